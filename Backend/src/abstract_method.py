@@ -4,7 +4,6 @@ import time
 from abc import ABC, abstractmethod
 from typing import Dict, List, Optional, Any, Type, Literal
 import asyncio
-import jsonref
 from itertools import count
 from datetime import datetime as dt
 import os
@@ -22,16 +21,29 @@ from .models import (SessionData, QueryResponse, AgentMessage, ChatMessage, Opac
                      ToolCall, ContainerLoginNotification, ContainerLoginResponse, ToolCallMessage,
                      ToolResultMessage, TextChunkMessage, MetricsMessage, StatusMessage, MethodConfig,
                      MissingApiKeyNotification, MissingApiKeyResponse, ConfirmActionNotification, ConfirmActionResponse,
-                     LLMConfig)
+                     LLMConfig, HistoryConfig, HistorySummary, ToolSelectionConfig)
+from .chat_history import SUMMARY_PROMPT, SUMMARY_BUDGET_SHARE, count_tokens, summary_messages, window_start, \
+    summary_request, truncate_tokens
 from .file_utils import upload_files
+from .response_chain import ResponseChain
+from .llm_cache import request_key, record_event, replay_events, get_response, put_response
+from .model_capabilities import get_model_capabilities
 from .internal_tools import InternalTools, INTERNAL_TOOLS_AGENT_NAME
+from .restrictions import needs_confirmation, is_deduplicated, is_forbidden
+from .result_cache import canonical_params, get_result_ttl, get_result, put_result
+from .tool_catalog import token_subject
+from .tool_retrieval import rank_tools
 
 
-# list of string-fragments; if any action or agent name contains one of those, SAGE will ask for confirmation before calling the tool
-actions_needing_confirmation: List[str] = []
-
 logger = logging.getLogger(__name__)
 
+# whether to lay out the requests so that LLM providers can reuse the cached prefix of previous requests, i.e.
+# static instructions and a deterministically ordered list of tools first, volatile parts like the time last
+PROMPT_CACHE_LAYOUT = os.getenv("LLM_PROMPT_CACHE_LAYOUT", "true").lower() == "true"
+
+# maximum number of tools accepted by the LLM APIs in a single request
+MAX_TOOLS = 128
+
 
 class AbstractMethod(ABC):
     NAME: str
@@ -51,6 +63,9 @@ class AbstractMethod(ABC):
         self.streaming = streaming
         self.tool_counter = count(0)
         self.internal_tools = internal_tools
+        self.inflight_invocations: Dict[tuple, asyncio.Future] = {}  # shared OPACA invocations within this query
+        self.event_queue: asyncio.Queue | None = None  # intermediate messages streamed on the HTTP response, if any
+        self.history_by_model: Dict[str, List[Dict[str, Any]]] = {}  # chat history within the token budget, per model
 
     @classmethod
     def config_schema(cls) -> Dict[str, Any]:
@@ -71,12 +86,13 @@ class AbstractMethod(ABC):
             model_config: LLMConfig,
             agent: str,
             system_prompt: str,
-            messages: List[ChatMessage],
+            messages: List[ChatMessage | Dict[str, Any]],
             tools: Optional[List[Dict[str, Any]]] = None,
             tool_choice: Optional[Literal["auto", "none", "only", "required"]] = "auto",
             response_format: Optional[Type[BaseModel]] = None,
             status_message: str | None = None,
             is_output: bool = False,
+            chain: ResponseChain | None = None,
     ) -> AgentMessage:
         """
         Calls an LLM with given parameters, including support for streaming, tools, file uploads, and response schema parsing.
@@ -85,12 +101,14 @@ class AbstractMethod(ABC):
             model_config (Dict[str, Any]): Individual model configuration settings.
             agent (str): The agent name (e.g. "simple-tools").
             system_prompt (str): The system prompt for model instructions.
-            messages (List[ChatMessage]): The list of chat messages.
+            messages (List[ChatMessage | Dict]): The list of chat messages, or their serialized form.
             tools (Optional[List[Dict]]): List of tool definitions (functions).
             tool_choice (Optional[str]): Whether to force tool use ("auto", "none", "only", or "required").
             response_format (Optional[Type[BaseModel]]): Optional Pydantic schema to validate response.
             status_message (str): optional message to be streamed to the UI
             is_output (bool): whether agent output should be streamed directly to chat or only to debug
+            chain (ResponseChain): state for continuing the previous response of this role in a multi-round loop,
+                if enabled with chain_responses; the messages have to extend those of the previous call
 
         Returns:
             AgentMessage: The final message returned by the LLM with metadata.
@@ -103,7 +121,7 @@ class AbstractMethod(ABC):
         model = model_config.model
 
         # Check if an additional API key is required for this model
-        if not self.session.get_api_key(model) and not litellm.validate_environment(model).get("keys_in_environment"):
+        if not self.session.get_api_key(model) and not get_model_capabilities(model).keys_in_environment:
             await self.handle_invalid_api_key(model)
 
         # Initialize variables
@@ -115,6 +133,9 @@ class AbstractMethod(ABC):
         # Modify the last user message to include file parts
         if file_message_parts:
             last = messages[-1]
+            if isinstance(last, dict):
+                # serialized messages may be shared, e.g. with the chat history
+                last = messages[-1] = ChatMessage(**last)
 
             # Normalize last content to "content parts"
             if isinstance(last.content, list):
@@ -131,8 +152,8 @@ class AbstractMethod(ABC):
             'api_key': self.session.get_api_key(model),
             'model': model,
             'instructions': system_prompt,
-            'input': [m.model_dump() for m in messages],
-            'tools': tools or [],
+            'input': [m if isinstance(m, dict) else m.model_dump() for m in messages],
+            'tools': sorted(tools, key=lambda t: t.get("name", "")) if tools and PROMPT_CACHE_LAYOUT else tools or [],
             'tool_choice': tool_choice if tools else 'none',
             'text_format': response_format,
             'stream': True
@@ -145,9 +166,41 @@ class AbstractMethod(ABC):
         if tool_choice == "only":
             kwargs['tool_choice'] = 'auto'
 
+        # Replay the cached response to an identical request, if enabled for this role, else record the events
+        cache_key = request_key(kwargs) if model_config.cache_responses else None
+        cached_events = await get_response(cache_key) if cache_key else None
+        recorded_events = [] if cache_key and cached_events is None else None
+
+        # Continue the previous response stored by the provider, sending only new messages and tool results,
+        # if enabled for this role (and the response is not cached anyway)
+        use_chain = (chain is not None and model_config.chain_responses and not model_config.cache_responses
+                     and get_model_capabilities(model).supports_response_chaining)
+        chained_input = chain.chained_input(model, messages) if use_chain else None
+        if use_chain:
+            kwargs['store'] = True
+        if chained_input is not None:
+            full_input = kwargs['input']
+            kwargs |= {'previous_response_id': chain.response_id, 'input': chained_input}
+        response_id, call_ids = None, {}
+
         # Main stream logic
-        stream = await litellm.aresponses_api_with_mcp(**kwargs)
+        if cached_events is not None:
+            stream = replay_events(cached_events)
+        else:
+            try:
+                stream = await litellm.aresponses_api_with_mcp(**kwargs)
+            except Exception as e:
+                if chained_input is None:
+                    raise
+                # e.g. the stored response expired; send the full input instead
+                logger.warning(f"Could not continue previous response {chain.response_id}, sending full input: {e}")
+                chained_input = None
+                del kwargs['previous_response_id']
+                kwargs['input'] = full_input
+                stream = await litellm.aresponses_api_with_mcp(**kwargs)
         async for event in stream:
+            if recorded_events is not None and (recorded := record_event(event)):
+                recorded_events.append(recorded)
 
             # Abort the response generation for a specific chat,
             # or for all notifications and other anonymous queries at once.
@@ -221,17 +274,33 @@ class AbstractMethod(ABC):
                             logger.warning(f"Could not parse tool arguments: {t.arguments}")
                             tool = ToolCall(name=t.name, type=tool_type, id=self.next_tool_id(agent_message), args={})
                         agent_message.tools.append(tool)
+                        call_ids[tool.id] = t.call_id
                         await self.send_to_websocket(ToolCallMessage(id=tool.id, name=tool.name, args=tool.args, agent=agent, chat_id=self.chat.chat_id))
-                # Capture token usage
+                response_id = getattr(event.response, "id", None)
+                # Capture token usage, including input tokens read from the provider's prompt cache
                 agent_message.response_metadata = event.response.usage.model_dump()
+                agent_message.response_metadata["cached_tokens"] = get_cached_tokens(agent_message.response_metadata)
+                if cached_events is not None:
+                    agent_message.response_metadata["cached_response"] = True
+                if chained_input is not None:
+                    agent_message.response_metadata["chained_response"] = True
+                elif recorded_events is not None:
+                    await put_response(cache_key, recorded_events)
 
         agent_message.execution_time = time.time() - exec_time
 
+        if chain is not None:
+            if use_chain and response_id and cached_events is None:
+                chain.update(model, response_id, messages, call_ids, agent_message)
+            else:
+                chain.reset()
+
         # Final stream to transmit execution time and response metadata
         await self.send_to_websocket(MetricsMessage(
             agent=agent,
             execution_time=agent_message.execution_time,
             metrics=agent_message.response_metadata,
+            cached_tokens=agent_message.response_metadata.get("cached_tokens", 0),
             chat_id=self.chat.chat_id,
         ))
 
@@ -240,7 +309,56 @@ class AbstractMethod(ABC):
         return agent_message
 
 
+    async def get_history(self, model_config: LLMConfig) -> List[ChatMessage | Dict[str, Any]]:
+        """
+        Get the previous interactions of the chat to be sent to the given model, within the token budget of the
+        method's history config, if any: as many recent interactions as fit in the budget (but at least the latest),
+        preceded by a summary of the older ones, limited to a share of the budget. The summary is extended (once per
+        query) as interactions drop out of the budget, and stored with the chat; the resulting history is reused for
+        all further rounds and roles of the query.
+        The messages are returned in their (shared) serialized form, so they must not be modified.
+        """
+        model = model_config.model
+        if model in self.history_by_model:
+            return list(self.history_by_model[model])
+
+        config: HistoryConfig | None = getattr(self.get_config(), "history", None)
+        responses = [r for r in self.chat.responses if r is not self.response]
+        messages = self.chat.serialized_messages(exclude=self.response)
+        if config is None or config.max_tokens <= 0:
+            self.history_by_model[model] = messages
+            return list(messages)
+
+        summary = self.chat.history_summary if config.summarize else None
+        if summary and summary.turns > len(responses):
+            summary = None
+        summary_budget = int(config.max_tokens * SUMMARY_BUDGET_SHARE)
+        if summary:
+            summary = HistorySummary(content=truncate_tokens(model, summary.content, summary_budget), turns=summary.turns)
+        start = summary.turns if summary else 0
+        summary_tokens = count_tokens(model, summary.content) if summary else 0
+        first = window_start(model, responses, start, config.max_tokens - summary_tokens)
+
+        if config.summarize and first > start:
+            result = await self.call_llm(
+                model_config=model_config,
+                agent="History Summarizer",
+                system_prompt=SUMMARY_PROMPT.format(words=max(50, summary_budget * 3 // 4)),
+                messages=[ChatMessage(role="user", content=summary_request(summary, responses[start:first]))],
+                status_message="Summarizing earlier messages",
+            )
+            summary = HistorySummary(content=truncate_tokens(model, result.content, summary_budget), turns=first)
+            self.chat.history_summary = summary
+            # the updated summary may be longer, exceeding the budget slightly; the window still starts right after
+            # the summary, and interactions not fitting any more are summarized with the next query
+
+        self.history_by_model[model] = [*summary_messages(summary), *messages[2 * first:]]
+        return list(self.history_by_model[model])
+
+
     async def send_to_websocket(self, message: BaseModel):
+        if self.event_queue is not None:
+            self.event_queue.put_nowait({"type": message.__class__.__name__, **message.model_dump()})
         if self.session.has_websocket() and self.streaming:
             await self.session.websocket_send(message)
 
@@ -258,11 +376,12 @@ class AbstractMethod(ABC):
         if not (login_attempt_retry or await self.check_confirmation(tool_name, tool_args)):
             return ToolCall(id=tool_id, type="opaca", name=tool_name, args=tool_args, result="Execution declined by user, do not attempt again.")
 
+        cached = False
         try:
             if agent_name == INTERNAL_TOOLS_AGENT_NAME:
                 t_result = await self.internal_tools.call_internal_tool(action_name, tool_args)
             else:
-                t_result = await self.session.opaca_client.invoke_opaca_action(action_name, agent_name, tool_args)
+                t_result, cached = await self.run_cancellable(self.invoke_opaca_action_cached(action_name, agent_name, tool_args))
         except httpx.HTTPStatusError as e:
             res = e.response.json()
             t_result = f"Failed to invoke tool.\nStatus code: {e.response.status_code}\nResponse: {e.response.text}\nResponse JSON: {res}"
@@ -273,8 +392,56 @@ class AbstractMethod(ABC):
         except Exception as e:
             t_result = f"Failed to invoke tool.\nCause: {e}"
 
-        await self.send_to_websocket(ToolResultMessage(id=tool_id, result=t_result, chat_id=self.chat.chat_id))
-        return ToolCall(id=tool_id, type="opaca", name=tool_name, args=tool_args, result=t_result)
+        await self.send_to_websocket(ToolResultMessage(id=tool_id, result=t_result, chat_id=self.chat.chat_id, cached=cached))
+        return ToolCall(id=tool_id, type="opaca", name=tool_name, args=tool_args, result=t_result, cached=cached)
+
+    async def run_cancellable(self, coro):
+        """Run the coroutine as a task that is cancelled right away when the query is aborted by the user."""
+        task = asyncio.ensure_future(coro)
+        self.session.track_task(self.chat.chat_id, task)
+        try:
+            return await task
+        except asyncio.CancelledError:
+            # only the task was cancelled (by abort), not the query itself
+            if task.cancelled() and not asyncio.current_task().cancelling():
+                raise Exception("Cancelled, as the generation of the response has been stopped.")
+            raise
+
+    async def invoke_opaca_action_cached(self, action_name: str, agent_name: str | None, tool_args: dict) -> tuple[Any, bool]:
+        """
+        Invoke the OPACA action, or take the result from the result cache if a TTL is configured for the action.
+        Results of containers the session is logged in to are not cached, as they may depend on the login.
+        Returns the result and whether it was taken from the cache.
+        """
+        client = self.session.opaca_client
+        ttl = get_result_ttl(agent_name, action_name)
+        if not ttl or is_forbidden(agent_name, action_name) or client.is_logged_in_for(agent_name, action_name):
+            return await self.invoke_opaca_action_shared(action_name, agent_name, tool_args), False
+
+        key = (client.url, token_subject(client.token), agent_name, action_name, canonical_params(tool_args))
+        found, result = get_result(key)
+        if not found:
+            result = await self.invoke_opaca_action_shared(action_name, agent_name, tool_args)
+            put_result(key, result, ttl)
+        return result, found
+
+    async def invoke_opaca_action_shared(self, action_name: str, agent_name: str | None, tool_args: dict) -> Any:
+        """
+        Invoke the OPACA action; if enabled for the action, concurrent calls with identical parameters
+        within this query share a single invocation (and its result or error).
+        """
+        if not is_deduplicated(agent_name, action_name):
+            return await self.session.opaca_client.invoke_opaca_action(action_name, agent_name, tool_args)
+
+        key = (agent_name, action_name, canonical_params(tool_args))
+        if key not in self.inflight_invocations:
+            task = asyncio.ensure_future(self.session.opaca_client.invoke_opaca_action(action_name, agent_name, tool_args))
+            task.add_done_callback(lambda _: self.inflight_invocations.pop(key, None))
+            # the shared invocation itself is cancelled as well when the query is aborted
+            self.session.track_task(self.chat.chat_id, task)
+            self.inflight_invocations[key] = task
+        # shielded, so one caller being cancelled does not cancel the invocation for the others
+        return await asyncio.shield(self.inflight_invocations[key])
 
     async def invoke_mcp_tool(self, full_tool_name: str, tool_args: dict, tool_id: str) -> ToolCall:
         async def create_result(result):
@@ -312,11 +479,13 @@ class AbstractMethod(ABC):
         return await create_result(t_result)
 
 
-    async def get_tools(self, include_internal: bool = True, include_mcp: bool = True, max_tools=128) -> tuple[list[dict], str]:
+    async def get_tools(self, include_internal: bool = True, include_mcp: bool = True, max_tools=MAX_TOOLS) -> tuple[list[dict], str]:
         """
         Get list of available actions as OpenAI Functions. This primarily includes the OPACA actions, but can also include "internal" tools.
+        Use select_tools to get the tools most relevant to the query from those, to be sent to the LLM.
         """
-        tools, error = openapi_to_functions(await self.session.opaca_client.get_actions_openapi(inline_refs=True))
+        catalog = await self.session.opaca_client.get_tool_catalog()
+        tools, error = catalog.get_functions(), catalog.errors
 
         if include_mcp and self.session.mcp_servers:
             for server in self.session.mcp_servers.values():
@@ -330,16 +499,32 @@ class AbstractMethod(ABC):
             tools.extend(self.internal_tools.get_internal_tools_openai())
         if len(tools) > max_tools:
             error += (f"WARNING: Your number of tools ({len(tools)}) exceeds the maximum tool limit "
-                      f"of {max_tools}. All tools after index {max_tools} will be ignored!\n")
-            tools = tools[:max_tools]
+                      f"of {max_tools}. Only the {max_tools} tools most relevant to the query will be used!\n")
         return tools, error
 
+    async def select_tools(self, tools: list[dict], context: str = "") -> list[dict]:
+        """
+        Select the tools most relevant to the query and the given context (e.g. results of the previous round),
+        up to the number configured in the method's tool selection config, if any, and at most MAX_TOOLS.
+        Tools already used in this query or earlier in the chat are always included.
+        """
+        config: ToolSelectionConfig | None = getattr(self.get_config(), "tool_selection", None)
+        k = min(config.max_tools or MAX_TOOLS, MAX_TOOLS) if config else MAX_TOOLS
+        if len(tools) <= k:
+            return tools
+        used = {tool.name
+                for response in (*self.chat.responses, self.response)
+                for message in response.agent_messages
+                for tool in message.tools}
+        return await rank_tools(tools, f"{self.response.query}\n{context}", k, used)
+
 
     async def check_confirmation(self, tool_name: str, parameters: dict, force_ask: bool = False) -> bool:
         """Use websocket to ask user for confirmation before executing the action if it matches any of the "needing confirmation" actions.
         Returns whether the action may be executed or not.
         """
-        if force_ask or any(x.lower() in tool_name.lower() for x in actions_needing_confirmation):
+        agent_name, action_name = tool_name.split('--', maxsplit=1) if '--' in tool_name else (None, tool_name)
+        if force_ask or needs_confirmation(agent_name, action_name):
             if not self.session.has_websocket(): return False
             # ask user for confirmation, sharing lock-mechanism with container-login
             async with self.session.opaca_client.login_lock:
@@ -408,10 +593,10 @@ class AbstractMethod(ABC):
         in each prompt, as well as (b) things like the current date and time or the location.
         """
         SELF_INTRODUCTION_AND_CAPABILITIES = f"""
-        You are part of an LLM Assistant called \"SAGE\". {self.get_time_and_location()} Following are your 
+        You are part of an LLM Assistant called \"SAGE\". Following are your 
         individual tasks:
         """
-        return "\n".join((SELF_INTRODUCTION_AND_CAPABILITIES, specific_prompt))
+        return compose_prompt("\n".join((SELF_INTRODUCTION_AND_CAPABILITIES, specific_prompt)), self.get_time_and_location())
 
     @staticmethod
     def get_time_and_location():
@@ -423,55 +608,17 @@ class AbstractMethod(ABC):
         else:
             return f"The current date and time is {now}."
 
-def openapi_to_functions(openapi_spec, agent: str | None = None):
-    """
-    Convert OpenAPI REST specification (with inlined references) to OpenAI Function specification.
-
-    Parameters:
-    - openapi_spec: the OpenAPI specification
-    - agent: name of OPACA agent to filter for, or None for all
-    """
-    functions = []
-    error_msg = ""
 
-    for path, methods in openapi_spec.get("paths", {}).items():
-        for method, spec_with_ref in methods.items():
-            # Resolve JSON references.
-            try:
-                spec = jsonref.replace_refs(spec_with_ref)
-            except Exception as e:
-                error_msg += f'Error while replacing references for unknown action. Cause: {e}\n'
-                continue
+def compose_prompt(static: str, volatile: str) -> str:
+    """Combine the static and volatile parts of a system prompt; with the cache-friendly layout, the volatile
+    part comes last, so that the static part forms a stable prefix that can be cached by the LLM provider."""
+    return "\n\n".join((static, volatile) if PROMPT_CACHE_LAYOUT else (volatile, static))
 
-            # Extract a name for the functions
-            try:
-                # The operation id is formatted as 'containerId-agentName-actionName'
-                container_id, agent_name, function_name = spec.get("operationId").split(';')
-                # action relevant for selected agent?
-                if agent and agent_name != agent:
-                    continue
-            except Exception as e:
-                error_msg += f'Error while splitting the operation id {spec.get("operationId")}. Cause: {e}\n'
-                continue
-
-            # Extract a description and parameters.
-            desc = spec.get("description", "")[:1024] or spec.get("summary", "")[:1024]
-
-            # assemble function block
-            # structure of schema: type (str), required (list), properties (the actual parameters), additionalProperties (bool)
-            schema = (spec.get("requestBody", {})
-                        .get("content", {})
-                        .get("application/json", {})
-                        .get("schema"))
-            schema.setdefault("properties", {})  # must be present even if no params
-
-            functions.append(
-                {
-                    "type": "function",
-                    "name": agent_name + '--' + function_name,
-                    "description": desc,
-                    "parameters": schema,
-                }
-            )
 
-    return functions, error_msg
+def get_cached_tokens(usage: Dict[str, Any]) -> int:
+    """Number of input tokens read from the provider's prompt cache, as reported in the token usage of the
+    Responses API, or of the Chat Completions API (e.g. if LiteLLM bridges the call to that)."""
+    for details in ("input_tokens_details", "prompt_tokens_details"):
+        if cached := (usage.get(details) or {}).get("cached_tokens"):
+            return cached
+    return usage.get("cache_read_input_tokens") or 0
@@ -0,0 +1,67 @@
+"""
+Helpers for keeping the chat history sent to the LLM within a token budget (see HistoryConfig). The most recent
+interactions are sent as they are, as long as they fit in the budget; older ones are covered by a rolling summary,
+which is extended incrementally whenever further interactions drop out of the window, and stored with the chat.
+The summary may take up only part of the budget, and the latest interaction is always kept, so that the window
+does not shrink to nothing and the summary does not have to be extended again with each query.
+"""
+import logging
+from typing import Any, Dict, List
+
+import litellm
+
+from .models import HistorySummary, QueryResponse
+
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = """You maintain a summary of the earlier part of a conversation between a user and an AI assistant \
+that can call tools on behalf of the user. You are given the previous summary, if any, and the next interactions. \
+Write an updated summary containing all facts, results, decisions and open requests that may be relevant for \
+continuing the conversation, e.g. names, IDs, dates and numbers. Do not add anything else. Use at most {words} words."""
+
+SUMMARY_QUERY = "Summarize our conversation so far."
+
+# share of the history's token budget that may be used by the summary; longer summaries are truncated
+SUMMARY_BUDGET_SHARE = 0.25
+
+
+def count_tokens(model: str, text: str) -> int:
+    """Number of tokens of the text for the given model, or a rough estimate if the tokenizer is not known."""
+    try:
+        return litellm.token_counter(model=model, text=text)
+    except Exception as e:
+        logger.debug(f"Could not count tokens for {model}: {e}")
+        return len(text) // 4
+
+
+def truncate_tokens(model: str, text: str, max_tokens: int) -> str:
+    """The text, cut off so that it has (roughly) at most the given number of tokens."""
+    tokens = count_tokens(model, text)
+    if tokens <= max_tokens:
+        return text
+    return text[:len(text) * max_tokens // tokens].rsplit(" ", 1)[0] + " [...]"
+
+
+def summary_messages(summary: HistorySummary | None) -> List[Dict[str, Any]]:
+    """The summary as a (fictitious) interaction, so that user and assistant messages still alternate."""
+    if summary is None:
+        return []
+    return [{"role": "user", "content": SUMMARY_QUERY}, {"role": "assistant", "content": summary.content}]
+
+
+def window_start(model: str, responses: List[QueryResponse], start: int, budget: int) -> int:
+    """Index of the oldest interaction (not before `start`) such that it and all following ones fit in the budget,
+    but always including the latest interaction."""
+    used = 0
+    for i in range(len(responses) - 1, start - 1, -1):
+        used += count_tokens(model, f"{responses[i].query}\n{responses[i].content}")
+        if used > budget:
+            return min(i + 1, len(responses) - 1)
+    return start
+
+
+def summary_request(summary: HistorySummary | None, responses: List[QueryResponse]) -> str:
+    previous = summary.content if summary else "(none)"
+    interactions = "\n\n".join(f"User: {r.query}\nAssistant: {r.content}" for r in responses)
+    return f"Previous summary:\n{previous}\n\nNext interactions:\n{interactions}"
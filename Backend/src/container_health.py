@@ -0,0 +1,115 @@
+"""
+Health of the containers running on the connected OPACA platforms, tracked from the results of the
+action invocations (shared by all sessions). For each container, a circuit breaker is opened when too many of
+the recent invocations failed, so that further calls to an unavailable container fail fast, instead of each
+one waiting for the platform's error. After some time, a single call is let through to probe whether the
+container has recovered (half-open), closing the breaker again if it succeeds.
+"""
+import os
+import time
+from collections import deque
+from datetime import datetime
+from enum import Enum
+from typing import Any, Deque, Dict, List, Tuple
+
+
+# settings for the circuit breakers: minimum number of calls and error rate within the last calls
+# for opening the breaker, and time in seconds before a call is let through again
+BREAKER_WINDOW = int(os.getenv("OPACA_BREAKER_WINDOW", 20))
+BREAKER_MIN_CALLS = int(os.getenv("OPACA_BREAKER_MIN_CALLS", 5))
+BREAKER_ERROR_RATE = float(os.getenv("OPACA_BREAKER_ERROR_RATE", 0.5))
+BREAKER_OPEN_SECONDS = float(os.getenv("OPACA_BREAKER_OPEN_SECONDS", 30))
+
+# weight of the latest call in the exponentially weighted moving average of the latency
+LATENCY_ALPHA = 0.2
+
+
+class BreakerState(str, Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+
+class ContainerHealth:
+    """Rolling error rate, latency average and circuit breaker of a single container."""
+
+    def __init__(self, url: str, container_id: str):
+        self.url = url
+        self.container_id = container_id
+        self.state = BreakerState.CLOSED
+        self.outcomes: Deque[bool] = deque(maxlen=BREAKER_WINDOW)  # whether the most recent calls succeeded
+        self.latency = 0.0
+        self.calls = 0
+        self.failures = 0
+        self.opened_at = 0.0
+        self.last_error = ""
+
+    @property
+    def error_rate(self) -> float:
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def allow_request(self) -> bool:
+        """Whether a call to the container should be made; in half-open state, only a single probing call."""
+        if self.state != BreakerState.CLOSED and time.time() - self.opened_at >= BREAKER_OPEN_SECONDS:
+            # let one call through (again, in case the previous probing call never returned)
+            self.state = BreakerState.HALF_OPEN
+            self.opened_at = time.time()
+            return True
+        return self.state == BreakerState.CLOSED
+
+    def retry_in(self) -> float:
+        """Seconds until the next call to the container is let through."""
+        return max(0.0, self.opened_at + BREAKER_OPEN_SECONDS - time.time())
+
+    def record(self, success: bool, latency: float, error: str = "") -> None:
+        """Record the outcome of a call, opening or closing the breaker accordingly."""
+        self.calls += 1
+        self.outcomes.append(success)
+        self.latency = latency if self.calls == 1 else LATENCY_ALPHA * latency + (1 - LATENCY_ALPHA) * self.latency
+        if success:
+            if self.state == BreakerState.HALF_OPEN:
+                self.state = BreakerState.CLOSED
+                self.outcomes.clear()
+        else:
+            self.failures += 1
+            self.last_error = error
+            if (self.state == BreakerState.HALF_OPEN or
+                    (len(self.outcomes) >= BREAKER_MIN_CALLS and self.error_rate >= BREAKER_ERROR_RATE)):
+                self.state = BreakerState.OPEN
+                self.opened_at = time.time()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "url": self.url,
+            "container_id": self.container_id,
+            "state": self.state.value,
+            "error_rate": round(self.error_rate, 3),
+            "latency": round(self.latency, 3),
+            "calls": self.calls,
+            "failures": self.failures,
+            "opened_at": datetime.fromtimestamp(self.opened_at).isoformat() if self.opened_at else None,
+            "last_error": self.last_error,
+        }
+
+
+# health of containers by (platform URL, container ID)
+_container_health: Dict[Tuple[str, str], ContainerHealth] = {}
+
+
+def get_container_health(url: str, container_id: str) -> ContainerHealth:
+    """Get the health of the given container, creating it if necessary."""
+    key = (url, container_id)
+    if key not in _container_health:
+        _container_health[key] = ContainerHealth(*key)
+    return _container_health[key]
+
+
+def forget_container_health(url: str, container_id: str) -> None:
+    """Remove the health of a container that was stopped."""
+    _container_health.pop((url, container_id), None)
+
+
+def get_container_health_info() -> List[Dict[str, Any]]:
+    """Health of all containers for the health-admin route, unhealthy and slow containers first."""
+    return [h.to_dict() for h in sorted(_container_health.values(),
+                                        key=lambda h: (h.state == BreakerState.CLOSED, -h.error_rate, -h.latency))]
@@ -1,10 +1,12 @@
-import io
+import asyncio
+import hashlib
 import re
 import os
 import tempfile
 import logging
 import shutil
 from pathlib import Path
+from typing import Dict, Tuple
 from urllib.parse import urlparse
 
 import litellm
@@ -12,61 +14,50 @@ from fastapi import UploadFile
 from starlette.datastructures import Headers
 
 from .models import SessionData, OpacaFile, OpacaException
+from .model_capabilities import get_model_capabilities
 
 logger = logging.getLogger(__name__)
 
 
 FILES_PATH = './data/files'
 
+# maximum number of files uploaded to the LLM host at the same time
+FILE_UPLOAD_CONCURRENCY = int(os.getenv("FILE_UPLOAD_CONCURRENCY", 4))
+
+# host's file IDs of uploaded files by (host, purpose, content hash), shared by all sessions, uploads still in
+# progress, and number of files referencing each host's file ID
+_uploaded_by_hash: Dict[Tuple[str, str, str], str] = {}
+_pending_uploads: Dict[Tuple[str, str, str], asyncio.Future] = {}
+_upload_refs: Dict[str, int] = {}
+
 
 async def upload_files(session: SessionData, model: str):
     """Uploads all unsent files to the connected LLM. Returns a list of file messages including file IDs."""
 
+    # Nothing to do if there are no (active) files, e.g. for most queries, and for internal calls
+    files = [f for f in session.uploaded_files.values() if not f.suspended]
+    if not files:
+        return []
+
     host = model.rsplit("/", 1)[0]
 
     # Check if model supports vision
-    model_supports_vision = (bool(litellm.supports_vision(model=model)) and host == "openai")
-
-    # Upload all files that haven't been uploaded to this host
-    for file_id, file_data in session.uploaded_files.items():
-        # Skip suspended files
-        if file_data.suspended:
-            continue
+    model_supports_vision = get_model_capabilities(model).supports_vision and host == "openai"
 
+    # Upload all files that haven't been uploaded to this host, concurrently
+    pending = [f for f in files if host not in f.host_ids]
+    if pending:
         # Check if the selected host supports file upload
         if host not in ["openai", "azure", "vertex_ai", "bedrock"]:
             raise OpacaException(user_message=f"Host {host} does not support file upload.")
 
-        # If this host already has an uploaded id for this file, skip
-        if host in file_data.host_ids:
-            continue
-
-        filename = file_data.file_name
-
-        # Check file type (purpose)
-        if is_image(filename) and model_supports_vision:
-            purpose = "vision"
-        elif is_pdf(filename):
-            purpose = "assistants"
-        else:
-            logger.info(f"Skipping file upload (Type not supported): {model} ({filename})")
-            continue
-
-        # prepare file for upload
-        file_path = create_path(session.session_id, file_id)
-        with open(file_path, 'rb') as f:
-            file_obj = io.BytesIO(f.read())
-            file_obj.name = file_data.file_name  # Required by OpenAI SDK
-
-        # Upload to the current host and store host-specific id
-        uploaded = await litellm.acreate_file(file=file_obj, purpose=purpose, custom_llm_provider=host)
-        logger.info(f"Uploaded file ID={uploaded.id} for file_id={file_id} (host={host})")
-        # record host id under this host_url
-        file_data.host_ids[host] = uploaded.id
+        semaphore = asyncio.Semaphore(FILE_UPLOAD_CONCURRENCY)
+        await asyncio.gather(*[upload_file(session, file_data, host, model_supports_vision, semaphore)
+                               for file_data in pending])
 
     parts = []
-    for filedata in session.uploaded_files.values():
-        if filedata.suspended or (host not in filedata.host_ids):
+    for filedata in files:
+        if host not in filedata.host_ids:
             continue
 
         if is_image(filedata.file_name) and model_supports_vision:
@@ -77,6 +68,68 @@ async def upload_files(session: SessionData, model: str):
     return parts
 
 
+async def upload_file(session: SessionData, file_data: OpacaFile, host: str, model_supports_vision: bool, semaphore: asyncio.Semaphore):
+    """Upload a single file to the host, or reuse the ID of a file with the same content uploaded before."""
+    filename = file_data.file_name
+
+    # Check file type (purpose)
+    if is_image(filename) and model_supports_vision:
+        purpose = "vision"
+    elif is_pdf(filename):
+        purpose = "assistants"
+    else:
+        logger.info(f"Skipping file upload (Type not supported): {host} ({filename})")
+        return
+
+    file_path = create_path(session.session_id, file_data.file_id)
+    if not file_data.content_hash:
+        file_data.content_hash = await asyncio.to_thread(hash_file, file_path)
+
+    # identical files (in any session) are uploaded only once, even if requested at the same time
+    key = (host, purpose, file_data.content_hash)
+    if key not in _uploaded_by_hash:
+        if key not in _pending_uploads:
+            task = asyncio.ensure_future(_upload_to_host(file_path, file_data, host, purpose, semaphore))
+            task.add_done_callback(lambda _: _pending_uploads.pop(key, None))
+            _pending_uploads[key] = task
+        _uploaded_by_hash[key] = await asyncio.shield(_pending_uploads[key])
+    host_file_id = _uploaded_by_hash[key]
+    # record host id under this host_url (unless already done by a concurrent call for the same session)
+    if host not in file_data.host_ids:
+        _upload_refs[host_file_id] = _upload_refs.get(host_file_id, 0) + 1
+        file_data.host_ids[host] = host_file_id
+
+
+async def _upload_to_host(file_path: Path, file_data: OpacaFile, host: str, purpose: str, semaphore: asyncio.Semaphore) -> str:
+    async with semaphore:
+        # stream the file from disk instead of loading it into memory first
+        with open(file_path, 'rb') as f:
+            uploaded = await litellm.acreate_file(file=(file_data.file_name, f, file_data.content_type),
+                                                  purpose=purpose, custom_llm_provider=host)
+    logger.info(f"Uploaded file ID={uploaded.id} for file_id={file_data.file_id} (host={host})")
+    return uploaded.id
+
+
+def register_uploaded_files(session: SessionData) -> None:
+    """Register the files of a session restored from the DB as uploaded, so their IDs are reused for identical
+    files, and they are not deleted from the host while still being used by another session."""
+    for file_data in session.uploaded_files.values():
+        for host, host_file_id in file_data.host_ids.items():
+            _upload_refs[host_file_id] = _upload_refs.get(host_file_id, 0) + 1
+            if file_data.content_hash:
+                purpose = "vision" if is_image(file_data.file_name) else "assistants"
+                _uploaded_by_hash.setdefault((host, purpose, file_data.content_hash), host_file_id)
+
+
+def hash_file(file_path: Path) -> str:
+    """Get the SHA-256 hash of the file's content, reading it in chunks."""
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(1024 * 1024):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
 async def delete_file_from_all_clients(session: SessionData, file_id: str, ignore_error: bool) -> bool:
     """
     Delete a file (identified by file_id) from all LLM hosts
@@ -92,6 +145,14 @@ async def delete_file_from_all_clients(session: SessionData, file_id: str, ignor
         return ignore_error
 
     for host, host_file_id in filedata.host_ids.items():
+        # Do not delete the file from the host if identical files of other sessions still use it
+        if _upload_refs.get(host_file_id, 0) > 1:
+            _upload_refs[host_file_id] -= 1
+            continue
+        _upload_refs.pop(host_file_id, None)
+        for key in [k for k, v in _uploaded_by_hash.items() if v == host_file_id]:
+            del _uploaded_by_hash[key]
+
         # Check if the selected host supports file deletion
         if not host in ["openai", "azure"]:
             logger.warning(f"Host {host} does not support file deletion.")
@@ -113,6 +174,13 @@ async def delete_file_from_all_clients(session: SessionData, file_id: str, ignor
     return True
 
 
+async def release_uploaded_files(session: SessionData) -> None:
+    """Release the session's references to its uploaded files, e.g. when the session is deleted, deleting
+    the files from the hosts once no other session uses them anymore."""
+    for file_id in list(session.uploaded_files):
+        await delete_file_from_all_clients(session, file_id, ignore_error=True)
+
+
 async def save_file_to_disk(file: UploadFile, session: SessionData) -> OpacaFile:
     """
     Save an UploadFile to disk.
@@ -130,9 +198,12 @@ async def save_file_to_disk(file: UploadFile, session: SessionData) -> OpacaFile
     # Add to uploaded_files
     session.uploaded_files[file_data.file_id] = file_data
     logger.info(f'Saving file to "{file_path}"')
+    sha = hashlib.sha256()
     with open(file_path, 'wb') as f:
         while chunk := await file.read(1024 * 1024):
             f.write(chunk)
+            sha.update(chunk)
+    file_data.content_hash = sha.hexdigest()
     return file_data
 
 
@@ -0,0 +1,74 @@
+"""
+Helpers for streaming the intermediate messages of a query on the HTTP response itself, as an alternative to the
+session's websocket, e.g. for API clients and benchmarks. The messages are the same typed messages that are sent
+via websocket (text chunks, tool calls and results, metrics, etc.), followed by the final QueryResponse, either as
+newline-delimited JSON or as Server-Sent Events, depending on the request's Accept header.
+"""
+import asyncio
+import json
+import logging
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict
+
+from fastapi import Request, Response
+from fastapi.responses import StreamingResponse
+
+from .models import QueryResponse
+
+
+logger = logging.getLogger(__name__)
+
+MEDIA_TYPE_NDJSON = "application/x-ndjson"
+MEDIA_TYPE_SSE = "text/event-stream"
+
+# queries continuing after the client disconnected; referenced here so they are not garbage-collected
+_background_tasks: set[asyncio.Task] = set()
+
+
+def encode_ndjson(message: Dict[str, Any]) -> str:
+    return json.dumps(message, default=str) + "\n"
+
+
+def encode_sse(message: Dict[str, Any]) -> str:
+    return f"event: {message['type']}\ndata: {json.dumps(message, default=str)}\n\n"
+
+
+async def stream_events(run: Callable[[asyncio.Queue], Awaitable[QueryResponse]], encode: Callable[[Dict[str, Any]], str],
+                        cancel_on_disconnect: bool = True) -> AsyncIterator[str]:
+    """Run the query, passing it the queue for its intermediate messages, and yield those messages as they come in,
+    followed by the final QueryResponse. If the client disconnects before, the query is cancelled, if so requested;
+    otherwise it continues in the background, e.g. so that the result is still added to the chat history."""
+    events = asyncio.Queue()
+    task = asyncio.create_task(run(events))
+    task.add_done_callback(lambda _: events.put_nowait(None))
+    try:
+        while (message := await events.get()) is not None:
+            yield encode(message)
+        response = task.result()
+        yield encode({"type": QueryResponse.__name__, **response.model_dump()})
+    finally:
+        if not task.done():
+            logger.info("Client disconnected from streamed query")
+            if cancel_on_disconnect:
+                task.cancel()
+            else:
+                _background_tasks.add(task)
+                task.add_done_callback(_background_tasks.discard)
+
+
+def streaming_response(request: Request, response: Response, run: Callable[[asyncio.Queue], Awaitable[QueryResponse]],
+                       cancel_on_disconnect: bool = True) -> StreamingResponse:
+    """Stream the messages of the query as Server-Sent Events, if accepted by the client, or as NDJSON otherwise.
+    The cookies set on the route's (temporary) response, i.e. the session cookie, are kept."""
+    if MEDIA_TYPE_SSE in request.headers.get("accept", ""):
+        media_type, encode = MEDIA_TYPE_SSE, encode_sse
+    else:
+        media_type, encode = MEDIA_TYPE_NDJSON, encode_ndjson
+    streaming = StreamingResponse(
+        stream_events(run, encode, cancel_on_disconnect),
+        media_type=media_type,
+        # disable buffering in reverse proxies like nginx, so messages are passed on right away
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    for cookie in response.headers.getlist("set-cookie"):
+        streaming.headers.append("set-cookie", cookie)
+    return streaming
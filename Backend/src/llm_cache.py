@@ -0,0 +1,160 @@
+"""
+Opt-in cache for the responses of the LLM to identical requests, e.g. evaluator calls with temperature 0,
+benchmarks, the platform info, or scheduled tasks. Enabled per method and role with the `cache_responses`
+setting of the respective LLMConfig. Responses are recorded as the (simplified) sequence of stream events and
+replayed on a cache hit, so that streaming to the websocket and the metrics work just like for an actual call.
+Responses are kept in memory, evicting the least recently used ones once the (estimated) size of all responses
+exceeds a limit, and optionally also on disk, so they can be reused after a restart.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Dict, List
+
+from litellm.types.llms.openai import ResponseAPIUsage, ResponsesAPIStreamEvents as event_type
+from litellm.types.responses.main import OutputFunctionToolCall
+from openai.types.responses import ResponseFunctionToolCall
+from pydantic import BaseModel
+
+
+logger = logging.getLogger(__name__)
+
+
+# upper bound for the (estimated) total size of all responses cached in memory, in bytes
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", 16 * 1024 * 1024))
+
+# directory for additionally storing the cached responses on disk; disabled if empty
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", "")
+
+llm_cache_stats: Dict[str, int] = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+
+# recorded stream events and estimated size by request key
+_responses: OrderedDict[str, tuple[List[Dict[str, Any]], int]] = OrderedDict()
+_responses_size = 0
+
+
+def request_key(kwargs: Dict[str, Any]) -> str:
+    """Hash of the canonical representation of everything that determines the response of the LLM,
+    i.e. model, parameters, instructions, input, tools, tool choice and response format (but not the API key)."""
+    request = {k: v for k, v in kwargs.items() if k not in ("api_key", "stream", "text_format")}
+    text_format = kwargs.get("text_format")
+    if isinstance(text_format, type) and issubclass(text_format, BaseModel):
+        request["text_format"] = text_format.model_json_schema()
+    canonical = json.dumps(request, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def record_event(event) -> Dict[str, Any] | None:
+    """Simplified, serializable form of a stream event, with all the data needed for replaying it."""
+    if event.type == event_type.OUTPUT_TEXT_DELTA:
+        return {"type": event.type, "delta": event.delta}
+    if event.type == event_type.OUTPUT_ITEM_DONE and event.item.type == "mcp_call":
+        # tool called by the LLM host; must not be cached, as the tool would not be called again
+        return {"type": event.type, "item_type": event.item.type}
+    if event.type == event_type.RESPONSE_COMPLETED:
+        return {
+            "type": event.type,
+            "tool_calls": [{"name": t.name, "arguments": t.arguments, "call_id": t.call_id}
+                           for t in event.response.output
+                           if isinstance(t, (OutputFunctionToolCall, ResponseFunctionToolCall))],
+            "usage": event.response.usage.model_dump(),
+        }
+    return None
+
+
+async def replay_events(events: List[Dict[str, Any]]) -> AsyncIterator[Any]:
+    """Replay recorded events in the same form as the actual stream events (as far as used by call_llm)."""
+    for event in events:
+        if event["type"] == event_type.OUTPUT_TEXT_DELTA:
+            yield SimpleNamespace(type=event_type.OUTPUT_TEXT_DELTA, delta=event["delta"])
+        elif event["type"] == event_type.RESPONSE_COMPLETED:
+            yield SimpleNamespace(type=event_type.RESPONSE_COMPLETED, response=SimpleNamespace(
+                output=[ResponseFunctionToolCall(type="function_call", **t) for t in event["tool_calls"]],
+                usage=ResponseAPIUsage(**event["usage"]),
+            ))
+
+
+async def get_response(key: str) -> List[Dict[str, Any]] | None:
+    """Get the recorded events of the cached response for the given key, from memory or disk, if any."""
+    if key in _responses:
+        _responses.move_to_end(key)
+        llm_cache_stats["hits"] += 1
+        return _responses[key][0]
+    if LLM_CACHE_DIR:
+        try:
+            events = json.loads(await asyncio.to_thread(_cache_file(key).read_text))
+            _put_in_memory(key, events)
+            llm_cache_stats["disk_hits"] += 1
+            return events
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Could not read cached LLM response {key}: {e}")
+    llm_cache_stats["misses"] += 1
+    return None
+
+
+async def put_response(key: str, events: List[Dict[str, Any]]) -> None:
+    """Cache the recorded events of a complete response, unless the LLM host called any tools."""
+    if any(e.get("item_type") == "mcp_call" for e in events):
+        return
+    _put_in_memory(key, events)
+    if LLM_CACHE_DIR:
+        try:
+            await asyncio.to_thread(_write_file, _cache_file(key), json.dumps(events))
+        except Exception as e:
+            logger.warning(f"Could not write cached LLM response {key}: {e}")
+
+
+def clear_responses() -> None:
+    """Drop all cached responses, in memory and on disk."""
+    global _responses_size
+    _responses.clear()
+    _responses_size = 0
+    if LLM_CACHE_DIR:
+        for file in Path(LLM_CACHE_DIR).glob("*.json"):
+            file.unlink(missing_ok=True)
+
+
+def get_llm_cache_info() -> Dict[str, Any]:
+    """Simplified view on the LLM response cache for the llm-cache-admin route."""
+    return {
+        **llm_cache_stats,
+        "entries": len(_responses),
+        "size": _responses_size,
+        "max_size": LLM_CACHE_MAX_BYTES,
+        "directory": LLM_CACHE_DIR or None,
+    }
+
+
+def _put_in_memory(key: str, events: List[Dict[str, Any]]) -> None:
+    global _responses_size
+    size = len(json.dumps(events))
+    if size > LLM_CACHE_MAX_BYTES:
+        return
+    if key in _responses:
+        _responses_size -= _responses.pop(key)[1]
+    _responses[key] = (events, size)
+    _responses_size += size
+    while _responses_size > LLM_CACHE_MAX_BYTES:
+        _, (_, evicted_size) = _responses.popitem(last=False)
+        _responses_size -= evicted_size
+        llm_cache_stats["evictions"] += 1
+
+
+def _cache_file(key: str) -> Path:
+    return Path(LLM_CACHE_DIR) / f"{key}.json"
+
+
+def _write_file(path: Path, content: str) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # write to temporary file first, so concurrent readers never see a partial file
+    tmp = path.with_name(f"{path.stem}.{uuid.uuid4().hex}.tmp")
+    tmp.write_text(content)
+    tmp.replace(path)
@@ -0,0 +1,82 @@
+"""
+Registry of the capabilities of the LLM models as reported by LiteLLM, e.g. whether the API key for the model
+is set in the environment, or which parameters it supports. Those lookups are needed for each LLM call and each
+validation or serialization of a method config, so they are memoized per model string. The registry has to be
+cleared explicitly (see invalidate_model_capabilities) whenever the relevant environment variables (API keys,
+configured models) change, e.g. on startup.
+"""
+import logging
+from dataclasses import dataclass
+from typing import Dict, FrozenSet
+
+import litellm
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ModelCapabilities:
+    """
+    Capabilities of a single model.
+
+    Attributes:
+        keys_in_environment: whether the API key(s) for the model's provider are set in the environment
+        supports_vision: whether the model accepts images as input
+        supported_params: names of the OpenAI parameters supported by the model
+        supports_structured_output: whether the model supports a JSON schema as response format
+        supports_response_chaining: whether the provider stores responses, to be continued with previous_response_id
+    """
+    keys_in_environment: bool
+    supports_vision: bool
+    supported_params: FrozenSet[str]
+    supports_structured_output: bool
+    supports_response_chaining: bool
+
+
+_capabilities: Dict[str, ModelCapabilities] = {}
+
+
+def get_model_capabilities(model: str) -> ModelCapabilities:
+    """Get the (memoized) capabilities of the given model, e.g. "openai/gpt-4o-mini"."""
+    if model not in _capabilities:
+        _capabilities[model] = _lookup_capabilities(model)
+    return _capabilities[model]
+
+
+def invalidate_model_capabilities() -> None:
+    """Drop all memoized capabilities, e.g. after the available models or API keys changed."""
+    _capabilities.clear()
+
+
+def _lookup_capabilities(model: str) -> ModelCapabilities:
+    def lookup(func, default):
+        try:
+            return func()
+        except Exception as e:
+            logger.warning(f"Could not look up {func.__name__} for model {model}: {e}")
+            return default
+
+    def keys_in_environment():
+        return bool(litellm.validate_environment(model).get("keys_in_environment"))
+
+    def supports_vision():
+        return bool(litellm.supports_vision(model=model))
+
+    def supported_params():
+        return frozenset(litellm.get_supported_openai_params(model) or ())
+
+    def supports_structured_output():
+        return bool(litellm.supports_response_schema(model=model))
+
+    def supports_response_chaining():
+        # other providers are called via the Chat Completions API by LiteLLM, without server-side state
+        return litellm.get_llm_provider(model)[1] in ("openai", "azure")
+
+    return ModelCapabilities(
+        keys_in_environment=lookup(keys_in_environment, False),
+        supports_vision=lookup(supports_vision, False),
+        supported_params=lookup(supported_params, frozenset()),
+        supports_structured_output=lookup(supports_structured_output, False),
+        supports_response_chaining=lookup(supports_response_chaining, False),
+    )
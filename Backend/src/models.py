@@ -12,12 +12,13 @@ import time
 import traceback
 import asyncio
 
-from litellm import get_supported_openai_params
 from litellm.experimental_mcp_client.client import MCPClient
 from starlette.websockets import WebSocket
 from pydantic import BaseModel, Field, PrivateAttr, SerializeAsAny, ValidationError, model_serializer, model_validator
 
 from .opaca_client import OpacaClient
+from .model_capabilities import get_model_capabilities
+from .websocket_stream import ChunkCoalescer, OutboundBuffer, WebSocketWriter
 
 
 logger = logging.getLogger(__name__)
@@ -88,9 +89,34 @@ class RestrictedActions(BaseModel):
     Attributes:
         forbidden: actions are forbidden and will result in an error if the LLM tries to call them
         need_confirmation: actions will require confirmation by the user each time they are called
+        deduplicate: (read-only) actions where concurrent calls with identical parameters within the same
+            query share a single invocation; if not given when updating, the current list is kept
     """
     forbidden: List[str]
     need_confirmation: List[str]
+    deduplicate: List[str] | None = None
+
+
+class ResultCacheConfig(BaseModel):
+    """
+    Used as payload for the /admin/result-cache route.
+
+    Attributes:
+        ttls: time in seconds for which results of actions where agent or action name contains (ignoring case)
+            the given string-fragment are cached; if multiple rules apply, the smallest TTL is used
+    """
+    ttls: Dict[str, float]
+
+
+class ActionTimeouts(BaseModel):
+    """
+    Used as payload/result for the /admin/timeouts routes.
+
+    Attributes:
+        timeouts: timeout in seconds for invoking actions where agent or action name contains (ignoring case)
+            the given string-fragment, instead of the global default; if multiple rules apply, the smallest is used
+    """
+    timeouts: Dict[str, float]
 
 
 class QueryRequest(BaseModel):
@@ -114,7 +140,7 @@ class AgentMessage(BaseModel):
         agent: The name of the agent
         content: The content of the message generated by the agent
         tools: List of generated tool calls
-        response_metadata: Metadata associated with the response including token usage
+        response_metadata: Metadata associated with the response including token usage (and cached input tokens)
         execution_time: Time it took to execute the response
         formatted_output: JSON output generated by the agent, if requested with response_format
     """
@@ -170,12 +196,14 @@ class OpacaFile(BaseModel):
         file_name: The absolute path to the file
         host_ids: IDs assigned by each host the file has been uploaded to
         suspended: Whether the file should be excluded from future requests
+        content_hash: SHA-256 hash of the file's content, to upload identical files only once
     """
     file_id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     content_type: str
     file_name: str
     host_ids: Dict[str, str] = Field(default_factory=dict)
     suspended: bool = False
+    content_hash: str | None = None
 
 
 class ChatMessage(BaseModel):
@@ -199,10 +227,11 @@ class ToolCall(BaseModel):
     name: str
     args: Dict[str, Any] = {}
     result: Any | None = None
+    cached: bool = False  # whether the result was taken from the result cache
 
     def without_id(self):
         """representation for tool without ID field, to be passed back to LLM (ID can be confusing)"""
-        return {k: v for k, v in self.model_dump().items() if k != "id"}
+        return {k: v for k, v in self.model_dump().items() if k not in ("id", "cached")}
 
 
 class InternalTool(BaseModel):
@@ -253,6 +282,18 @@ class PromptCategory(BaseModel):
     questions: List[Prompt] = []
 
 
+class HistorySummary(BaseModel):
+    """
+    Rolling summary of the older part of a chat's history, replayed to the LLM instead of those messages.
+
+    Attributes:
+        content: The summary of the first `turns` interactions of the chat.
+        turns: The number of interactions (from the start of the chat) covered by the summary.
+    """
+    content: str
+    turns: int
+
+
 class Chat(BaseModel):
     """
     Stores information about each chat.
@@ -265,7 +306,9 @@ class Chat(BaseModel):
         time_modified: when the chat was last used
         is_aborted: Boolean indicating whether the current interaction should be aborted.
         is_finished: Boolean indicating whether the chat has finished generating a response for its last query.
+        history_summary: Summary of older interactions not fitting in the token budget for the history, if any.
         messages: Chat history (user queries and final LLM responses), used in subsequent requests. (derived)
+        _serialized: Serialized messages of each response, with the query and content they were created from
     """
     chat_id: str
     name: str = ''
@@ -274,6 +317,9 @@ class Chat(BaseModel):
     time_modified: datetime = Field(default_factory=lambda: datetime.now(tz=timezone.utc))
     is_aborted: bool = False
     is_finished: bool = True
+    history_summary: HistorySummary | None = None
+
+    _serialized: List[tuple[str, str, tuple[Dict[str, Any], Dict[str, Any]]]] = PrivateAttr(default_factory=list)
 
     @property
     def messages(self) -> Iterator[ChatMessage]:
@@ -281,11 +327,33 @@ class Chat(BaseModel):
             yield ChatMessage(role="user", content=r.query)
             yield ChatMessage(role="assistant", content=r.content)
 
+    def serialized_messages(self, exclude: QueryResponse | None = None) -> List[Dict[str, Any]]:
+        """Chat history in the serialized form of the messages sent to the LLM, optionally without the given
+        (e.g. still running) response. The returned messages are shared and must not be modified."""
+        self._update_serialized()
+        return [message
+                for r, (_, _, messages) in zip(self.responses, self._serialized) if r is not exclude
+                for message in messages]
+
     def store_interaction(self, result: QueryResponse):
         self.responses.append(result)
+        self._update_serialized()
         self.update_modified()
         self.derive_name()
 
+    def _update_serialized(self) -> None:
+        """Serialize the messages of new responses, and of those whose query or content changed since then
+        (e.g. the response was still running when stored); others are reused as they are."""
+        del self._serialized[len(self.responses):]
+        for i, r in enumerate(self.responses):
+            if i < len(self._serialized) and self._serialized[i][0] is r.query and self._serialized[i][1] is r.content:
+                continue
+            entry = (r.query, r.content, ({"role": "user", "content": r.query}, {"role": "assistant", "content": r.content}))
+            if i < len(self._serialized):
+                self._serialized[i] = entry
+            else:
+                self._serialized.append(entry)
+
     def update_modified(self) -> None:
         self.time_modified = datetime.now(tz=timezone.utc)
 
@@ -353,10 +421,13 @@ class SessionData(BaseModel):
     Transient fields:
         _websocket: Can be used to send intermediate result and other messages back to the UI
         _ws_message_queue: Used to buffer messages received from the websocket
-        _ws_out_cache: Used to cache outgoing WS messages if WS is disconnected, to be sent later
+        _ws_buffer: Outgoing WS messages with sequence numbers, kept to be (re)sent when the WS (re)connects
+        _ws_coalescer: Merges consecutive text chunks of the same message before sending them
+        _ws_writer: Sends the buffered WS messages from a single task, so producers never wait for the client
         _opaca_client: Client instance for OPACA, for calling agent actions.
         _llm_clients: Dictionary of LLM client instances.
         _user_api_keys: User-provided API keys for specific LLM hosts
+        _inflight_tasks: Running tasks (e.g. action invocations) by chat ID, to be cancelled when aborted.
 
     Note: The websocket from the session should not be used directly; instead use the send/receive
     methods. Especially the latter is necessary to ensure that messages are properly received while
@@ -377,9 +448,12 @@ class SessionData(BaseModel):
 
     _websocket: WebSocket | None = PrivateAttr(default=None)
     _ws_msg_queue: asyncio.Queue | None = PrivateAttr(default=None)
-    _ws_out_cache: list[dict] | None = PrivateAttr(default_factory=list)
+    _ws_buffer: OutboundBuffer = PrivateAttr(default_factory=OutboundBuffer)
+    _ws_coalescer: ChunkCoalescer | None = PrivateAttr(default=None)
+    _ws_writer: WebSocketWriter | None = PrivateAttr(default=None)
     _opaca_client: OpacaClient = PrivateAttr(default_factory=OpacaClient)
     _user_api_keys: Dict[str, str] = PrivateAttr(default_factory=dict)
+    _inflight_tasks: Dict[str, Set[asyncio.Task]] = PrivateAttr(default_factory=dict)
 
     @model_validator(mode="after")
     def initialize_scheduled_task_id_counter(self) -> "SessionData":
@@ -396,6 +470,17 @@ class SessionData(BaseModel):
     def opaca_client(self) -> OpacaClient:
         return self._opaca_client
 
+    def track_task(self, chat_id: str, task: asyncio.Task) -> None:
+        """Register task (e.g. an action invocation) to be cancelled when the query in the given chat is aborted."""
+        tasks = self._inflight_tasks.setdefault(chat_id, set())
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    def cancel_tasks(self, chat_id: str) -> None:
+        """Cancel all running tasks registered for the given chat (or '' for anonymous queries)."""
+        for task in self._inflight_tasks.pop(chat_id, set()):
+            task.cancel()
+
     def is_valid(self) -> bool:
         return self.valid_until > time.time()
 
@@ -434,20 +519,52 @@ class SessionData(BaseModel):
     def has_websocket(self) -> bool:
         return self._websocket is not None
 
-    async def websocket_send_pending(self):
-        for msg in self._ws_out_cache:
-            await self._websocket.send_json(msg)
-        self._ws_out_cache.clear()
+    async def attach_websocket(self, websocket: WebSocket, last_seq: int | None = None, subprotocol: str | None = None):
+        """Use the (accepted) websocket for sending and receiving messages, in the encoding of the given subprotocol,
+        and send all messages after the given sequence number (or all not sent so far), asking the client to
+        reload the chats if some are missing. A previous websocket of the session is replaced, stopping its writer
+        before resuming, so that no two writers send from the buffer at the same time."""
+        if self._ws_writer:
+            await self._ws_writer.close()
+        self._websocket = websocket
+        self._ws_msg_queue = asyncio.Queue()
+        if not self._ws_buffer.resume(last_seq):
+            self._ws_buffer.append({"type": ReloadChatsMessage.__name__, **ReloadChatsMessage().model_dump()})
+        self._ws_writer = WebSocketWriter(websocket, self._ws_buffer, subprotocol)
+
+    async def detach_websocket(self, websocket: WebSocket | None = None) -> bool:
+        """Stop using the (disconnected) websocket; messages not sent yet are kept for the next one. If a websocket
+        is given, this does nothing unless it is still the current one, i.e. was not replaced by a new connection.
+        Returns whether the websocket was detached."""
+        if websocket is not None and websocket is not self._websocket:
+            return False
+        self._websocket = None
+        if self._ws_writer:
+            await self._ws_writer.close()
+            self._ws_writer = None
+        return True
+
+    def websocket_info(self) -> dict:
+        """Statistics of outgoing messages, for the sessions-admin route."""
+        return {
+            "connected": self.has_websocket(),
+            **self._ws_buffer.info(),
+            **(self._ws_writer.info() if self._ws_writer else {}),
+        }
 
     async def websocket_send(self, message: BaseModel) -> bool:
-        """Send object as JSON over websocket. The JSON will include the class name as "type"."""
+        """Send object as JSON over websocket. The JSON will include the class name as "type".
+        Consecutive text chunks of the same message may be merged and sent a few milliseconds later."""
         typed_message = {"type": message.__class__.__name__, **message.model_dump()}
-        if self._websocket:
-            await self._websocket.send_json(typed_message)
-            return True
-        else:
-            self._ws_out_cache.append(typed_message)
-            return False
+        if self._ws_coalescer is None:
+            self._ws_coalescer = ChunkCoalescer(self._websocket_send_typed)
+        await self._ws_coalescer.put(typed_message)
+        return self._websocket is not None
+
+    async def _websocket_send_typed(self, typed_message: dict):
+        self._ws_buffer.append(typed_message)
+        if self._websocket and self._ws_writer:
+            self._ws_writer.notify()
 
     async def websocket_receive(self) -> dict:
         if self._websocket and self._ws_msg_queue:
@@ -630,6 +747,13 @@ class ReloadChatsMessage(BaseModel):
     pass
 
 
+class ContainersChangedMessage(BaseModel):
+    """IDs of containers added to, removed from or changed on the connected platform."""
+    added: List[str] = []
+    removed: List[str] = []
+    changed: List[str] = []
+
+
 class ResetTextMessage(BaseModel):
     chat_id: str
 
@@ -646,6 +770,7 @@ class ToolResultMessage(BaseModel):
     id: str
     result: Any | None
     chat_id: str
+    cached: bool = False
 
 
 class StatusMessage(BaseModel):
@@ -658,6 +783,7 @@ class MetricsMessage(BaseModel):
     agent: str
     metrics: dict
     execution_time: float
+    cached_tokens: int = 0
     chat_id: str
 
 
@@ -779,6 +905,14 @@ class MethodConfig(BaseModel):
     def llm_role(title: str, description: str) -> Any:
         return Field(default_factory=LLMConfig, title=title, description=description)
 
+    @staticmethod
+    def history_field() -> Any:
+        return MethodConfig.nested(HistoryConfig, title='Chat History', description='How much of the chat history to send to the LLM')
+
+    @staticmethod
+    def tool_selection_field() -> Any:
+        return MethodConfig.nested(ToolSelectionConfig, title='Tool Selection', description='Which of the available tools to send to the LLM')
+
 
 class LLMParameters(BaseModel):
     """
@@ -791,12 +925,31 @@ class LLMParameters(BaseModel):
     presence_penalty: float = MethodConfig.number(default=0, min=-2, max=2, step=0.1, title="Presence Penalty", description="Penalty applied to repeated tokens based on their presence in the prompt")
 
 
+class HistoryConfig(BaseModel):
+    """
+    Token budget for the chat history sent to the LLM with each request. The most recent interactions are sent as
+    they are; older ones are replaced by a rolling summary, or dropped.
+    """
+    max_tokens: int = MethodConfig.integer(default=0, min=0, max=128000, step=1000, title="Max Tokens", description="Maximum number of tokens of the chat history sent to the LLM; 0 for sending the full history")
+    summarize: bool = MethodConfig.boolean(default=True, title="Summarize", description="Summarize older messages not fitting in the budget instead of dropping them")
+
+
+class ToolSelectionConfig(BaseModel):
+    """
+    Number of tools sent to the LLM with each request. If more tools are available, the ones most relevant to the
+    query (and the results of previous rounds) are selected, always including tools already used in the chat.
+    """
+    max_tools: int = MethodConfig.integer(default=0, min=0, max=128, step=1, title="Max Tools", description="Maximum number of tools sent to the LLM, selected by relevance to the query; 0 for all tools (up to the limit of 128)")
+
+
 class LLMConfig(BaseModel):
     """
     Saves a single model and its parameter configuration. Checks during serialization what parameters are supported by the LLM.
     """
     model: Annotated[str, MethodConfig.llm_field("model", "LLM to use for this agent")]
     parameters: LLMParameters = MethodConfig.nested(LLMParameters, title="LLM Parameters", description="Parameters for the LLM")
+    cache_responses: bool = MethodConfig.boolean(default=False, title="Cache Responses", description="Reuse the response to identical requests instead of calling the LLM again; only for deterministic settings, e.g. temperature 0")
+    chain_responses: bool = MethodConfig.boolean(default=False, title="Chain Rounds", description="In further rounds, send only new messages and tool results, continuing the previous response stored by the provider (OpenAI only); falls back to sending the full input")
 
     @model_serializer(mode="wrap")
     def filter_unsupported_params_for_serialization(self, serializer):
@@ -815,7 +968,7 @@ class LLMConfig(BaseModel):
     
     def _filter_supported(self, params: dict) -> dict:
         """Remove unsupported parameters from config schema."""
-        supported = get_supported_openai_params(self.model)
+        supported = get_model_capabilities(self.model).supported_params
         filtered = {k: v for k, v in params.items() if k in supported}
 
         # Special handling for reasoning models not supporting temperature settings
@@ -1,18 +1,178 @@
 import decimal
 import functools
+import hashlib
+import json
 import logging
 import asyncio
+import os
+import time
 
-import requests
 import httpx
 import jsonref
 from typing import Optional, List, Dict, Any
 
+from .tool_catalog import ToolCatalog, PlatformCatalog, catalog_stats, get_platform_catalog, notify_catalog_changed, \
+    is_catalog_stored
+from .container_health import get_container_health, forget_container_health
+from .restrictions import is_forbidden, ActionSettings
+
 logger = logging.getLogger(__name__)
 
 
-# list of string fragments that must NOT appear in the action names, else they will be forbidden
-actions_blacklist: List[str] = []
+# settings for the pooled HTTP connections to the OPACA platforms (shared by all sessions)
+HTTP_MAX_CONNECTIONS = int(os.getenv("OPACA_HTTP_MAX_CONNECTIONS", 100))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OPACA_HTTP_MAX_KEEPALIVE_CONNECTIONS", 20))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("OPACA_HTTP_KEEPALIVE_EXPIRY", 30))
+HTTP2_ENABLED = os.getenv("OPACA_HTTP2", "false").lower() == "true"
+
+# seconds for which the fetched container catalog is considered current before it is revalidated
+CATALOG_TTL = float(os.getenv("OPACA_CATALOG_TTL", 10))
+
+# timeout for probing a container's extra port, and for how long the result is reused (shorter if it failed)
+EXTRA_PORT_TIMEOUT = float(os.getenv("OPACA_EXTRA_PORT_TIMEOUT", 3))
+EXTRA_PORT_HEALTH_TTL = 60
+EXTRA_PORT_FAILURE_TTL = 15
+
+# timeouts in seconds for invoking actions (unless set otherwise for the action) and for logging in to containers;
+# 0 means no timeout
+INVOKE_TIMEOUT = float(os.getenv("OPACA_INVOKE_TIMEOUT", 300))
+LOGIN_TIMEOUT = float(os.getenv("OPACA_LOGIN_TIMEOUT", 60))
+
+# maximum size of action results in bytes; larger results are truncated (and passed to the LLM as string)
+MAX_RESULT_BYTES = int(os.getenv("OPACA_MAX_RESULT_BYTES", 1024 * 1024))
+
+# timeouts of individual actions, configured via the /admin/timeouts routes
+action_timeouts = ActionSettings()
+
+# last results of probing extra ports, by URL: (reachable, time of check)
+_extra_port_health: Dict[str, tuple[bool, float]] = {}
+
+# interval in seconds for checking the containers of connected platforms for changes in the background; 0 to disable
+CATALOG_WATCH_INTERVAL = float(os.getenv("OPACA_CATALOG_WATCH_INTERVAL", 0))
+
+# background tasks watching the containers, by (platform URL, platform user) like the catalogs
+_catalog_watchers: Dict[tuple[str, str | None], asyncio.Task] = {}
+
+# one long-lived HTTP client per event loop and platform URL (connections can not be shared between event loops)
+_http_clients: Dict[tuple[asyncio.AbstractEventLoop, str], httpx.AsyncClient] = {}
+
+
+def get_http_client(url: str) -> httpx.AsyncClient:
+    """Get the pooled HTTP client for the given platform URL, creating it if necessary. The client
+    keeps connections alive between requests and is shared by all sessions connected to that platform.
+    """
+    loop = asyncio.get_running_loop()
+    client = _http_clients.get((loop, url))
+    if client is not None and not client.is_closed:
+        return client
+
+    # the connections of clients of event loops closed in the meantime are gone already
+    for key in [key for key in _http_clients if key[0].is_closed()]:
+        del _http_clients[key]
+
+    http2 = HTTP2_ENABLED
+    if http2:
+        try:
+            import h2  # noqa: F401 (only checking availability)
+        except ImportError:
+            logger.warning("HTTP/2 enabled, but package 'h2' is not installed; falling back to HTTP/1.1")
+            http2 = False
+
+    client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        http2=http2,
+    )
+    _http_clients[(loop, url)] = client
+    return client
+
+
+async def close_http_clients() -> None:
+    """Close all pooled HTTP clients, e.g. on server shutdown. Clients of other (running) event loops
+    are closed in their own loop."""
+    current = asyncio.get_running_loop()
+    for (loop, url), client in list(_http_clients.items()):
+        try:
+            if loop is current:
+                await client.aclose()
+            elif loop.is_running():
+                asyncio.run_coroutine_threadsafe(client.aclose(), loop)
+        except Exception as e:
+            logger.warning(f"Could not close HTTP client for {url}: {e}")
+    _http_clients.clear()
+
+
+def error_status(response: httpx.Response) -> int:
+    """Status code of the innermost cause of an error response, as the platform wraps errors of the container
+    (e.g. a 400 of the container in a 502 of the platform), or the status code of the response itself."""
+    status = response.status_code
+    try:
+        cause = response.json()
+    except Exception:
+        return status
+    while isinstance(cause, dict) and isinstance(cause.get("cause"), dict):
+        cause = cause["cause"]
+        if isinstance(cause.get("statusCode"), int):
+            status = cause["statusCode"]
+    return status
+
+
+async def probe_extra_port(client: httpx.AsyncClient, url: str) -> bool:
+    """Check whether the extra port at the given URL is reachable, reusing recent results."""
+    if url in _extra_port_health:
+        ok, checked = _extra_port_health[url]
+        if time.time() - checked < (EXTRA_PORT_HEALTH_TTL if ok else EXTRA_PORT_FAILURE_TTL):
+            return ok
+    try:
+        (await client.get(url, timeout=EXTRA_PORT_TIMEOUT)).raise_for_status()
+        ok = True
+    except Exception as e:
+        logger.warning(f"Could not load extension {url}: {e}")
+        ok = False
+    _extra_port_health[url] = (ok, time.time())
+    return ok
+
+
+def start_catalog_watcher(client: "OpacaClient") -> None:
+    """Start watching the containers of the client's platform (as the client's user), if enabled and not already
+    watching. The catalog is watched until it is evicted from the catalog store."""
+    catalog = client._catalog()
+    catalog.watch_token = client.token
+    key = (catalog.url, catalog.subject)
+    if CATALOG_WATCH_INTERVAL > 0 and (key not in _catalog_watchers or _catalog_watchers[key].done()):
+        _catalog_watchers[key] = asyncio.create_task(_watch_catalog(catalog))
+
+
+async def stop_catalog_watchers() -> None:
+    """Stop all background catalog watchers, e.g. on server shutdown."""
+    for task in _catalog_watchers.values():
+        task.cancel()
+    await asyncio.gather(*_catalog_watchers.values(), return_exceptions=True)
+    _catalog_watchers.clear()
+
+
+async def _watch_catalog(catalog: PlatformCatalog) -> None:
+    watcher = OpacaClient()
+    watcher.url = catalog.url
+    while True:
+        await asyncio.sleep(CATALOG_WATCH_INTERVAL)
+        if not is_catalog_stored(catalog):
+            break
+        # the watcher itself should not keep the catalog from being evicted
+        last_access = catalog.last_access
+        watcher.token = catalog.watch_token
+        try:
+            async with catalog.lock:
+                await watcher._fetch_containers(catalog)
+            if catalog.tool_catalog is not None:
+                await watcher.get_tool_catalog()
+        except Exception as e:
+            logger.warning(f"Could not check containers of {catalog.url} for changes: {e}")
+        catalog.last_access = last_access
+    _catalog_watchers.pop((catalog.url, catalog.subject), None)
 
 
 class OpacaClient:
@@ -36,7 +196,8 @@ class OpacaClient:
         self.connected = False
         try:
             await self._get_token(user, pwd)
-            await self.get_containers()
+            await self.get_containers(force_refresh=True)
+            start_catalog_watcher(self)
             self.connected = True
             logger.info(f"Connected to {url}")
             return 200
@@ -61,62 +222,113 @@ class OpacaClient:
         try:
             if not self.url:
                 return []
-            async with httpx.AsyncClient() as client:
-                res = await client.get(f"{self.url}/containers", headers=self._headers())
-            res.raise_for_status()
-            # build dict of all accessible extra codes
-            tmp = {}
-            for container in res.json():
+            # collect all TCP extra ports, then check which of them are reachable, all at once
+            candidates = []
+            for container in await self.get_containers():
                 cid = container["containerId"]
                 token = self.logged_in_containers.get(cid)
                 for k, v in container["connectivity"]["extraPortMappings"].items():
                     if v["protocol"] == "TCP":
                         url = f'{container["connectivity"]["publicUrl"]}:{k}'
                         if token: url += f"?token={token}"
-                        try:
-                            requests.get(url).raise_for_status()
-                            if cid not in tmp:
-                                tmp[cid] = {
-                                    "container": container["image"]["imageName"],
-                                    "extraPorts": []
-                                }
-                            tmp[cid]["extraPorts"].append(
-                                {"fullUrl": url, "description": v["description"]}
-                            )
-                        except Exception as e:
-                            logger.warning(f"Could not load extension {url}: {e}")
+                        candidates.append((container, url, v["description"]))
+
+            client = self._client()
+            reachable = await asyncio.gather(*[probe_extra_port(client, url) for _, url, _ in candidates])
+
+            # build dict of all accessible extra codes
+            tmp = {}
+            for (container, url, description), ok in zip(candidates, reachable):
+                if ok:
+                    tmp.setdefault(container["containerId"], {
+                        "container": container["image"]["imageName"],
+                        "extraPorts": []
+                    })["extraPorts"].append({"fullUrl": url, "description": description})
             return list(tmp.values())
 
         except Exception as e:
             logger.error(f"Could not get Extra-Ports: {e}")
             raise e
 
-    async def get_containers(self) -> list:
-        """Get actions of OPACA agents, in original OPACA format."""
+    @property
+    def catalog_version(self) -> int:
+        """Version of the cached container catalog, changing each time the containers change."""
+        return self._catalog().version if self.url else 0
+
+    async def get_containers(self, force_refresh: bool = False) -> list:
+        """Get actions of OPACA agents, in original OPACA format. The result is cached (and shared with
+        other sessions connected to the same platform as the same user) for a short time and revalidated
+        with the platform (using the ETag, if provided) once that has expired.
+        """
         try:
             if not self.url:
                 return []
-            async with httpx.AsyncClient() as client:
-                res = await client.get(f"{self.url}/containers", headers=self._headers())
-            res.raise_for_status()
-            return res.json()
+            catalog = self._catalog()
+            async with catalog.lock:
+                if (catalog.containers is not None and not force_refresh
+                        and time.time() - catalog.containers_fetched < CATALOG_TTL):
+                    return catalog.containers
+
+                return await self._fetch_containers(catalog, revalidate=not force_refresh)
         except Exception as e:
             logger.error(f"Could not get Actions: {e}")
             raise e
-    
+
+    async def _fetch_containers(self, catalog: PlatformCatalog, revalidate: bool = True) -> list:
+        """Fetch the containers into the catalog (with the catalog's lock held), only getting the full list of
+        containers from the platform if they changed since the last fetch (if revalidate is set)."""
+        headers = self._headers() or {}
+        if catalog.containers is not None and catalog.containers_etag and revalidate:
+            headers["If-None-Match"] = catalog.containers_etag
+        res = await self._client().get(f"{self.url}/containers", headers=headers)
+        if res.status_code == 304:
+            catalog.containers_fetched = time.time()
+        else:
+            res.raise_for_status()
+            if diff := catalog.set_containers(res.json(), res.headers.get("ETag")):
+                notify_catalog_changed(catalog, diff)
+        return catalog.containers
+
+    async def get_agent_summaries(self) -> Dict[str, Dict[str, Any]]:
+        """Get description and names of actions of all agents, derived from (and cached with) the containers."""
+        if not self.url:
+            return {}
+        containers = await self.get_containers()
+        catalog = self._catalog()
+        if "agent_summaries" not in catalog.derived:
+            catalog.derived["agent_summaries"] = {
+                agent["agentId"]: {
+                    "description": agent["description"],
+                    "functions": [action["name"] for action in agent["actions"]]
+                }
+                for container in containers
+                for agent in container["agents"]
+            }
+        return dict(catalog.derived["agent_summaries"])
+
+    def invalidate_catalog(self) -> None:
+        """Mark the cached container catalog as outdated, so it is fetched again on next access."""
+        if self.url:
+            self._catalog().invalidate()
+
     async def deploy_container(self, post_container: dict, update: bool = False) -> None:
-        async with httpx.AsyncClient() as client:
+        try:
             if update:
-                res = await client.put(f"{self.url}/containers", json=post_container, headers=self._headers())
+                res = await self._client().put(f"{self.url}/containers", json=post_container, headers=self._headers())
             else:
-                res = await client.post(f"{self.url}/containers", json=post_container, headers=self._headers())
-        res.raise_for_status()
-    
+                res = await self._client().post(f"{self.url}/containers", json=post_container, headers=self._headers())
+            res.raise_for_status()
+        finally:
+            self.invalidate_catalog()
+
     async def stop_container(self, container_id: str) -> None:
         if self.url:
-            async with httpx.AsyncClient() as client:
-                res = await client.delete(f"{self.url}/containers/{container_id}", headers=self._headers())
-            res.raise_for_status()
+            try:
+                res = await self._client().delete(f"{self.url}/containers/{container_id}", headers=self._headers())
+                res.raise_for_status()
+                forget_container_health(self.url, container_id)
+            finally:
+                self.invalidate_catalog()
 
     async def get_actions_simple(self) -> dict[str, List[Dict[str, Any]]]:
         """Get actions of OPACA agents, grouped by agent, but a bit simplified: just agent-ids and actions"""
@@ -133,8 +345,7 @@ class OpacaClient:
         try:
             if not self.url:
                 return {}
-            async with httpx.AsyncClient() as client:
-                res = await client.get(f"{self.url}/v3/api-docs/actions", headers=self._headers())
+            res = await self._client().get(f"{self.url}/v3/api-docs/actions", headers=self._headers())
             res.raise_for_status()
             if inline_refs:
                 loader = functools.partial(jsonref.jsonloader, parse_float=decimal.Decimal)
@@ -145,21 +356,84 @@ class OpacaClient:
             logger.error(f"Could not get Actions: {e}")
             raise e
 
+    async def get_tool_catalog(self, force_refresh: bool = False) -> ToolCatalog:
+        """Get actions of OPACA agents as compiled catalog of OpenAI Functions. The OpenAPI specification
+        is fetched again after the same TTL as the container catalog, but only converted again if changed.
+        """
+        try:
+            if not self.url:
+                return ToolCatalog()
+            catalog = self._catalog()
+            async with catalog.lock:
+                if (catalog.tool_catalog is not None and not force_refresh
+                        and time.time() - catalog.tool_catalog_fetched < CATALOG_TTL):
+                    catalog_stats["hits"] += 1
+                    return catalog.tool_catalog
+
+                res = await self._client().get(f"{self.url}/v3/api-docs/actions", headers=self._headers())
+                res.raise_for_status()
+                spec_hash = hashlib.sha256(res.content).hexdigest()
+                if catalog.tool_catalog is not None and catalog.tool_catalog.spec_hash == spec_hash:
+                    catalog_stats["hits"] += 1
+                else:
+                    catalog.set_tool_catalog(json.loads(res.content, parse_float=decimal.Decimal), spec_hash)
+                catalog.tool_catalog_fetched = time.time()
+                return catalog.tool_catalog
+        except Exception as e:
+            logger.error(f"Could not get Actions: {e}")
+            raise e
+
     async def invoke_opaca_action(self, action: str, agent: Optional[str], params: dict) -> dict:
         """Invoke the given OPACA agent at the given agent (or any agent) with given parameters."""
-        if any(x in agent.lower() or x in action.lower() for x in map(str.lower, actions_blacklist)):
+        if is_forbidden(agent, action):
             raise Exception("Executing this action is currently not permitted.")
-        agent = f"/{agent}" if agent else ""
-        async with httpx.AsyncClient() as client:
-            res = await client.post(f"{self.url}/invoke/{action}{agent}", json=params, headers=self._headers(), timeout=None)
-        res.raise_for_status()
-        return res.json()
+        container_id, container_name = self._catalog().container_index.get((agent, action), ("", ""))
+        health = get_container_health(self.url, container_id) if container_id else None
+        if health and not health.allow_request():
+            raise Exception(f"The container '{container_name}' providing this action is currently unavailable "
+                            f"({health.last_error}); try again in {health.retry_in():.0f} seconds.")
+
+        timeout = action_timeouts.get(agent, action) or INVOKE_TIMEOUT or None
+        start = time.time()
+        try:
+            async with asyncio.timeout(timeout):
+                result = await self._invoke(f"{self.url}/invoke/{action}{f'/{agent}' if agent else ''}", params)
+        except httpx.HTTPStatusError as e:
+            # client errors (e.g. missing login, invalid parameters) do not count against the container's health
+            if health:
+                health.record(error_status(e.response) < 500, time.time() - start, str(e))
+            raise
+        except Exception as e:
+            if isinstance(e, TimeoutError):
+                e = TimeoutError(f"The action did not return a result within {timeout:.0f} seconds.")
+            if health:
+                health.record(False, time.time() - start, str(e) or type(e).__name__)
+            raise e
+        if health:
+            health.record(True, time.time() - start)
+        return result
+
+    async def _invoke(self, url: str, params: dict) -> Any:
+        """Post the invoke request, reading the response as a stream and truncating it if it is too large."""
+        async with self._client().stream("POST", url, json=params, headers=self._headers(), timeout=None) as res:
+            if res.is_error:
+                await res.aread()
+                res.raise_for_status()
+            content = bytearray()
+            async for chunk in res.aiter_bytes():
+                content += chunk
+                if len(content) > MAX_RESULT_BYTES:
+                    break
+        if len(content) > MAX_RESULT_BYTES:
+            logger.warning(f"Truncated result of {url} after {MAX_RESULT_BYTES} bytes")
+            return (content[:MAX_RESULT_BYTES].decode(errors="ignore")
+                    + f"\n[... result truncated, exceeding the maximum size of {MAX_RESULT_BYTES} bytes]")
+        return json.loads(content)
 
     async def container_login(self, container_id: str, username: str, password: str):
         """Initiate container login for OPACA RP"""
         logger.info(f"Login to container {container_id}")
-        async with httpx.AsyncClient() as client:
-            res = await client.post(f"{self.url}/containers/login/{container_id}", json={"username": username, "password": password}, headers=self._headers(), timeout=None)
+        res = await self._client().post(f"{self.url}/containers/login/{container_id}", json={"username": username, "password": password}, headers=self._headers(), timeout=LOGIN_TIMEOUT or None)
         res.raise_for_status()
 
         # Mark container as logged in
@@ -182,19 +456,30 @@ class OpacaClient:
                     return
 
                 logger.info(f"Logout of container {container_id}")
-                async with httpx.AsyncClient() as client:
-                    await client.post(f"{self.url}/containers/logout/{container_id}", headers=self._headers())
-                    del self.logged_in_containers[container_id]
+                await self._client().post(f"{self.url}/containers/logout/{container_id}", headers=self._headers())
+                del self.logged_in_containers[container_id]
 
     async def get_most_likely_container_id(self, agent: str, action: str) -> tuple[str, str]:
-        """Get most likely container id and name for given agent and action. Returns empty string if no match found."""
-        async with httpx.AsyncClient() as client:
-            res = await client.get(f"{self.url}/containers", headers=self._headers())
-        res.raise_for_status()
+        """Get most likely container id and name for given agent and action. Returns empty strings if no match found."""
+        # look up the container in the index derived from the cached containers, refreshing those only if not found
+        await self.get_containers()
+        if (agent, action) not in self._catalog().container_index:
+            await self.get_containers(force_refresh=True)
+        return self._catalog().container_index.get((agent, action), ("", ""))
+
+    def is_logged_in_for(self, agent: str | None, action: str) -> bool:
+        """Whether the results of the action may depend on a container login of this session, i.e. if the session
+        is logged in to the container providing the action (or to any container, if that is not known)."""
+        if not self.logged_in_containers:
+            return False
+        container_id, _ = self._catalog().container_index.get((agent, action), ("", ""))
+        return not container_id or container_id in self.logged_in_containers
+
+    def _client(self) -> httpx.AsyncClient:
+        return get_http_client(self.url)
 
-        # Return the containerId and container name of the first matching container to include the given agent and action
-        return next((c["containerId"], c["image"].get("name") or c["image"]["imageName"]) for c in res.json()
-                    for a in c["agents"] if a["agentId"] == agent and any(action == ac["name"] for ac in a["actions"]))
+    def _catalog(self) -> PlatformCatalog:
+        return get_platform_catalog(self.url, self.token)
 
     def _headers(self):
         return {'Authorization': f'Bearer {self.token}'} if self.token else None
@@ -203,7 +488,6 @@ class OpacaClient:
         """Get and store JWT access token for OPACA RP"""
         self.token = None
         if user:
-            async with httpx.AsyncClient() as client:
-                res = await client.post(f"{self.url}/login", json={"username": user, "password": pwd})
+            res = await self._client().post(f"{self.url}/login", json={"username": user, "password": pwd})
             res.raise_for_status()
             self.token = res.text
@@ -7,6 +7,7 @@ import pytz
 from copy import deepcopy
 
 
+from ..abstract_method import compose_prompt
 from ..models import ChatMessage, AgentMessage
 from .models import (
     AgentTask, OrchestratorPlan, PlannerPlan, AgentEvaluation,
@@ -239,10 +240,10 @@ class WorkerAgent(BaseAgent):
         self.logger = logging.getLogger(__name__)
 
     def system_prompt(self):
-        return get_current_time() + BACKGROUND_INFO + AGENT_SYSTEM_PROMPT.format(
+        return compose_prompt(BACKGROUND_INFO + AGENT_SYSTEM_PROMPT.format(
             agent_name=self.agent_name,
             agent_summary=self.summary
-        )
+        ), get_current_time())
 
     @staticmethod
     def messages(task: Union[str, AgentTask]):
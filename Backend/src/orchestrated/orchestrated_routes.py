@@ -8,9 +8,9 @@ import asyncio
 from .prompts import (
     OUTPUT_GENERATOR_PROMPT, BACKGROUND_INFO, GENERAL_CAPABILITIES_RESPONSE, GENERAL_AGENT_DESC, INTERNAL_AGENT_DESC
 )
-from ..abstract_method import AbstractMethod, openapi_to_functions
+from ..abstract_method import AbstractMethod
 from ..models import QueryResponse, AgentMessage, ChatMessage, ToolCall, StatusMessage, MethodConfig, \
-    LLMConfig
+    LLMConfig, HistoryConfig
 from .agents import (
     OrchestratorAgent,
     WorkerAgent,
@@ -31,6 +31,7 @@ class OrchestrationConfig(MethodConfig):
     evaluator_model: LLMConfig = MethodConfig.llm_role(title='Evaluators', description='For evaluating tool results')
     generator_model: LLMConfig = MethodConfig.llm_role(title='Output', description='For generating the final response')
     max_rounds: int = MethodConfig.max_rounds_field()
+    history: HistoryConfig = MethodConfig.history_field()
     max_iterations: int = MethodConfig.integer(default=3, min=1, max=10, step=1, title='Max Iterations', description='Maximum number of re-iterations (retries after failed attempts)')
     use_agent_planner: bool = MethodConfig.boolean(default=True, title='Use Agent Planner?')
     use_agent_evaluator: bool = MethodConfig.boolean(default=False, title='Use Agent Evaluator?')
@@ -286,7 +287,7 @@ Now, using the tools available to you and the previous results, continue with yo
 
             # Initialize Orchestrator, evaluator and iteration advisor
             orchestrator = OrchestratorAgent(
-                chat_history=self.chat.messages,
+                chat_history=await self.get_history(config.orchestrator_model),
                 tools=self.get_agents_as_tools(agent_details),
             )
             overall_evaluator = OverallEvaluator()
@@ -346,10 +347,10 @@ Now, using the tools available to you and the previous results, continue with yo
                         agent_data = agent_details[agent_name]["description"]
                         
                         # Get functions from platform
-                        agent_tools = await self.session.opaca_client.get_actions_openapi(inline_refs=True)
-                        agent_tools, errors = openapi_to_functions(agent_tools, agent=agent_name)
-                        if errors:
-                            logger.warning(errors)
+                        catalog = await self.session.opaca_client.get_tool_catalog()
+                        agent_tools = catalog.get_functions(agent=agent_name)
+                        if catalog.errors:
+                            logger.warning(catalog.errors)
                         
                         # Create worker agents for each unique agent in the plan
                         worker_agents[agent_name] = WorkerAgent(
@@ -466,14 +467,7 @@ Please address these specific improvements:
 
     async def get_agent_details(self) -> Dict[str, Dict]:
         """Get simplified agent summaries for the orchestrator"""
-        agent_details = {
-            agent["agentId"]: {
-                "description": agent["description"],
-                "functions": [action["name"] for action in agent["actions"]]
-            }
-            for container in await self.session.opaca_client.get_containers()
-            for agent in container["agents"]
-        }
+        agent_details = await self.session.opaca_client.get_agent_summaries()
         agent_details["GeneralAgent"] = {"description": GENERAL_AGENT_DESC, "functions": ["GeneralAgent--getGeneralCapabilities"]}
         if self.internal_tools:
             agent_details["InternalToolsAgent"] = {"description": INTERNAL_AGENT_DESC, "functions": [tool["name"] for tool in self.internal_tools.get_internal_tools_openai()]}
@@ -0,0 +1,78 @@
+"""
+Chaining of the LLM calls in the rounds of a multi-round loop via the Responses API's `previous_response_id`, for
+roles where `chain_responses` is enabled and providers that store responses (see ModelCapabilities). Instead of
+resending the full input in each round, only the messages added since the previous round, and the outputs of the
+tools called in the previous response, are sent; messages merely repeating those outputs for the full input are
+left out. Whenever the chain can not be continued, e.g. for a different
+model, changed earlier messages, or an expired stored response, the full input is sent instead.
+"""
+import hashlib
+import json
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Set
+
+from .models import AgentMessage, ChatMessage
+
+
+@dataclass
+class ResponseChain:
+    """
+    State of the chain of responses of one role in one query, to be passed to each call of call_llm.
+
+    Attributes:
+        model: the model of the previous response
+        response_id: ID of the previous response, as stored by the provider
+        sent: number of messages already covered by the previous response
+        prefix_hash: hash of those messages, to detect if they changed in the meantime
+        call_ids: the provider's call IDs of the function calls in the previous response, by ToolCall ID
+        message: the previous response, for getting the results of the called tools
+        tool_result_messages: IDs of messages repeating the results of the called tools, not sent when chaining
+    """
+    model: str | None = None
+    response_id: str | None = None
+    sent: int = 0
+    prefix_hash: str = ""
+    call_ids: Dict[str, str] = field(default_factory=dict)
+    message: AgentMessage | None = None
+    tool_result_messages: Set[int] = field(default_factory=set)
+
+    def reset(self) -> None:
+        self.response_id = None
+
+    def add_tool_results(self, message: ChatMessage) -> ChatMessage:
+        """Mark the message as (only) repeating the results of the tools called in the previous response, which
+        are sent as function call outputs instead when the chain is continued. Returns the message."""
+        self.tool_result_messages.add(id(message))
+        return message
+
+    def chained_input(self, model: str, messages: List[ChatMessage | Dict[str, Any]]) -> List[Dict[str, Any]] | None:
+        """The input continuing the previous response, i.e. the outputs of all function calls in the previous
+        response and all new messages, or None if the full input has to be sent."""
+        if (self.response_id is None or model != self.model or len(messages) < self.sent
+                or _hash(messages[:self.sent]) != self.prefix_hash):
+            return None
+        results = {tool.id: tool.result for tool in self.message.tools}
+        if any(tool_id not in results for tool_id in self.call_ids):
+            return None
+        return [
+            *({"type": "function_call_output", "call_id": call_id,
+               "output": json.dumps(results[tool_id], default=str) if results[tool_id] is not None else "(not executed)"}
+              for tool_id, call_id in self.call_ids.items()),
+            *(m if isinstance(m, dict) else m.model_dump() for m in messages[self.sent:]
+              if id(m) not in self.tool_result_messages),
+        ]
+
+    def update(self, model: str, response_id: str | None, messages: List[ChatMessage | Dict[str, Any]],
+               call_ids: Dict[str, str], message: AgentMessage) -> None:
+        """Continue the chain with the given response to the given messages."""
+        self.model = model
+        self.response_id = response_id
+        self.sent = len(messages)
+        self.prefix_hash = _hash(messages)
+        self.call_ids = call_ids
+        self.message = message
+
+
+def _hash(messages: List[ChatMessage | Dict[str, Any]]) -> str:
+    canonical = json.dumps([m if isinstance(m, dict) else m.model_dump() for m in messages], sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
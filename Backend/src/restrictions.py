@@ -0,0 +1,104 @@
+"""
+Restrictions on which OPACA actions may be called by the LLM, configured via the /admin/restrict routes.
+All lists contain string-fragments; rules apply to actions where action or agent name contains (ignoring
+case) any of those strings. The lists are compiled to a single regular expression each, and the resulting
+decision is cached for each agent and action, as it has to be checked for every single tool invocation.
+The same kind of rules are used for numeric settings of individual actions, like timeouts, see ActionSettings.
+"""
+import re
+from typing import Dict, List, Tuple
+
+
+# list of string fragments that must NOT appear in the action names, else they will be forbidden
+actions_blacklist: List[str] = []
+
+# list of string-fragments; if any action or agent name contains one of those, SAGE will ask for confirmation before calling the tool
+actions_needing_confirmation: List[str] = []
+
+# list of string-fragments; concurrent calls of matching (read-only) actions with identical parameters share one invocation
+actions_deduplicated: List[str] = []
+
+# maximum number of cached decisions, to not grow without bounds with e.g. hallucinated tool names
+MAX_CACHED_DECISIONS = 10_000
+
+_forbidden_pattern: re.Pattern | None = None
+_confirmation_pattern: re.Pattern | None = None
+_deduplicated_pattern: re.Pattern | None = None
+
+# cached decisions by (agent, action): (forbidden, needs confirmation, deduplicated)
+_decisions: Dict[Tuple[str | None, str], Tuple[bool, bool, bool]] = {}
+
+
+def set_restrictions(forbidden: List[str], need_confirmation: List[str], deduplicate: List[str] = ()) -> None:
+    """Update the lists of restricted actions and rebuild the compiled matchers."""
+    global _forbidden_pattern, _confirmation_pattern, _deduplicated_pattern
+    actions_blacklist[:] = forbidden
+    actions_needing_confirmation[:] = need_confirmation
+    actions_deduplicated[:] = deduplicate
+    _forbidden_pattern = _compile(actions_blacklist)
+    _confirmation_pattern = _compile(actions_needing_confirmation)
+    _deduplicated_pattern = _compile(actions_deduplicated)
+    _decisions.clear()
+
+
+def is_forbidden(agent: str | None, action: str) -> bool:
+    """Whether the action is forbidden, i.e. agent or action name contain any of the forbidden fragments."""
+    return _get_decision(agent, action)[0]
+
+
+def needs_confirmation(agent: str | None, action: str) -> bool:
+    """Whether the user has to confirm the action, i.e. the full tool name contains any of the respective fragments."""
+    return _get_decision(agent, action)[1]
+
+
+def is_deduplicated(agent: str | None, action: str) -> bool:
+    """Whether concurrent calls of the action with identical parameters may share a single invocation."""
+    return _get_decision(agent, action)[2]
+
+
+def _get_decision(agent: str | None, action: str) -> Tuple[bool, bool, bool]:
+    key = (agent, action)
+    if key not in _decisions:
+        if len(_decisions) >= MAX_CACHED_DECISIONS:
+            _decisions.clear()
+        tool_name = f"{agent}--{action}" if agent else action
+        _decisions[key] = (
+            _forbidden_pattern is not None and any(_forbidden_pattern.search(name) for name in (agent or "", action)),
+            _confirmation_pattern is not None and _confirmation_pattern.search(tool_name) is not None,
+            _deduplicated_pattern is not None and _deduplicated_pattern.search(tool_name) is not None,
+        )
+    return _decisions[key]
+
+
+class ActionSettings:
+    """
+    Numeric settings (e.g. timeouts) for actions where agent or action name contains (ignoring case) the given
+    string-fragment. If multiple rules apply, the smallest value is used. Resolved values are cached, too.
+    """
+
+    def __init__(self):
+        self.values: Dict[str, float] = {}
+        self._patterns: List[Tuple[re.Pattern, float]] = []
+        self._resolved: Dict[Tuple[str | None, str], float | None] = {}
+
+    def update(self, values: Dict[str, float]) -> None:
+        """Replace all rules; rules with values <= 0 are dropped."""
+        self.values = {fragment: value for fragment, value in values.items() if value > 0}
+        self._patterns = [(_compile([fragment]), value) for fragment, value in self.values.items()]
+        self._resolved.clear()
+
+    def get(self, agent: str | None, action: str) -> float | None:
+        """Get the smallest value of all rules matching the action, or None if none match."""
+        key = (agent, action)
+        if key not in self._resolved:
+            if len(self._resolved) >= MAX_CACHED_DECISIONS:
+                self._resolved.clear()
+            values = [value for pattern, value in self._patterns if pattern.search(agent or "") or pattern.search(action)]
+            self._resolved[key] = min(values, default=None)
+        return self._resolved[key]
+
+
+def _compile(fragments: List[str]) -> re.Pattern | None:
+    if not fragments:
+        return None
+    return re.compile("|".join(map(re.escape, fragments)), re.IGNORECASE)
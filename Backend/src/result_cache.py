@@ -0,0 +1,91 @@
+"""
+Opt-in cache for the results of idempotent OPACA actions, e.g. pure lookups that are called with the same
+parameters again and again by scheduled tasks or repeated chats. Actions are cached only if a TTL is
+configured for them via the /admin/result-cache routes. Results are cached per platform and platform user,
+and the least recently used results are evicted once the (estimated) size of all results exceeds a limit.
+"""
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Tuple
+
+from .restrictions import ActionSettings
+
+
+# upper bound for the (estimated) total size of all cached results, in bytes
+RESULT_CACHE_MAX_BYTES = int(os.getenv("OPACA_RESULT_CACHE_MAX_BYTES", 16 * 1024 * 1024))
+
+# TTL in seconds for actions where the agent or action name contains (ignoring case) the given string-fragment
+result_ttls = ActionSettings()
+
+result_cache_stats: Dict[str, int] = {"hits": 0, "misses": 0, "evictions": 0}
+
+# cached results by (platform, user, agent, action, params): (result, expiry time, estimated size)
+_results: OrderedDict[Tuple, Tuple[Any, float, int]] = OrderedDict()
+_results_size = 0
+
+
+def canonical_params(params: dict) -> str:
+    """Canonical string representation of action parameters, independent of the order of the keys."""
+    return json.dumps(params, sort_keys=True, separators=(",", ":"), default=str)
+
+
+def set_result_ttls(ttls: Dict[str, float]) -> None:
+    """Update the TTLs of cached actions, dropping all results cached so far."""
+    result_ttls.update(ttls)
+    clear_results()
+
+
+def get_result_ttl(agent: str | None, action: str) -> float:
+    """Get the TTL for results of the given action; the smallest of all matching rules, or 0 if not cached."""
+    return result_ttls.get(agent, action) or 0
+
+
+def get_result(key: Tuple) -> Tuple[bool, Any]:
+    """Get whether a valid result is cached for the given key, and that result."""
+    global _results_size
+    if key in _results:
+        result, expires, size = _results[key]
+        if time.time() < expires:
+            _results.move_to_end(key)
+            result_cache_stats["hits"] += 1
+            return True, result
+        del _results[key]
+        _results_size -= size
+    result_cache_stats["misses"] += 1
+    return False, None
+
+
+def put_result(key: Tuple, result: Any, ttl: float) -> None:
+    """Cache the result for the given time, evicting the least recently used results if necessary."""
+    global _results_size
+    size = len(canonical_params(result).encode()) if not isinstance(result, str) else len(result.encode())
+    if size > RESULT_CACHE_MAX_BYTES:
+        return
+    if key in _results:
+        _results_size -= _results.pop(key)[2]
+    _results[key] = (result, time.time() + ttl, size)
+    _results_size += size
+    while _results_size > RESULT_CACHE_MAX_BYTES:
+        _, (_, _, evicted_size) = _results.popitem(last=False)
+        _results_size -= evicted_size
+        result_cache_stats["evictions"] += 1
+
+
+def clear_results() -> None:
+    """Drop all cached results."""
+    global _results_size
+    _results.clear()
+    _results_size = 0
+
+
+def get_result_cache_info() -> Dict[str, Any]:
+    """Simplified view on the result cache for the result-cache-admin route."""
+    return {
+        **result_cache_stats,
+        "ttls": result_ttls.values,
+        "entries": len(_results),
+        "size": _results_size,
+        "max_size": RESULT_CACHE_MAX_BYTES,
+    }
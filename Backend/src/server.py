@@ -14,7 +14,7 @@ import logging
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, Request, Response, HTTPException, UploadFile, Depends, Header, Query
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.websockets import WebSocket
 from starlette.datastructures import Headers
@@ -23,7 +23,7 @@ from openai import OpenAI
 from . import sample_prompts as prompts
 from .models import ConnectRequest, MCPToolApproval, QueryRequest, QueryResponse, ConfigPayload, Chat, RestrictedActions, \
     SearchResult, get_supported_models, SessionData, OpacaException, MCPCreateMessage, PushMessage, \
-    InvokeRequest, InvokeResponse, SessionPrompts, ReloadChatsMessage
+    InvokeRequest, InvokeResponse, SessionPrompts, ReloadChatsMessage, ResultCacheConfig, ActionTimeouts
 from .simple import SimpleMethod
 from .simple_tools import SimpleToolsMethod
 from .toolllm import ToolLLMMethod
@@ -33,8 +33,15 @@ from .code_execution import CodeExecutor
 from .file_utils import delete_file_from_all_clients, save_file_to_disk, create_path, delete_file_from_disk, rename_file
 from .session_manager import create_or_refresh_session, cleanup_task, on_shutdown, load_all_sessions, \
     restore_scheduled_tasks, get_all_sessions, update_session, SessionAction
-from .opaca_client import actions_blacklist
-from .abstract_method import actions_needing_confirmation
+from .restrictions import actions_blacklist, actions_needing_confirmation, actions_deduplicated, set_restrictions
+from .tool_catalog import get_catalog_store_info
+from .result_cache import get_result_cache_info, set_result_ttls, clear_results
+from .llm_cache import get_llm_cache_info, clear_responses
+from .websocket_stream import select_subprotocol, receive_message
+from .http_stream import streaming_response
+from .container_health import get_container_health_info
+from .opaca_client import action_timeouts
+from .model_capabilities import invalidate_model_capabilities
 
 # Configure CORS settings
 origins = os.getenv('CORS_WHITELIST', 'http://localhost:5173').split(";")
@@ -63,6 +70,8 @@ info_queries = {
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # before start
+    # capabilities looked up on import (e.g. for the default configs) may predate the final environment
+    invalidate_model_capabilities()
     asyncio.create_task(cleanup_task(60))
     CodeExecutor.warmup_task = asyncio.create_task(CodeExecutor().warmup())
     await load_all_sessions()
@@ -153,13 +162,58 @@ async def session_admin_update(session_id: str, action: SessionAction, auth = De
 
 @app.get("/admin/restrict", description="Get list of 'restricted' terms in action and agent names.", tags=["admin"])
 async def get_blacklist() -> RestrictedActions:
-    return RestrictedActions(forbidden=actions_blacklist, need_confirmation=actions_needing_confirmation)
+    return RestrictedActions(forbidden=actions_blacklist, need_confirmation=actions_needing_confirmation, deduplicate=actions_deduplicated)
 
 
 @app.put("/admin/restrict", description="Update list of 'restricted' terms in action and agent names, blocking those actions from being executed.", tags=["admin"])
 async def set_blacklist(restrictions: RestrictedActions, auth = Depends(require_password)):
-    actions_blacklist[:] = restrictions.forbidden
-    actions_needing_confirmation[:] = restrictions.need_confirmation
+    deduplicate = restrictions.deduplicate if restrictions.deduplicate is not None else list(actions_deduplicated)
+    set_restrictions(restrictions.forbidden, restrictions.need_confirmation, deduplicate)
+
+
+@app.get("/admin/timeouts", description="Get timeouts of individual actions, by terms in action and agent names.", tags=["admin"])
+async def get_action_timeouts() -> ActionTimeouts:
+    return ActionTimeouts(timeouts=action_timeouts.values)
+
+
+@app.put("/admin/timeouts", description="Update timeouts of individual actions, by terms in action and agent names, overriding the global default timeout.", tags=["admin"])
+async def set_action_timeouts(timeouts: ActionTimeouts, auth = Depends(require_password)):
+    action_timeouts.update(timeouts.timeouts)
+
+
+@app.get("/admin/catalog", description="Get short info on the platform catalogs shared by all sessions, and number of tool catalog lookups served from an already compiled catalog (hits) or requiring a new conversion (misses). Requires authentication, if configured.", tags=["admin"])
+async def get_catalog_stats(auth = Depends(require_password)) -> dict[str, Any]:
+    return get_catalog_store_info()
+
+
+@app.get("/admin/health", description="Get health of the containers of the connected OPACA platforms, as observed in action invocations: error rate, latency and state of the circuit breaker. Requires authentication, if configured.", tags=["admin"])
+async def get_container_health(auth = Depends(require_password)) -> list[dict[str, Any]]:
+    return get_container_health_info()
+
+
+@app.get("/admin/result-cache", description="Get the TTLs of cached actions, and number, size, hits and misses of cached action results. Requires authentication, if configured.", tags=["admin"])
+async def get_result_cache(auth = Depends(require_password)) -> dict[str, Any]:
+    return get_result_cache_info()
+
+
+@app.put("/admin/result-cache", description="Update the TTLs of actions whose results should be cached, by terms in action and agent names. Drops all cached results. Requires authentication, if configured.", tags=["admin"])
+async def set_result_cache(config: ResultCacheConfig, auth = Depends(require_password)):
+    set_result_ttls(config.ttls)
+
+
+@app.delete("/admin/result-cache", description="Drop all cached action results. Requires authentication, if configured.", tags=["admin"])
+async def delete_result_cache(auth = Depends(require_password)):
+    clear_results()
+
+
+@app.get("/admin/llm-cache", description="Get number, size, hits and misses of cached LLM responses. Requires authentication, if configured.", tags=["admin"])
+async def get_llm_cache(auth = Depends(require_password)) -> dict[str, Any]:
+    return get_llm_cache_info()
+
+
+@app.delete("/admin/llm-cache", description="Drop all cached LLM responses, in memory and on disk. Requires authentication, if configured.", tags=["admin"])
+async def delete_llm_cache(auth = Depends(require_password)):
+    clear_responses()
 
 
 @app.post("/connect", description="Connect to OPACA Runtime Platform. Returns the status code of the original request (to differentiate from errors resulting from this call itself).", tags=["opaca"])
@@ -199,9 +253,9 @@ async def get_extra_ports(session: SessionData = Depends(handle_session_http)) -
     return await session.opaca_client.get_extra_ports()
 
 
-@app.get("/containers", description="Get available containers on connected OPACA Runtime Platform, including agents and their actions, using the same format as the OPACA platform itself.", tags=["opaca"])
-async def get_containers(session: SessionData = Depends(handle_session_http)) -> list:
-    return await session.opaca_client.get_containers()
+@app.get("/containers", description="Get available containers on connected OPACA Runtime Platform, including agents and their actions, using the same format as the OPACA platform itself. Use `refresh` to bypass the cached container list.", tags=["opaca"])
+async def get_containers(refresh: bool = False, session: SessionData = Depends(handle_session_http)) -> list:
+    return await session.opaca_client.get_containers(force_refresh=refresh)
 
 
 @app.get("/internal-tools", description="Get backend-provided internal tools as a pseudo OPACA container.", tags=["opaca"])
@@ -239,11 +293,21 @@ async def invoke_action(invoke: InvokeRequest, session: SessionData = Depends(ha
 
 @app.post("/query/{method}", description="Send message to the given LLM method. Returns the final LLM response along with all intermediate messages and different metrics. This method does not include, nor is the message and response added to, any chat history.", tags=["chat"])
 async def query_no_history(method: str, message: QueryRequest, session: SessionData = Depends(handle_session_http)) -> QueryResponse:
+    return await run_query_no_history(method, message, session)
+
+
+@app.post("/query/{method}/stream", description="Same as `/query/{method}`, but streams the intermediate messages (text chunks, tool calls and results, metrics) on the HTTP response, followed by the final `QueryResponse`; as Server-Sent Events if the `Accept` header includes `text/event-stream`, otherwise as NDJSON.", tags=["chat"])
+async def query_no_history_stream(request: Request, response: Response, method: str, message: QueryRequest, session: SessionData = Depends(handle_session_http)) -> StreamingResponse:
+    return streaming_response(request, response, lambda events: run_query_no_history(method, message, session, events))
+
+
+async def run_query_no_history(method: str, message: QueryRequest, session: SessionData, events: asyncio.Queue | None = None) -> QueryResponse:
     session.is_notifs_aborted = False
     try:
         internal_tools = InternalTools(session, METHODS[method])
         response = QueryResponse(query=message.user_query)
         method_impl = METHODS[method](session, Chat(chat_id=''), response, message.streaming, internal_tools)
+        method_impl.event_queue = events
         return await method_impl.query()
     except Exception as e:
         response = QueryResponse(query=message.user_query)
@@ -297,6 +361,15 @@ async def get_chat_history(chat_id: str, session: SessionData = Depends(handle_s
 
 @app.post("/chats/{chat_id}/query/{method}", description="Send message to the given LLM method; the history is stored in the backend and will be sent to the actual LLM along with the new message. Returns the final LLM response along with all intermediate messages and different metrics.", tags=["chat"])
 async def query_chat(method: str, chat_id: str, message: QueryRequest, session: SessionData = Depends(handle_session_http)) -> QueryResponse:
+    return await run_query_chat(method, chat_id, message, session)
+
+
+@app.post("/chats/{chat_id}/query/{method}/stream", description="Same as `/chats/{chat_id}/query/{method}`, but streams the intermediate messages on the HTTP response, followed by the final `QueryResponse`; as Server-Sent Events if the `Accept` header includes `text/event-stream`, otherwise as NDJSON. If the client disconnects, the query is still completed and added to the chat history.", tags=["chat"])
+async def query_chat_stream(request: Request, response: Response, method: str, chat_id: str, message: QueryRequest, session: SessionData = Depends(handle_session_http)) -> StreamingResponse:
+    return streaming_response(request, response, lambda events: run_query_chat(method, chat_id, message, session, events), cancel_on_disconnect=False)
+
+
+async def run_query_chat(method: str, chat_id: str, message: QueryRequest, session: SessionData, events: asyncio.Queue | None = None) -> QueryResponse:
     chat = session.get_or_create_chat(chat_id, True)
     response = QueryResponse(query=message.user_query)
     chat.store_interaction(response)
@@ -305,6 +378,7 @@ async def query_chat(method: str, chat_id: str, message: QueryRequest, session:
     try:
         internal_tools = InternalTools(session, METHODS[method])
         method_impl = METHODS[method](session, chat, response, message.streaming, internal_tools)
+        method_impl.event_queue = events
         await session.websocket_send(ReloadChatsMessage())
         await method_impl.query()
     except Exception as e:
@@ -376,11 +450,13 @@ async def append(chat_id: str, auto_append: bool, push_message: PushMessage, ses
 async def stop_query(chat_id: str, session: SessionData = Depends(handle_session_http)) -> None:
     chat = session.get_or_create_chat(chat_id, create_if_missing=False)
     chat.is_aborted = True
+    session.cancel_tasks(chat_id)
 
 
 @app.post("/stop", description="Abort generation for all anonymous query of the session (e.g. notifications).", tags=["chat"])
 async def stop_query(session: SessionData = Depends(handle_session_http)) -> None:
     session.is_notifs_aborted = True
+    session.cancel_tasks('')
 
 
 ## CONFIG ROUTES
@@ -546,24 +622,24 @@ async def whisper_generate(text: str = Query(""), voice: str = Query("alloy")) -
 # WEBSOCKET CONNECTION (permanently opened)
 
 @app.websocket("/ws")
-async def open_websocket(websocket: WebSocket, session: SessionData = Depends(handle_session_ws)):
-    await websocket.accept()
-    session._websocket = websocket
-    session._ws_msg_queue = asyncio.Queue()
-    await session.websocket_send_pending()
+async def open_websocket(websocket: WebSocket, last_seq: int | None = None, session: SessionData = Depends(handle_session_ws)):
+    subprotocol = select_subprotocol(websocket.scope.get("subprotocols", []))
+    await websocket.accept(subprotocol=subprotocol)
+    await session.attach_websocket(websocket, last_seq, subprotocol)
     try:
         while True:
             logger.debug("websocket waiting...")
             # messages coming from the websocket are received here and put into an async queue
             # so any exceptions (like websocket closing) can be handled here without losing messages
-            response = await websocket.receive_json()
+            response = await receive_message(websocket)
             await session._ws_msg_queue.put(response)
     except Exception as e:
         pass  # this is normal when e.g. the browser is closed
     finally:
-        # when the browser session is closed, immediately logout of all previously logged in containers
-        await session.opaca_client.logout_all_containers()
-        session._websocket = None
+        # when the browser session is closed, immediately logout of all previously logged in containers,
+        # unless the session is already connected via a newer websocket (e.g. after a reconnect)
+        if await session.detach_websocket(websocket):
+            await session.opaca_client.logout_all_containers()
 
 
 ## HELPER FUNCTIONS
@@ -608,4 +684,4 @@ def unpack_error(error: dict) -> str:
 # run as `python3 -m Backend.server`
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=3001)
+    uvicorn.run(app, host="0.0.0.0", port=3001, ws_per_message_deflate=os.getenv("WS_PER_MESSAGE_DEFLATE", "true").lower() == "true")
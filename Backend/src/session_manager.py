@@ -9,9 +9,11 @@ from enum import Enum
 from pydantic import ValidationError
 from pymongo.asynchronous.mongo_client import AsyncMongoClient
 
-from .file_utils import delete_all_files_from_disk
+from .file_utils import delete_all_files_from_disk, register_uploaded_files, release_uploaded_files
 from .internal_tools import InternalTools
-from .models import SessionData
+from .models import SessionData, ContainersChangedMessage
+from .opaca_client import close_http_clients, stop_catalog_watchers
+from .tool_catalog import evict_unused_catalogs, catalog_listeners, token_subject, PlatformCatalog
 
 
 class SessionAction(Enum):
@@ -27,6 +29,9 @@ logger: Logger = logging.getLogger(__name__)
 DB_NAME: str = 'backend-data'
 SESSIONS_COLLECTION: str = 'sessions'
 
+# shared platform catalogs not used by any session for this long are removed
+CATALOG_MAX_IDLE_SECONDS: int = 60 * 60
+
 # Simple dict to store session data in memory
 # Is saved periodically to DB, and also on server shutdown
 sessions_lock: asyncio.Lock = asyncio.Lock()
@@ -116,6 +121,7 @@ async def load_all_sessions() -> None:
         session = await db_client.load_session(session_id)
         if session and session.is_valid():
             sessions[session_id] = session
+            register_uploaded_files(session)
         else:
             await delete_session(session_id)
 
@@ -168,7 +174,7 @@ async def cleanup_old_sessions() -> None:
 
 async def delete_session(session_id: str) -> None:
     if session_id in sessions:
-        del sessions[session_id]
+        await release_uploaded_files(sessions.pop(session_id))
     delete_all_files_from_disk(session_id)
     await db_client.delete_session(session_id)
 
@@ -176,7 +182,8 @@ async def delete_session(session_id: str) -> None:
 async def delete_all_sessions() -> None:
     logger.warning("Deleting all sessions...")
     async with sessions_lock:
-        for session_id in sessions:
+        for session_id, session in sessions.items():
+            await release_uploaded_files(session)
             await db_client.delete_session(session_id)
         sessions.clear()
 
@@ -195,6 +202,7 @@ async def get_all_sessions() -> dict:
             "container-logins": list(session._opaca_client.logged_in_containers.keys()),
             "user_api_keys": list(session._user_api_keys),
             "blocked": session.blocked,
+            "websocket": session.websocket_info(),
         }
         for _id, session in sessions.items()
     }
@@ -223,17 +231,33 @@ async def update_session(session_id: str, action: SessionAction):
             session.blocked = False
 
 
+async def push_catalog_changes(catalog: PlatformCatalog, diff: dict) -> None:
+    """Notify all sessions connected to the platform (as the same user) that the containers changed."""
+    message = ContainersChangedMessage(**diff)
+    for session in list(sessions.values()):
+        client = session.opaca_client
+        if session.has_websocket() and client.url == catalog.url and token_subject(client.token) == catalog.subject:
+            try:
+                await session.websocket_send(message)
+            except Exception as e:
+                logger.warning(f"Could not notify session {session.session_id} of changed containers: {e}")
+
+
+catalog_listeners.append(push_catalog_changes)
+
+
 # LIFECYCLE
 
 async def cleanup_task(delay_seconds: int = 60 * 60 * 24) -> None:
     """
-    Cleanup old session and files, and save the current sessions to DB
+    Cleanup old session and files and unused platform catalogs, and save the current sessions to DB
     in a configurable interval.
 
     :param delay_seconds: Number of seconds after which this task repeats. Defaults to 86400s (1 day).
     """
     while True:
         await cleanup_old_sessions()
+        evict_unused_catalogs(CATALOG_MAX_IDLE_SECONDS)
         await store_sessions_in_db()
         await asyncio.sleep(delay_seconds)
 
@@ -257,6 +281,8 @@ async def restore_scheduled_tasks(methods: dict[str, type['AbstractMethod']]) ->
 
 
 async def on_shutdown():
+    await stop_catalog_watchers()
+    await close_http_clients()
     if db_client.is_db_configured():
         await store_sessions_in_db()
         await db_client.client.close()
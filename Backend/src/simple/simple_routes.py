@@ -5,7 +5,7 @@ import json
 
 from ..abstract_method import AbstractMethod
 from ..models import QueryResponse, AgentMessage, ChatMessage, ToolCall, MethodConfig, ToolCallMessage, \
-    LLMConfig, ResetTextMessage
+    LLMConfig, ResetTextMessage, HistoryConfig
 
 SYSTEM_PROMPT = """
 You are an assistant, called 'SAGE'.
@@ -62,6 +62,7 @@ logger = logging.getLogger(__name__)
 class SimpleConfig(MethodConfig):
     model: LLMConfig = MethodConfig.llm_role(title='Simple Agent', description='The model to use')
     max_rounds: int = MethodConfig.max_rounds_field()
+    history: HistoryConfig = MethodConfig.history_field()
     ask_policy: str = MethodConfig.string(default='never', options=ask_policies.keys(), allow_free_input=False, title='Ask Policy', description='Determine how much confirmation the LLM will require')
 
 
@@ -82,6 +83,7 @@ class SimpleMethod(AbstractMethod):
             policy=ask_policies[config.ask_policy],
             actions=actions,
         ) if actions else FALLBACK_PROMPT
+        history = await self.get_history(config.model)
 
         while self.response.iterations < max_iters:
             await self.send_to_websocket(ResetTextMessage(chat_id=self.chat.chat_id))
@@ -92,7 +94,7 @@ class SimpleMethod(AbstractMethod):
                 agent="assistant",
                 system_prompt=self.build_full_prompt(prompt),
                 messages=[
-                    *self.chat.messages,
+                    *history,
                     ChatMessage(role="user", content=self.response.query),
                     *(ChatMessage(role=am.agent, content=am.content) for am in self.response.agent_messages),
                 ],
@@ -2,7 +2,9 @@ import logging
 import time
 
 from ..abstract_method import AbstractMethod
-from ..models import QueryResponse, AgentMessage, ChatMessage, MethodConfig, LLMConfig, ResetTextMessage
+from ..response_chain import ResponseChain
+from ..models import QueryResponse, AgentMessage, ChatMessage, MethodConfig, LLMConfig, ResetTextMessage, HistoryConfig, \
+    ToolSelectionConfig
 
 SYSTEM_PROMPT = """You are a helpful ai assistant who answers user queries with the help of 
 tools. You can find those tools in the tool section. Do not generate optional 
@@ -24,6 +26,8 @@ logger = logging.getLogger(__name__)
 class SimpleToolConfig(MethodConfig):
     model: LLMConfig = MethodConfig.llm_role(title='Simple Tools Agent', description='The model to use')
     max_rounds: int = MethodConfig.max_rounds_field()
+    history: HistoryConfig = MethodConfig.history_field()
+    tool_selection: ToolSelectionConfig = MethodConfig.tool_selection_field()
 
 
 class SimpleToolsMethod(AbstractMethod):
@@ -38,16 +42,21 @@ class SimpleToolsMethod(AbstractMethod):
         max_iters = config.max_rounds
 
         # Get tools and transform them into the OpenAI Function Schema
-        tools, error = await self.get_tools()
+        all_tools, error = await self.get_tools()
+        tool_contents = ""
 
         # initialize message history
-        messages = list(self.chat.messages)
+        messages = await self.get_history(config.model)
         messages.append(ChatMessage(role="user", content=self.response.query))
+        chain = ResponseChain()
 
         while self.response.iterations < max_iters:
             await self.send_to_websocket(ResetTextMessage(chat_id=self.chat.chat_id))
             self.response.iterations += 1
 
+            # select the tools most relevant to the query and the results of the previous round, if too many
+            tools = await self.select_tools(all_tools, tool_contents)
+
             # call the LLM with function-calling enabled
             result = await self.call_llm(
                 model_config=config.model,
@@ -56,6 +65,7 @@ class SimpleToolsMethod(AbstractMethod):
                 messages=messages,
                 tools=tools,
                 is_output=True,
+                chain=chain,
             )
             self.response.agent_messages.append(result)
 
@@ -71,11 +81,11 @@ class SimpleToolsMethod(AbstractMethod):
                     f"The result of tool '{tool.name}' with parameters '{tool.args}' was: {tool.result}"
                     for tool in tool_entries
                 )
-                messages.append(ChatMessage(
+                messages.append(chain.add_tool_results(ChatMessage(
                     role="user",
                     content=f"A user had the following request: {self.response.query}\n"
                             f"You have used the following tools: \n{tool_contents}")
-                )
+                ))
                 self.response.agent_messages[-1].tools = tool_entries
 
             except Exception as e:
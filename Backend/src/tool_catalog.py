@@ -0,0 +1,288 @@
+"""
+Compiled catalog of the OPACA actions as OpenAI Functions. The OpenAPI specification of the
+platform's actions is dereferenced and converted only once per distinct specification (identified
+by its hash), and the resulting functions are indexed by name and by agent, so that the LLM methods
+only have to do a dictionary lookup when getting the tools for a query.
+
+The fetched containers and compiled catalogs are kept in a process-wide store, shared by all sessions
+connected to the same platform with the same user, so that the memory and the load on the platform
+scale with the number of distinct platforms, not with the number of sessions. Whenever the containers
+change, the derived data is invalidated, too, and the registered listeners are notified of the changes.
+"""
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+import jsonref
+
+
+logger = logging.getLogger(__name__)
+
+
+# number of tool catalog lookups served from an already compiled catalog (hits) or requiring
+# the OpenAPI specification to be converted again (misses)
+catalog_stats: Dict[str, int] = {"hits": 0, "misses": 0}
+
+
+@dataclass
+class ToolCatalog:
+    """
+    OPACA actions converted to OpenAI Functions, for one specific version of the OpenAPI specification.
+
+    Attributes:
+        spec_hash: hash of the raw OpenAPI specification this catalog was compiled from
+        functions: all actions as OpenAI Functions, in the order of the specification
+        errors: errors encountered while converting the actions
+        by_name: functions indexed by their full name, i.e. "agent--action"
+        by_agent: functions grouped by the name of the agent providing them
+    """
+    spec_hash: str = ""
+    functions: List[Dict[str, Any]] = field(default_factory=list)
+    errors: str = ""
+    by_name: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    by_agent: Dict[str, List[Dict[str, Any]]] = field(default_factory=dict)
+
+    @classmethod
+    def compile(cls, openapi_spec: dict, spec_hash: str) -> "ToolCatalog":
+        """Dereference the OpenAPI specification once and convert it to an indexed list of functions."""
+        catalog_stats["misses"] += 1
+        try:
+            # inline all references as plain dicts, so they do not have to be resolved again
+            openapi_spec = jsonref.replace_refs(openapi_spec, proxies=False, lazy_load=False)
+        except Exception as e:
+            # e.g. recursive data types; fall back to lazily resolved references
+            logger.warning(f"Could not inline references in OpenAPI spec: {e}")
+
+        functions, errors = openapi_to_functions(openapi_spec)
+        catalog = cls(spec_hash=spec_hash, functions=functions, errors=errors)
+        for function in functions:
+            catalog.by_name[function["name"]] = function
+            catalog.by_agent.setdefault(function["name"].split("--", 1)[0], []).append(function)
+        logger.info(f"Compiled tool catalog with {len(functions)} functions")
+        return catalog
+
+    def get_functions(self, agent: str | None = None) -> List[Dict[str, Any]]:
+        """Get (a new list of) all functions, or only those of the given agent."""
+        return list(self.functions if agent is None else self.by_agent.get(agent, []))
+
+
+class PlatformCatalog:
+    """
+    Containers and compiled tool catalog of one OPACA platform, as visible to one platform user.
+    The lock makes sure that concurrent sessions trigger only a single fetch of the same data.
+    """
+
+    def __init__(self, url: str, subject: str | None):
+        self.url = url
+        self.subject = subject
+        self.version = 0  # incremented each time the cached containers change
+        self.containers: list | None = None
+        self.container_index: Dict[Tuple[str | None, str], Tuple[str, str]] = {}
+        self.containers_etag: str | None = None
+        self.containers_fetched = 0.0
+        self.tool_catalog: ToolCatalog | None = None
+        self.tool_catalog_fetched = 0.0
+        self.derived: Dict[str, Any] = {}  # other data derived from the containers, e.g. agent summaries
+        self.watch_token: str | None = None  # access token used by the background watcher, if any
+        self.last_access = time.time()
+        self.lock = asyncio.Lock()
+
+    def invalidate(self) -> None:
+        """Mark the cached containers and tool catalog as outdated, so both are fetched again. The containers
+        are kept until then, to tell which of them changed."""
+        self.containers_etag = None
+        self.containers_fetched = 0.0
+        self.tool_catalog_fetched = 0.0
+        self.version += 1
+
+    def set_containers(self, containers: list, etag: str | None) -> Dict[str, List[str]] | None:
+        """Update the cached containers if they changed, invalidating all data derived from them.
+        Returns the IDs of added, removed and changed containers, unless there were no containers before."""
+        diff = None
+        if containers != self.containers:
+            if self.containers is not None:
+                diff = container_diff(self.containers, containers)
+            self.containers = containers
+            self.container_index = build_container_index(containers)
+            self.tool_catalog_fetched = 0.0
+            self.derived.clear()
+            self.version += 1
+        self.containers_etag = etag
+        self.containers_fetched = time.time()
+        return diff
+
+    def set_tool_catalog(self, spec: dict, spec_hash: str) -> ToolCatalog:
+        """Use the compiled catalog for the given spec, converting the spec only if no other platform
+        (or other user of the same platform) has provided the very same spec before."""
+        if spec_hash not in _compiled_catalogs:
+            _compiled_catalogs[spec_hash] = ToolCatalog.compile(spec, spec_hash)
+        else:
+            catalog_stats["hits"] += 1
+        self.tool_catalog = _compiled_catalogs[spec_hash]
+        return self.tool_catalog
+
+
+# shared catalogs by (platform URL, subject of the access token), and compiled catalogs by spec hash
+_platform_catalogs: Dict[Tuple[str, str | None], PlatformCatalog] = {}
+_compiled_catalogs: Dict[str, ToolCatalog] = {}
+
+# functions to be called with the catalog and the changes whenever the containers of a catalog changed
+catalog_listeners: List[Callable[[PlatformCatalog, Dict[str, List[str]]], Awaitable[None]]] = []
+_listener_tasks: set[asyncio.Task] = set()
+
+
+def get_platform_catalog(url: str, token: str | None) -> PlatformCatalog:
+    """Get the shared catalog for the given platform and access token, creating it if necessary."""
+    key = (url, token_subject(token))
+    if key not in _platform_catalogs:
+        _platform_catalogs[key] = PlatformCatalog(*key)
+    catalog = _platform_catalogs[key]
+    catalog.last_access = time.time()
+    return catalog
+
+
+def is_catalog_stored(catalog: PlatformCatalog) -> bool:
+    """Whether the catalog is still in the store, i.e. was not evicted."""
+    return _platform_catalogs.get((catalog.url, catalog.subject)) is catalog
+
+
+def notify_catalog_changed(catalog: PlatformCatalog, diff: Dict[str, List[str]]) -> None:
+    """Call all catalog listeners in the background, not blocking the caller (e.g. a query)."""
+    async def call(listener):
+        try:
+            await listener(catalog, diff)
+        except Exception as e:
+            logger.warning(f"Catalog listener {listener.__name__} failed: {e}")
+
+    for listener in catalog_listeners:
+        task = asyncio.create_task(call(listener))
+        _listener_tasks.add(task)
+        task.add_done_callback(_listener_tasks.discard)
+
+
+def evict_unused_catalogs(max_idle_seconds: float) -> None:
+    """Remove platform catalogs that have not been used for some time, and compiled catalogs no longer in use."""
+    now = time.time()
+    for key, catalog in list(_platform_catalogs.items()):
+        if now - catalog.last_access > max_idle_seconds:
+            del _platform_catalogs[key]
+    in_use = {c.tool_catalog.spec_hash for c in _platform_catalogs.values() if c.tool_catalog}
+    for spec_hash in list(_compiled_catalogs):
+        if spec_hash not in in_use:
+            del _compiled_catalogs[spec_hash]
+
+
+def get_catalog_store_info() -> Dict[str, Any]:
+    """Simplified view on the catalog store for the catalog-admin route."""
+    return {
+        **catalog_stats,
+        "compiled_catalogs": len(_compiled_catalogs),
+        "platforms": [
+            {
+                "url": catalog.url,
+                "subject": catalog.subject,
+                "version": catalog.version,
+                "containers": len(catalog.containers or []),
+                "functions": len(catalog.tool_catalog.functions) if catalog.tool_catalog else 0,
+                "last_access": datetime.fromtimestamp(catalog.last_access).isoformat(),
+            }
+            for catalog in _platform_catalogs.values()
+        ],
+    }
+
+
+def container_diff(old: list, new: list) -> Dict[str, List[str]]:
+    """IDs of containers that were added, removed or changed (e.g. agents or actions) between both lists."""
+    old_by_id = {c["containerId"]: c for c in old}
+    new_by_id = {c["containerId"]: c for c in new}
+    return {
+        "added": [cid for cid in new_by_id if cid not in old_by_id],
+        "removed": [cid for cid in old_by_id if cid not in new_by_id],
+        "changed": [cid for cid, c in new_by_id.items() if cid in old_by_id and old_by_id[cid] != c],
+    }
+
+
+def build_container_index(containers: list) -> Dict[Tuple[str | None, str], Tuple[str, str]]:
+    """Index the ID and display name of the container providing each (agent, action), with agent None
+    mapping to the first container providing an action of that name, like when invoking without an agent."""
+    index = {}
+    for container in containers:
+        entry = (container["containerId"], container["image"].get("name") or container["image"]["imageName"])
+        for agent in container["agents"]:
+            for action in agent["actions"]:
+                index.setdefault((agent["agentId"], action["name"]), entry)
+                index.setdefault((None, action["name"]), entry)
+    return index
+
+
+def token_subject(token: str | None) -> str | None:
+    """Get the subject (i.e. the platform user) of a JWT access token, without validating the token,
+    or a hash of the token if it can not be decoded. Used to tell apart the auth scopes of a platform."""
+    if not token:
+        return None
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return str(json.loads(base64.urlsafe_b64decode(payload))["sub"])
+    except Exception:
+        return hashlib.sha256(token.encode()).hexdigest()
+
+
+def openapi_to_functions(openapi_spec, agent: str | None = None):
+    """
+    Convert OpenAPI REST specification (with inlined references) to OpenAI Function specification.
+
+    Parameters:
+    - openapi_spec: the OpenAPI specification
+    - agent: name of OPACA agent to filter for, or None for all
+    """
+    functions = []
+    error_msg = ""
+
+    for path, methods in openapi_spec.get("paths", {}).items():
+        for method, spec_with_ref in methods.items():
+            # Resolve JSON references.
+            try:
+                spec = jsonref.replace_refs(spec_with_ref)
+            except Exception as e:
+                error_msg += f'Error while replacing references for unknown action. Cause: {e}\n'
+                continue
+
+            # Extract a name for the functions
+            try:
+                # The operation id is formatted as 'containerId-agentName-actionName'
+                container_id, agent_name, function_name = spec.get("operationId").split(';')
+                # action relevant for selected agent?
+                if agent and agent_name != agent:
+                    continue
+            except Exception as e:
+                error_msg += f'Error while splitting the operation id {spec.get("operationId")}. Cause: {e}\n'
+                continue
+
+            # Extract a description and parameters.
+            desc = spec.get("description", "")[:1024] or spec.get("summary", "")[:1024]
+
+            # assemble function block
+            # structure of schema: type (str), required (list), properties (the actual parameters), additionalProperties (bool)
+            schema = (spec.get("requestBody", {})
+                        .get("content", {})
+                        .get("application/json", {})
+                        .get("schema"))
+            schema.setdefault("properties", {})  # must be present even if no params
+
+            functions.append(
+                {
+                    "type": "function",
+                    "name": agent_name + '--' + function_name,
+                    "description": desc,
+                    "parameters": schema,
+                }
+            )
+
+    return functions, error_msg
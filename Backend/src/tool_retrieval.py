@@ -0,0 +1,148 @@
+"""
+Relevance-ranked selection of the tools sent to the LLM, for platforms with more tools than the LLM APIs accept,
+or to save prompt tokens by sending only the most relevant ones (see ToolSelectionConfig). The tools are indexed
+by the words in their names, descriptions and parameter names, and ranked against the query (and the results of
+the previous rounds) with BM25. Optionally, the ranking is combined with the similarity of embeddings of the tools
+and the query, computed with any embedding model supported by LiteLLM. The index is built once per distinct list
+of tools and reused by all sessions and queries.
+"""
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+from collections import Counter, OrderedDict
+from typing import Any, Dict, Iterable, List
+
+import litellm
+
+
+logger = logging.getLogger(__name__)
+
+
+# embedding model used in addition to BM25 for ranking the tools, e.g. "openai/text-embedding-3-small"; disabled if empty
+TOOL_EMBEDDING_MODEL = os.getenv("TOOL_EMBEDDING_MODEL", "")
+
+# number of indexes (distinct lists of tools) and embeddings kept in memory
+MAX_INDEXES = 32
+MAX_EMBEDDINGS = 10000
+
+STOPWORDS = frozenset("a an and are as at be by for from get in is it of on or set the this to with".split())
+
+# BM25 parameters: term frequency saturation and document length normalization
+K1 = 1.2
+B = 0.75
+
+# constant of the reciprocal rank fusion of BM25 and embedding ranks
+RRF_K = 60
+
+_indexes: OrderedDict[str, "ToolIndex"] = OrderedDict()
+_embeddings: Dict[str, List[float]] = {}
+
+
+def tokenize(text: str) -> List[str]:
+    """Lower-case words in the text, splitting camelCase and snake_case names, without stopwords and plural s."""
+    words = re.findall(r"[a-z0-9]+", re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", text).lower())
+    return [w[:-1] if len(w) > 3 and w.endswith("s") and not w.endswith("ss") else w
+            for w in words if w not in STOPWORDS]
+
+
+def tool_text(tool: Dict[str, Any]) -> str:
+    """Text describing the tool: its name (agent and action), description, and names of its parameters."""
+    params = (tool.get("parameters") or {}).get("properties") or {}
+    param_texts = [f"{name} {p.get('description', '') if isinstance(p, dict) else ''}" for name, p in params.items()]
+    return "\n".join((tool.get("name", "").replace("--", " "), tool.get("description") or "", *param_texts))
+
+
+class ToolIndex:
+    """BM25 index of a list of tools."""
+
+    def __init__(self, tools: List[Dict[str, Any]]):
+        self.names = [tool.get("name", "") for tool in tools]
+        self.texts = [tool_text(tool) for tool in tools]
+        # the tool name is counted twice, as it is the most specific part
+        self.term_freqs = [Counter(tokenize(text) + tokenize(name.replace("--", " ")))
+                           for name, text in zip(self.names, self.texts)]
+        self.lengths = [sum(tf.values()) for tf in self.term_freqs]
+        self.avg_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0
+        doc_freqs = Counter(term for tf in self.term_freqs for term in tf)
+        n = len(tools)
+        self.idf = {term: math.log(1 + (n - df + 0.5) / (df + 0.5)) for term, df in doc_freqs.items()}
+
+    def scores(self, query: str) -> List[float]:
+        terms = [t for t in set(tokenize(query)) if t in self.idf]
+        scores = []
+        for tf, length in zip(self.term_freqs, self.lengths):
+            norm = K1 * (1 - B + B * length / (self.avg_length or 1))
+            scores.append(sum(self.idf[t] * tf[t] * (K1 + 1) / (tf[t] + norm) for t in terms if t in tf))
+        return scores
+
+
+def get_index(tools: List[Dict[str, Any]]) -> ToolIndex:
+    """Get the (memoized) index of the given tools, identified by a digest of their full specifications."""
+    key = hashlib.sha256(json.dumps(tools, sort_keys=True, default=str).encode()).hexdigest()
+    if key in _indexes:
+        _indexes.move_to_end(key)
+    else:
+        _indexes[key] = ToolIndex(tools)
+        while len(_indexes) > MAX_INDEXES:
+            _indexes.popitem(last=False)
+    return _indexes[key]
+
+
+async def rank_tools(tools: List[Dict[str, Any]], query: str, k: int, always: Iterable[str] = ()) -> List[Dict[str, Any]]:
+    """
+    Select the k tools most relevant to the query, always including those with the given names (e.g. tools
+    already used in the conversation). The selected tools are returned in their original order.
+    """
+    if len(tools) <= k:
+        return tools
+    index = get_index(tools)
+    scores = index.scores(query)
+    ranking = sorted(range(len(tools)), key=lambda i: -scores[i])
+    if TOOL_EMBEDDING_MODEL:
+        try:
+            ranking = fuse_rankings(ranking, await rank_by_embeddings(index, query))
+        except Exception as e:
+            logger.warning(f"Could not rank tools with embedding model {TOOL_EMBEDDING_MODEL}, using BM25 only: {e}")
+
+    always = set(always)
+    selected = [i for i, name in enumerate(index.names) if name in always][:k]
+    selected_set = set(selected)
+    for i in ranking:
+        if len(selected) >= k:
+            break
+        if i not in selected_set:
+            selected.append(i)
+            selected_set.add(i)
+    return [tools[i] for i in sorted(selected)]
+
+
+async def rank_by_embeddings(index: ToolIndex, query: str) -> List[int]:
+    """Ranking of the tools by the cosine similarity of their embeddings to the embedding of the query."""
+    missing = [text for text in set(index.texts) if text not in _embeddings]
+    if len(_embeddings) + len(missing) > MAX_EMBEDDINGS:
+        _embeddings.clear()
+        missing = list(set(index.texts))
+    if missing:
+        response = await litellm.aembedding(model=TOOL_EMBEDDING_MODEL, input=missing)
+        _embeddings.update((text, item["embedding"]) for text, item in zip(missing, response.data))
+    query_embedding = (await litellm.aembedding(model=TOOL_EMBEDDING_MODEL, input=[query])).data[0]["embedding"]
+    similarities = [cosine(query_embedding, _embeddings[text]) for text in index.texts]
+    return sorted(range(len(similarities)), key=lambda i: -similarities[i])
+
+
+def fuse_rankings(*rankings: List[int]) -> List[int]:
+    """Reciprocal rank fusion of several rankings of the same items."""
+    fused = Counter()
+    for ranking in rankings:
+        for rank, i in enumerate(ranking):
+            fused[i] += 1 / (RRF_K + rank)
+    return sorted(fused, key=lambda i: -fused[i])
+
+
+def cosine(a: List[float], b: List[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
@@ -8,7 +8,9 @@ from pydantic import BaseModel
 from .prompts import GENERATOR_PROMPT, EVALUATOR_TEMPLATE, OUTPUT_GENERATOR_TEMPLATE, \
     OUTPUT_GENERATOR_NO_TOOLS, FILE_EVALUATOR_SYSTEM_PROMPT, FILE_EVALUATOR_TEMPLATE, OUTPUT_GENERATOR_SYSTEM_PROMPT
 from ..abstract_method import AbstractMethod
-from ..models import QueryResponse, ChatMessage, ToolCall, MethodConfig, LLMConfig, ToolResultMessage
+from ..response_chain import ResponseChain
+from ..models import QueryResponse, ChatMessage, ToolCall, MethodConfig, LLMConfig, ToolResultMessage, HistoryConfig, \
+    ToolSelectionConfig
 
 
 class ToolLlmConfig(MethodConfig):
@@ -16,6 +18,8 @@ class ToolLlmConfig(MethodConfig):
     tool_eval_model: LLMConfig = MethodConfig.llm_role(title='Evaluator', description='Evaluating tool call results')
     output_model: LLMConfig = MethodConfig.llm_role(title='Output', description='Generating the final output')
     max_rounds: int = MethodConfig.max_rounds_field()
+    history: HistoryConfig = MethodConfig.history_field()
+    tool_selection: ToolSelectionConfig = MethodConfig.tool_selection_field()
 
 
 class ToolLLMMethod(AbstractMethod):
@@ -35,13 +39,16 @@ class ToolLLMMethod(AbstractMethod):
         should_continue = True      # Whether the internal iteration should continue or not
         skip_chain = False          # Whether to skip the internal chain and go straight to the output generation
         eval_reason = ""            # Saves the last reason the Evaluator Agent output for its decision
+        generator_chain = ResponseChain()  # Continues the previous response of the Tool Generator, if enabled
 
         # Use config set in session, if nothing was set yet, use default values
         config: ToolLlmConfig = self.get_config()
         max_iters = config.max_rounds
 
         # Get tools and transform them into the OpenAI Function Schema
-        tools, error = await self.get_tools()
+        # and select the ones most relevant to the query, if too many
+        all_tools, error = await self.get_tools()
+        tools = await self.select_tools(all_tools)
 
         # Save time before execution
         total_exec_time = time.time()
@@ -76,18 +83,23 @@ class ToolLLMMethod(AbstractMethod):
 
         # Run until request is finished or maximum number of iterations is reached
         while should_continue and c_it < max_iters and not skip_chain:
+            if c_it > 0:
+                # select the tools again, also considering the results of the previous round
+                tools = await self.select_tools(all_tools, str(called_tools[c_it - 1]))
+
             result = await self.call_llm(
                 model_config=config.tool_gen_model,
                 agent='Tool Generator',
                 system_prompt=self.build_full_prompt(GENERATOR_PROMPT),
                 messages=[
-                    *self.chat.messages,
+                    *await self.get_history(config.tool_gen_model),
                     ChatMessage(role="user", content=self.response.query),
                     *tool_messages,
                 ],
                 tool_choice="only",
                 tools=tools,
-                status_message="Generating Tool Calls"
+                status_message="Generating Tool Calls",
+                chain=generator_chain,
             )
 
             if not result.tools:
@@ -108,14 +120,15 @@ class ToolLLMMethod(AbstractMethod):
                     agent='Tool Generator',
                     system_prompt=self.build_full_prompt(GENERATOR_PROMPT),
                     messages=[
-                        *self.chat.messages,
+                        *await self.get_history(config.tool_gen_model),
                         ChatMessage(role="user", content=self.response.query),
                         *tool_messages,
                         ChatMessage(role="user", content=full_err),
                     ],
                     tool_choice="only",
                     tools=tools,
-                    status_message="Fixing Tool Calls"
+                    status_message="Fixing Tool Calls",
+                    chain=generator_chain,
                 )
                 correction_limit += 1
 
@@ -141,7 +154,7 @@ class ToolLLMMethod(AbstractMethod):
                     agent='Tool Evaluator',
                     system_prompt='',
                     messages=[
-                        *self.chat.messages,
+                        *await self.get_history(config.tool_eval_model),
                         ChatMessage(role="user", content=EVALUATOR_TEMPLATE.format(
                             message=self.response.query,
                             called_tools=called_tools,
@@ -163,7 +176,7 @@ class ToolLLMMethod(AbstractMethod):
                     eval_reason = "ERROR: The response from the Tool Evaluator was not in the correct format!"
 
                 # Add generated response to internal history to give result to first llm agent
-                tool_messages.append(ChatMessage(role="assistant", content=str(called_tools)))
+                tool_messages.append(generator_chain.add_tool_results(ChatMessage(role="assistant", content=str(called_tools))))
                 tool_messages.append(ChatMessage(role="user", content=f"Based on the called tools, another LLM has "
                                                                        f"decided to continue the process with the "
                                                                        f"following reason: {eval_reason}"))
@@ -177,7 +190,7 @@ class ToolLLMMethod(AbstractMethod):
             agent='Output Generator',
             system_prompt=self.build_full_prompt(OUTPUT_GENERATOR_SYSTEM_PROMPT),
             messages=[
-                *self.chat.messages,
+                *await self.get_history(config.output_model),
                 ChatMessage(role="user", content=OUTPUT_GENERATOR_NO_TOOLS.format(message=self.response.query) if len(called_tools) == 0 else
                 OUTPUT_GENERATOR_TEMPLATE.format(
                     message=self.response.query,
@@ -202,8 +215,9 @@ class ToolLLMMethod(AbstractMethod):
         # Save all encountered errors in a single string, which will be given to the llm as an input
         err_out = ""
 
-        # Get the list of available tools without mcp tools
-        tools, _ = await self.get_tools(include_mcp=False)
+        # Get the available tools (without mcp tools) indexed by name
+        catalog = await self.session.opaca_client.get_tool_catalog()
+        internal_tools = {t['name']: t for t in self.internal_tools.get_internal_tools_openai()} if self.internal_tools else {}
 
         # Since the gpt models can generate multiple tools, iterate over each generated call
         for call in calls:
@@ -218,7 +232,7 @@ class ToolLLMMethod(AbstractMethod):
 
             # Check if the generated action name is found in the list of action definitions
             # If not, abort current iteration since no reference parameters can be found
-            action_def = next((a for a in tools if a['name'] == action), None)
+            action_def = catalog.by_name.get(action) or internal_tools.get(action)
             if not action_def:
                 err_out += (f'Your generated function name "{action}" does not exist. Only use the exact function name '
                             f'defined in your tool section. Please make sure to separate the agent name and function '
@@ -0,0 +1,370 @@
+"""
+Helpers for streaming messages to the UI via the session's websocket. Fast models produce hundreds of tiny
+text chunks per second, each of which would otherwise be serialized and sent as a frame of its own, so
+consecutive chunks of the same message are merged within a short time window before being sent.
+The messages are then put into a bounded buffer per session, numbered with sequence numbers, from where they
+are sent by a single writer task per websocket, so that neither concurrent producers (e.g. parallel worker
+agents) nor a slow client can stall the generation of the response. The buffered messages are kept for a short
+time after being sent, so that a client reconnecting after a lost connection can resume where it left off.
+Messages are sent as JSON, or, if negotiated by the client, as more compact MessagePack.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque
+from contextlib import suppress
+from typing import Any, Awaitable, Callable, Deque, Dict, List
+
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+
+logger = logging.getLogger(__name__)
+
+
+# time window in milliseconds within which consecutive text chunks of the same message are merged; 0 to disable
+WS_COALESCE_MS = float(os.getenv("WS_COALESCE_MS", 30))
+
+# number of characters after which merged text chunks are sent right away, without waiting for the time window
+WS_COALESCE_MAX_CHARS = int(os.getenv("WS_COALESCE_MAX_CHARS", 2048))
+
+# maximum number of messages waiting to be sent to a websocket, before the client is considered stalled
+WS_QUEUE_SIZE = int(os.getenv("WS_QUEUE_SIZE", 1000))
+
+# upper bound for the (estimated) total size of the messages buffered for a session's websocket, in bytes
+WS_BUFFER_MAX_BYTES = int(os.getenv("WS_BUFFER_MAX_BYTES", 1024 * 1024))
+
+# message types that may be dropped if the client can not keep up, i.e. the queue is more than half full
+LOW_PRIORITY_MESSAGES = {"StatusMessage"}
+
+# message types of which only the latest message for each scheduled task is kept in the buffer
+PER_TASK_MESSAGES = {"PushAdvert", "PushMessage"}
+
+# seconds for which messages are kept in the buffer after being sent, for resuming after a reconnect
+WS_RESUME_SECONDS = float(os.getenv("WS_RESUME_SECONDS", 60))
+
+# weight of the latest send in the exponentially weighted moving average of the send latency
+LATENCY_ALPHA = 0.2
+
+# whether clients may negotiate MessagePack encoding (requires the msgpack package)
+WS_MSGPACK_ENABLED = os.getenv("WS_MSGPACK", "true").lower() == "true"
+
+# websocket subprotocols for the encodings of the messages
+SUBPROTOCOL_JSON = "sage.json"
+SUBPROTOCOL_MSGPACK = "sage.msgpack"
+
+# with MessagePack encoding, the "type" of the messages is replaced by the index in this list (append only!)
+MESSAGE_TYPES = [
+    "TextChunkMessage", "ToolCallMessage", "ToolResultMessage", "StatusMessage", "MetricsMessage",
+    "ResetTextMessage", "ReloadChatsMessage", "ContainersChangedMessage", "PushAdvert", "PushMessage",
+    "ConfirmActionNotification", "ContainerLoginNotification", "MissingApiKeyNotification",
+]
+MESSAGE_TYPE_TAGS = {name: tag for tag, name in enumerate(MESSAGE_TYPES)}
+
+
+class ChunkCoalescer:
+    """
+    Merges consecutive TextChunkMessages for the same message (and chat) before sending them. Merged chunks are
+    sent when the time window has passed, when they exceed the maximum size, or right before any other message
+    (e.g. tool calls, metrics or status), so that the order of all messages is preserved.
+    """
+
+    def __init__(self, send: Callable[[Dict[str, Any]], Awaitable[None]]):
+        self.send = send
+        self.pending: Dict[str, Any] | None = None
+        self.flush_task: asyncio.Task | None = None
+        self.lock = asyncio.Lock()
+
+    async def put(self, message: Dict[str, Any]) -> None:
+        """Send the message (typed dict), or hold it back if it is a text chunk that may be merged with the next."""
+        if message["type"] != "TextChunkMessage" or WS_COALESCE_MS <= 0:
+            previous, self.pending = self.pending, None
+            async with self.lock:
+                if previous:
+                    await self.send(previous)
+                await self.send(message)
+            return
+
+        if self.pending and is_same_message(self.pending, message):
+            self.pending["chunk"] += message["chunk"]
+        else:
+            previous, self.pending = self.pending, dict(message)
+            if previous:
+                async with self.lock:
+                    await self.send(previous)
+
+        if self.pending and len(self.pending["chunk"]) >= WS_COALESCE_MAX_CHARS:
+            await self.flush()
+        elif self.pending and self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_later())
+
+    async def flush(self) -> None:
+        """Send the merged chunks held back so far, if any."""
+        if self.flush_task is not None and self.flush_task is not asyncio.current_task():
+            self.flush_task.cancel()
+        self.flush_task = None
+        previous, self.pending = self.pending, None
+        if previous:
+            async with self.lock:
+                await self.send(previous)
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(WS_COALESCE_MS / 1000)
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.warning(f"Could not send text chunks: {e}")
+
+
+def select_subprotocol(offered: List[str]) -> str | None:
+    """Select the encoding from the subprotocols offered by the client, preferring MessagePack (if available)."""
+    if SUBPROTOCOL_MSGPACK in offered and WS_MSGPACK_ENABLED:
+        try:
+            import msgpack  # noqa: F401 (only checking availability)
+            return SUBPROTOCOL_MSGPACK
+        except ImportError:
+            logger.warning("MessagePack offered by client, but package 'msgpack' is not installed; using JSON")
+    return SUBPROTOCOL_JSON if SUBPROTOCOL_JSON in offered else None
+
+
+def encode_msgpack(message: Dict[str, Any]) -> bytes:
+    """Encode the message (typed dict) as MessagePack, with the type replaced by its numeric tag, if known."""
+    import msgpack
+    return msgpack.packb({**message, "type": MESSAGE_TYPE_TAGS.get(message["type"], message["type"])}, default=str)
+
+
+def decode_msgpack(data: bytes) -> Dict[str, Any]:
+    import msgpack
+    message = msgpack.unpackb(data)
+    if isinstance(message.get("type"), int):
+        message["type"] = MESSAGE_TYPES[message["type"]]
+    return message
+
+
+async def send_message(websocket: WebSocket, message: Dict[str, Any], subprotocol: str | None = None) -> None:
+    """Send the message (typed dict) in the encoding negotiated with the client."""
+    if subprotocol == SUBPROTOCOL_MSGPACK:
+        await websocket.send_bytes(encode_msgpack(message))
+    else:
+        await websocket.send_json(message)
+
+
+async def receive_message(websocket: WebSocket) -> Dict[str, Any]:
+    """Receive a message from the client, either as JSON text or as MessagePack binary frame."""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+    if message.get("bytes") is not None:
+        return decode_msgpack(message["bytes"])
+    return json.loads(message["text"])
+
+
+class OutboundBuffer:
+    """
+    Messages sent (or still to be sent) to a session's websocket, numbered with sequence numbers, so that a
+    reconnecting client can resume after the last message it received. Sent messages are dropped after the resume
+    window, or earlier if the buffer exceeds the size limit. Messages not sent yet are only dropped (oldest first)
+    while no websocket is connected, in which case the client is asked to reload the chats when reconnecting; a
+    connected client falling behind is closed by the writer instead. Superseded messages are dropped right away: text
+    chunks not yet sent are merged into the previous chunk of the same message, and only the latest PushAdvert
+    and PushMessage of each scheduled task are kept.
+    """
+
+    def __init__(self):
+        self.entries: Deque[List] = deque()  # [message, estimated size, time sent], ordered by sequence number
+        self.size = 0
+        self.last_seq = 0  # sequence number of the latest message
+        self.delivered_seq = 0  # sequence number of the latest message sent to the websocket
+        self.pending = 0  # number of messages not yet sent
+        self.evicted_seq = 0  # sequence number of the latest message dropped from the buffer
+        self.connected = False  # whether a writer is currently sending the messages to a websocket
+        self.stats: Dict[str, int] = {"merged": 0, "dropped": 0, "superseded": 0, "evicted": 0, "trimmed": 0,
+                                      "max_pending": 0}
+
+    def append(self, message: Dict[str, Any]) -> None:
+        """Add the message (typed dict), assigning the next sequence number unless it can be merged or dropped."""
+        tail = self.entries[-1] if self.entries else None
+        if (tail and tail[0]["seq"] > self.delivered_seq and tail[0]["type"] == message["type"] == "TextChunkMessage"
+                and is_same_message(tail[0], message)):
+            tail[0]["chunk"] += message["chunk"]
+            tail[1] += len(message["chunk"])
+            self.size += len(message["chunk"])
+            self.stats["merged"] += 1
+        elif message["type"] in LOW_PRIORITY_MESSAGES and self.pending >= WS_QUEUE_SIZE // 2:
+            # the client is falling behind
+            self.stats["dropped"] += 1
+            return
+        else:
+            if message["type"] in PER_TASK_MESSAGES:
+                self._drop_superseded(message)
+            self.last_seq += 1
+            message["seq"] = self.last_seq
+            size = len(json.dumps(message, default=str))
+            self.entries.append([message, size, None])
+            self.size += size
+            self.pending += 1
+            self.stats["max_pending"] = max(self.stats["max_pending"], self.pending)
+        self.trim()
+
+    def trim(self) -> None:
+        """Drop the messages sent longer ago than the resume window, and the oldest messages exceeding the size
+        limit, but no messages still to be sent to the connected websocket."""
+        expiry = time.time() - WS_RESUME_SECONDS
+        while self.entries and self.entries[0][2] is not None and self.entries[0][2] < expiry:
+            self._drop_oldest("trimmed")
+        while self.size > WS_BUFFER_MAX_BYTES and len(self.entries) > 1:
+            if self.connected and self.entries[0][0]["seq"] > self.delivered_seq:
+                break
+            self._drop_oldest("evicted")
+
+    def next_pending(self) -> Dict[str, Any] | None:
+        """The oldest message not yet sent, if any."""
+        return self.entries[len(self.entries) - self.pending][0] if self.pending else None
+
+    def mark_delivered(self, message: Dict[str, Any]) -> None:
+        """Mark the message returned by next_pending as sent."""
+        self.entries[len(self.entries) - self.pending][2] = time.time()
+        self.delivered_seq = message["seq"]
+        self.pending -= 1
+        self.trim()
+
+    def resume(self, last_seq: int | None) -> bool:
+        """Continue sending after the given sequence number (or after the last message sent so far, if None).
+        Returns False if messages after that were dropped already, i.e. some messages can not be resent."""
+        if last_seq is None or not 0 <= last_seq <= self.last_seq:
+            last_seq = self.delivered_seq
+        self.delivered_seq = last_seq
+        self.pending = 0
+        for entry in self.entries:
+            if entry[0]["seq"] > last_seq:
+                entry[2] = None
+                self.pending += 1
+        return last_seq >= self.evicted_seq
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "entries": len(self.entries),
+            "size": self.size,
+            "pending": self.pending,
+            "last_seq": self.last_seq,
+            "delivered_seq": self.delivered_seq,
+        }
+
+    def _drop_oldest(self, reason: str) -> None:
+        message, size, _ = self.entries.popleft()
+        self.size -= size
+        self.evicted_seq = message["seq"]
+        self.stats[reason] += 1
+        if message["seq"] > self.delivered_seq:
+            self.pending -= 1
+
+    def _drop_superseded(self, message: Dict[str, Any]) -> None:
+        for entry in list(self.entries):
+            if entry[0]["type"] == message["type"] and entry[0].get("task_id") == message.get("task_id"):
+                self.entries.remove(entry)
+                self.size -= entry[1]
+                self.stats["superseded"] += 1
+                if entry[0]["seq"] > self.delivered_seq:
+                    self.pending -= 1
+
+
+class WebSocketWriter:
+    """
+    Sends the messages in the buffer to the websocket from a single task, so that the producers only add messages
+    to the buffer and never wait for the client. If too many messages are pending anyway, the client is
+    considered stalled and the websocket is closed; the client can then reconnect and resume from the buffer.
+    """
+
+    def __init__(self, websocket: WebSocket, buffer: OutboundBuffer, subprotocol: str | None = None):
+        self.websocket = websocket
+        self.buffer = buffer
+        self.subprotocol = subprotocol
+        self.ready = asyncio.Event()
+        self.drained = asyncio.Event()
+        self.closed = False
+        self.stalled = False
+        self.stats: Dict[str, int] = {"sent": 0}
+        self.latency = 0.0
+        self.max_latency = 0.0
+        # messages pending from before (e.g. while disconnected) do not count towards the limit
+        self.stall_limit = buffer.pending + WS_QUEUE_SIZE
+        self.buffer.connected = True
+        self.ready.set()
+        self.task = asyncio.create_task(self._run())
+        self.close_task: asyncio.Task | None = None
+
+    def notify(self) -> None:
+        """Wake up the writer after messages were added to the buffer, or close a stalled websocket."""
+        if self.closed:
+            return
+        if self.buffer.pending >= self.stall_limit:
+            logger.warning(f"Too many pending messages ({self.buffer.pending}), closing stalled websocket")
+            self.closed = self.stalled = True
+            self.buffer.connected = False
+            self.task.cancel()
+            self.drained.set()
+            self.close_task = asyncio.ensure_future(self._close_websocket())
+            return
+        self.drained.clear()
+        self.ready.set()
+
+    async def join(self) -> None:
+        """Wait until all pending messages have been sent (or the writer was closed)."""
+        await self.drained.wait()
+
+    async def close(self) -> None:
+        """Stop sending, e.g. when the websocket was disconnected; pending messages stay in the buffer."""
+        self.closed = True
+        self.buffer.connected = False
+        self.task.cancel()
+        self.drained.set()
+        with suppress(asyncio.CancelledError):
+            await self.task
+
+    def info(self) -> Dict[str, Any]:
+        """Send latency and state of the writer, for the sessions-admin route."""
+        return {
+            **self.stats,
+            "latency": round(self.latency, 4),
+            "max_latency": round(self.max_latency, 4),
+            "closed": self.closed,
+            "stalled": self.stalled,
+            "encoding": self.subprotocol or SUBPROTOCOL_JSON,
+        }
+
+    async def _run(self) -> None:
+        try:
+            while not self.closed:
+                await self.ready.wait()
+                while (message := self.buffer.next_pending()) and not self.closed:
+                    # marked before sending, so it is no longer merged with following chunks
+                    self.buffer.mark_delivered(message)
+                    start = time.perf_counter()
+                    try:
+                        await send_message(self.websocket, message, self.subprotocol)
+                    except BaseException:
+                        self.buffer.resume(message["seq"] - 1)
+                        raise
+                    latency = time.perf_counter() - start
+                    self.latency = latency if not self.stats["sent"] else LATENCY_ALPHA * latency + (1 - LATENCY_ALPHA) * self.latency
+                    self.max_latency = max(self.max_latency, latency)
+                    self.stats["sent"] += 1
+                self.ready.clear()
+                self.drained.set()
+        except Exception as e:
+            logger.debug(f"Could not send to websocket: {e}")
+        finally:
+            self.closed = True
+            self.buffer.connected = False
+            self.drained.set()
+
+    async def _close_websocket(self) -> None:
+        with suppress(Exception):
+            await asyncio.wait_for(self.websocket.close(code=1013), timeout=1)
+
+
+def is_same_message(chunk: Dict[str, Any], other: Dict[str, Any]) -> bool:
+    """Whether both text chunks belong to the same message, i.e. can be merged."""
+    return all(chunk[k] == other.get(k) for k in ("id", "agent", "is_output", "chat_id"))
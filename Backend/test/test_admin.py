@@ -5,6 +5,7 @@ import pytest
 from fastapi.testclient import TestClient
 
 from src.models import ScheduledTask
+from src.restrictions import is_forbidden, needs_confirmation
 from src.session_manager import create_or_refresh_session
 from src.server import app, handle_session_http
 
@@ -79,7 +80,27 @@ def test_restrict_tool():
 
     res = client.get("/admin/restrict")
     assert res.status_code == 200
-    assert res.json() == {"forbidden": ["tool_FBD"], "need_confirmation": ["tool_NC"]}
+    assert res.json() == {"forbidden": ["tool_FBD"], "need_confirmation": ["tool_NC"], "deduplicate": []}
+
+    # fragments match case-insensitively in agent or action name
+    assert is_forbidden("SomeAgent", "my_TOOL_fbd_action")
+    assert is_forbidden("Tool_FBD_Agent", "action")
+    assert not is_forbidden(None, "tool_NC")
+    assert needs_confirmation("SomeAgent", "tool_nc")
+    assert not needs_confirmation("SomeAgent", "other")
+
+    # cached decisions are dropped when the restrictions are updated
+    res = client.put("/admin/restrict", json={"forbidden": [], "need_confirmation": ["other"]}, headers={"x-api-password": ADMIN_PWD})
+    assert res.status_code == 200
+    assert not is_forbidden("SomeAgent", "my_TOOL_fbd_action")
+    assert needs_confirmation("SomeAgent", "other")
+    assert not needs_confirmation("SomeAgent", "tool_nc")
+
+    # deduplicated actions are kept unless given explicitly
+    client.put("/admin/restrict", json={"forbidden": [], "need_confirmation": [], "deduplicate": ["lookup"]}, headers={"x-api-password": ADMIN_PWD})
+    client.put("/admin/restrict", json={"forbidden": ["tool_FBD"], "need_confirmation": []}, headers={"x-api-password": ADMIN_PWD})
+    assert client.get("/admin/restrict").json()["deduplicate"] == ["lookup"]
+    client.put("/admin/restrict", json={"forbidden": [], "need_confirmation": [], "deduplicate": []}, headers={"x-api-password": ADMIN_PWD})
 
 # SESSION ADMIN UPDATE
 @pytest.mark.anyio
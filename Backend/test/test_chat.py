@@ -1,12 +1,16 @@
+import json
 import threading
 import time
 import uuid
+from types import SimpleNamespace
+from unittest.mock import patch
 
 import pytest
 from fastapi.testclient import TestClient
+from litellm.types.llms.openai import ResponseAPIUsage, ResponsesAPIStreamEvents as event_type
 
 from src.server import app, handle_session_id
-from util import handle_user_session_id
+from util import handle_user_session_id, patch_environment
 
 
 # Initialize the client with a mock session
@@ -42,6 +46,32 @@ def test_get_chat_by_id(method):
     res = client.get(f"/chats/{chats[method]}")
     assert res.status_code == 200
 
+def test_chat_query_stream():
+    """Test the streaming variant of the /chats endpoint, with a mocked LLM."""
+    async def stream():
+        for delta in ("Hello", " World"):
+            yield SimpleNamespace(type=event_type.OUTPUT_TEXT_DELTA, delta=delta)
+        yield SimpleNamespace(type=event_type.RESPONSE_COMPLETED, response=SimpleNamespace(
+            output=[], usage=ResponseAPIUsage(input_tokens=10, output_tokens=5, total_tokens=15)))
+
+    async def aresponses_api_with_mcp(**kwargs):
+        return stream()
+
+    chat_id = str(uuid.uuid4())
+    with patch("litellm.aresponses_api_with_mcp", aresponses_api_with_mcp), patch_environment({"OPENAI_API_KEY": "test"}):
+        res = client.post(f"/chats/{chat_id}/query/simple-tools/stream", json={"user_query": "Hi"})
+        assert res.headers["content-type"] == "application/x-ndjson"
+        messages = [json.loads(line) for line in res.text.splitlines()]
+        assert [m["type"] for m in messages] == ["ResetTextMessage", "TextChunkMessage", "TextChunkMessage", "MetricsMessage", "QueryResponse"]
+        assert messages[-1]["content"] == "Hello World"
+        assert client.get(f"/chats/{chat_id}").json()["responses"][-1]["content"] == "Hello World"
+
+        res = client.post("/query/simple-tools/stream", json={"user_query": "Hi"}, headers={"Accept": "text/event-stream"})
+        assert res.headers["content-type"].startswith("text/event-stream")
+        events = res.text.strip().split("\n\n")
+        assert events[1].startswith("event: TextChunkMessage\ndata: ")
+        assert json.loads(events[-1].split("data: ", 1)[1])["content"] == "Hello World"
+
 @pytest.mark.skip()
 def test_get_non_existing_chat():
     """Test if a non-existing chat returns a 404."""
@@ -0,0 +1,133 @@
+"""
+Tests for keeping the chat history within the token budget, using a mocked LLM for the summaries.
+"""
+
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+from litellm.types.llms.openai import ResponseAPIUsage, ResponsesAPIStreamEvents as event_type
+
+from src.models import SessionData, Chat, QueryResponse, LLMConfig, HistoryConfig, HistorySummary
+from src.simple_tools import SimpleToolsMethod
+from src.simple_tools.simple_tools_routes import SimpleToolConfig
+from util import patch_environment
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def llm(request):
+    """Mocked LLM, responding with a numbered summary (padded with the given number of words), and recording the
+    requests."""
+    calls = []
+    padding = " word" * getattr(request, "param", 0)
+
+    async def stream():
+        yield SimpleNamespace(type=event_type.OUTPUT_TEXT_DELTA, delta=f"Summary {len(calls)}{padding}")
+        yield SimpleNamespace(type=event_type.RESPONSE_COMPLETED, response=SimpleNamespace(
+            output=[], usage=ResponseAPIUsage(input_tokens=10, output_tokens=5, total_tokens=15),
+        ))
+
+    async def aresponses_api_with_mcp(**kwargs):
+        calls.append(kwargs)
+        return stream()
+
+    with patch("litellm.aresponses_api_with_mcp", aresponses_api_with_mcp), patch_environment({"OPENAI_API_KEY": "test"}):
+        yield calls
+
+
+MODEL = LLMConfig(model="openai/gpt-4o-mini")
+
+
+def make_method(session: SessionData, chat: Chat, query: str) -> SimpleToolsMethod:
+    """Method for the next query in the chat, added to the chat before the query, like in the chat route."""
+    response = QueryResponse(query=query)
+    chat.store_interaction(response)
+    return SimpleToolsMethod(session, chat, response)
+
+
+def answer(i: int) -> QueryResponse:
+    return QueryResponse(query=f"Question {i}", content=" ".join(["word"] * 400))
+
+
+@pytest.mark.anyio
+async def test_full_history_by_default(llm):
+    chat = Chat(chat_id="c1", responses=[answer(i) for i in range(3)])
+    method = make_method(SessionData(), chat, "Next")
+    history = await method.get_history(MODEL)
+    assert [m["content"] for m in history[::2]] == ["Question 0", "Question 1", "Question 2"]
+    assert not llm
+
+
+@pytest.mark.anyio
+async def test_rolling_summary(llm):
+    session = SessionData()
+    session.config[SimpleToolsMethod.NAME] = SimpleToolConfig(history=HistoryConfig(max_tokens=1000))
+    chat = Chat(chat_id="c1", responses=[answer(i) for i in range(5)])
+
+    method = make_method(session, chat, "Next")
+    history = await method.get_history(MODEL)
+    assert [m["content"] for m in history] == ["Summarize our conversation so far.", "Summary 1",
+                                            "Question 3", answer(3).content, "Question 4", answer(4).content]
+    assert chat.history_summary.turns == 3
+    assert "Question 2" in llm[0]["input"][0]["content"]
+
+    # reused for further rounds and roles of the same query
+    assert await method.get_history(MODEL) == history
+    assert len(llm) == 1
+
+    # extended with the interactions dropping out of the budget in the next query
+    method.response.content = answer(5).content
+    method = make_method(session, chat, "Next")
+    history = await method.get_history(MODEL)
+    assert len(llm) == 2
+    assert "Summary 1" in llm[1]["input"][0]["content"] and "Question 2" not in llm[1]["input"][0]["content"]
+    assert chat.history_summary.turns == 4
+    assert [m["content"] for m in history[::2]] == ["Summarize our conversation so far.", "Question 4", "Next"]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("llm", [200], indirect=True)
+async def test_no_interactions_dropped_by_longer_summary(llm):
+    session = SessionData()
+    session.config[SimpleToolsMethod.NAME] = SimpleToolConfig(history=HistoryConfig(max_tokens=1000))
+    chat = Chat(chat_id="c1", responses=[answer(i) for i in range(5)])
+
+    # the new summary covers the first three interactions; the window starts right after those, even if the
+    # summary leaves less room for the window than assumed before
+    history = await make_method(session, chat, "Next").get_history(MODEL)
+    assert chat.history_summary.turns == 3
+    assert [m["content"] for m in history[2::2]] == ["Question 3", "Question 4"]
+
+
+@pytest.mark.anyio
+async def test_latest_interaction_kept_and_summary_truncated(llm):
+    session = SessionData()
+    session.config[SimpleToolsMethod.NAME] = SimpleToolConfig(history=HistoryConfig(max_tokens=1000))
+    long_answer = QueryResponse(query="Question 1", content=" ".join(["word"] * 2000))
+    chat = Chat(chat_id="c1", responses=[answer(0), long_answer],
+                history_summary=HistorySummary(content=" ".join(["summary"] * 2000), turns=1))
+
+    method = make_method(session, chat, "Next")
+    history = await method.get_history(MODEL)
+    assert [m["content"] for m in history[2:]] == ["Question 1", long_answer.content]
+    assert history[1]["content"].endswith("[...]") and len(history[1]["content"].split()) < 300
+    assert not llm
+
+
+def test_serialized_messages_reused():
+    chat = Chat(chat_id="c1", responses=[answer(i) for i in range(2)])
+    first = chat.serialized_messages()
+    assert first == [m.model_dump() for m in chat.messages]
+
+    running = QueryResponse(query="Next")
+    chat.store_interaction(running)
+    second = chat.serialized_messages(exclude=running)
+    assert all(a is b for a, b in zip(first, second)) and len(second) == 4
+
+    running.content = "Done"
+    assert chat.serialized_messages()[-1] == {"role": "assistant", "content": "Done"}
@@ -1,9 +1,16 @@
+from unittest.mock import patch
+
+import litellm
 import pytest
 from fastapi.testclient import TestClient
 
+from src import abstract_method
+from src.abstract_method import compose_prompt, get_cached_tokens
+from src.models import LLMConfig
+from src.model_capabilities import get_model_capabilities, invalidate_model_capabilities
 from src.server import app, handle_session_id
 
-from util import handle_user_session_id
+from util import handle_user_session_id, patch_environment
 
 
 # Initialize the client with a mock session
@@ -51,3 +58,29 @@ def test_reset_config_simple(method):
     assert res.status_code == 200
     data = res.json()
     assert data["config_values"]["max_rounds"] == 5
+
+
+def test_model_capabilities_memoized():
+    invalidate_model_capabilities()
+    with patch("litellm.get_supported_openai_params", wraps=litellm.get_supported_openai_params) as lookup:
+        for _ in range(3):
+            config = LLMConfig(model="openai/gpt-4o-mini")
+            config.model_dump()
+        assert lookup.call_count == 1
+        assert "temperature" in get_model_capabilities("openai/gpt-4o-mini").supported_params
+
+        # capabilities are looked up again after invalidating the registry, e.g. for a changed environment
+        with patch_environment({"OPENAI_API_KEY": "changed"}):
+            assert get_model_capabilities("openai/gpt-4o-mini").keys_in_environment
+        assert lookup.call_count == 2
+
+
+def test_prompt_cache_layout():
+    with patch.object(abstract_method, "PROMPT_CACHE_LAYOUT", True):
+        assert compose_prompt("static", "time") == "static\n\ntime"
+    with patch.object(abstract_method, "PROMPT_CACHE_LAYOUT", False):
+        assert compose_prompt("static", "time") == "time\n\nstatic"
+
+    assert get_cached_tokens({"input_tokens": 100, "input_tokens_details": {"cached_tokens": 64}}) == 64
+    assert get_cached_tokens({"prompt_tokens": 100, "prompt_tokens_details": {"cached_tokens": 32}}) == 32
+    assert get_cached_tokens({"input_tokens": 100, "input_tokens_details": None}) == 0
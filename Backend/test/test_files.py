@@ -1,7 +1,16 @@
+import asyncio
 import io
+from types import SimpleNamespace
+from unittest.mock import patch, AsyncMock
+
 import pytest
+from fastapi import UploadFile
 from fastapi.testclient import TestClient
+from starlette.datastructures import Headers
 
+from src import file_utils, session_manager
+from src.file_utils import upload_files, save_file_to_disk, delete_file_from_all_clients
+from src.models import SessionData
 from src.server import app, handle_session_http
 from util import handle_user_session_id
 
@@ -123,3 +132,51 @@ def test_delete_files(files_response):
     res = client.get("/files")
     assert res.status_code == 200
     assert len(res.json()) == 0
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.mark.anyio
+async def test_upload_files_deduplicated(tmp_path):
+    uploaded = []
+
+    async def create_file(file, purpose, custom_llm_provider):
+        uploaded.append(file[0])
+        host_file_id = f"host-file-{len(uploaded)}"
+        await asyncio.sleep(0.01)
+        return SimpleNamespace(id=host_file_id)
+
+    with (patch("src.file_utils.FILES_PATH", str(tmp_path)),
+          patch("src.file_utils.litellm.acreate_file", side_effect=create_file),
+          patch("src.file_utils.litellm.afile_delete", new_callable=AsyncMock) as afile_delete,
+          patch.dict(file_utils._uploaded_by_hash, clear=True),
+          patch.dict(file_utils._upload_refs, clear=True)):
+        sessions = [SessionData() for _ in range(3)]
+        assert await upload_files(sessions[0], "openai/gpt-4o-mini") == []
+
+        for session, content in zip(sessions, [b"same content", b"same content", b"other content"]):
+            upload = UploadFile(io.BytesIO(content), filename="file.pdf", headers=Headers({"content-type": "application/pdf"}))
+            await save_file_to_disk(upload, session)
+
+        # identical files are uploaded only once, even by concurrent queries
+        results = await asyncio.gather(*[upload_files(s, "openai/gpt-4o-mini") for s in [*sessions, sessions[0]]])
+        assert len(uploaded) == 2
+        assert results[0] == results[1] == results[3] != results[2]
+        assert await upload_files(sessions[0], "openai/gpt-4o-mini") == results[0]
+        assert len(uploaded) == 2
+
+        # the host's file is only deleted once no session uses it anymore
+        file_id = next(iter(sessions[0].uploaded_files))
+        assert await delete_file_from_all_clients(sessions[0], file_id, False)
+        afile_delete.assert_not_called()
+        file_id = next(iter(sessions[1].uploaded_files))
+        assert await delete_file_from_all_clients(sessions[1], file_id, False)
+        afile_delete.assert_called_once()
+
+        # deleting a session releases its files as well
+        with patch.dict(session_manager.sessions, {sessions[2].session_id: sessions[2]}):
+            await session_manager.delete_session(sessions[2].session_id)
+        assert afile_delete.call_count == 2 and file_utils._upload_refs == {}
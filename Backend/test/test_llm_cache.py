@@ -0,0 +1,88 @@
+"""
+Tests for the LLM response cache, using a mocked LLM stream instead of an actual LLM.
+"""
+
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+from litellm.types.llms.openai import ResponseAPIUsage, ResponsesAPIStreamEvents as event_type
+from openai.types.responses import ResponseFunctionToolCall
+
+from src import llm_cache
+from src.models import SessionData, Chat, QueryResponse, LLMConfig, ChatMessage
+from src.simple_tools import SimpleToolsMethod
+from util import patch_environment
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def llm():
+    """Mocked LLM, streaming a short text and a tool call, and counting the calls."""
+    calls = []
+
+    async def stream():
+        for delta in ("Hello", " World"):
+            yield SimpleNamespace(type=event_type.OUTPUT_TEXT_DELTA, delta=delta)
+        yield SimpleNamespace(type=event_type.RESPONSE_COMPLETED, response=SimpleNamespace(
+            output=[ResponseFunctionToolCall(type="function_call", name="Agent--Action", arguments='{"x": 1}', call_id="c1")],
+            usage=ResponseAPIUsage(input_tokens=10, output_tokens=5, total_tokens=15),
+        ))
+
+    async def aresponses_api_with_mcp(**kwargs):
+        calls.append(kwargs)
+        return stream()
+
+    with (patch("litellm.aresponses_api_with_mcp", aresponses_api_with_mcp),
+          patch_environment({"OPENAI_API_KEY": "test"}),
+          patch.dict(llm_cache.llm_cache_stats, {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0})):
+        llm_cache.clear_responses()
+        yield calls
+        llm_cache.clear_responses()
+
+
+async def query(cache_responses: bool, content: str = "Hi"):
+    method = SimpleToolsMethod(SessionData(), Chat(chat_id=""), QueryResponse())
+    return await method.call_llm(
+        model_config=LLMConfig(model="openai/gpt-4o-mini", cache_responses=cache_responses),
+        agent="assistant",
+        system_prompt="Test",
+        messages=[ChatMessage(role="user", content=content)],
+    )
+
+
+@pytest.mark.anyio
+async def test_responses_not_cached_by_default(llm):
+    await query(False)
+    await query(False)
+    assert len(llm) == 2
+
+
+@pytest.mark.anyio
+async def test_responses_replayed(llm):
+    first = await query(True)
+    second = await query(True)
+    assert len(llm) == 1
+    assert second.content == first.content == "Hello World"
+    assert [(t.name, t.args) for t in second.tools] == [("Agent--Action", {"x": 1})]
+    assert second.response_metadata["total_tokens"] == 15
+    assert second.response_metadata["cached_response"] and "cached_response" not in first.response_metadata
+
+    await query(True, "Something else")
+    assert len(llm) == 2
+    assert llm_cache.get_llm_cache_info()["hits"] == 1
+
+
+@pytest.mark.anyio
+async def test_responses_cached_on_disk(llm, tmp_path):
+    with patch("src.llm_cache.LLM_CACHE_DIR", str(tmp_path)):
+        await query(True)
+        llm_cache._responses.clear()
+        second = await query(True)
+        assert len(llm) == 1
+        assert second.content == "Hello World"
+        assert llm_cache.llm_cache_stats["disk_hits"] == 1
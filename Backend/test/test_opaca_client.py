@@ -0,0 +1,440 @@
+"""
+Tests for the caching behavior of the OpacaClient, using a mocked OPACA platform
+instead of a running one.
+"""
+
+import asyncio
+import json
+import threading
+import time
+from typing import Dict, List
+from unittest.mock import patch
+
+import httpx
+import pytest
+
+from src.models import SessionData, Chat, QueryResponse
+from src import opaca_client as opaca_client_module
+from src.opaca_client import OpacaClient, stop_catalog_watchers
+from src.restrictions import set_restrictions
+from src import result_cache
+from src.result_cache import set_result_ttls
+from src.simple_tools import SimpleToolsMethod
+from src import tool_catalog, container_health
+from src.tool_catalog import catalog_stats
+
+
+URL = "http://opaca-test:8000"
+
+OPENAPI_SPEC = {
+    "paths": {
+        "/invoke/TestAction/TestAgent": {
+            "post": {
+                "operationId": "container-1;TestAgent;TestAction",
+                "description": "Test action",
+                "requestBody": {"content": {"application/json": {"schema": {"$ref": "#/components/schemas/TestParams"}}}},
+            }
+        },
+    },
+    "components": {
+        "schemas": {
+            "TestParams": {"type": "object", "properties": {"value": {"type": "integer"}}, "required": ["value"]},
+        }
+    },
+}
+
+CONTAINERS = [
+    {
+        "containerId": "container-1",
+        "image": {"imageName": "test-image", "name": "Test Container"},
+        "agents": [
+            {"agentId": "TestAgent", "description": "", "actions": [{"name": "TestAction"}]},
+        ],
+        "connectivity": {"publicUrl": "http://opaca-test", "extraPortMappings": {}},
+    }
+]
+
+
+class MockPlatform:
+    """Mocked OPACA platform, counting the requests made to each route."""
+
+    def __init__(self):
+        self.requests = []
+        self.containers = list(CONTAINERS)
+        self.invoke_status = 200
+        self.invoke_delay = 0
+        self.invoke_cause = None
+        self.extra_ports: Dict[int, int] = {}  # status returned by the extra ports of the containers
+        self.extra_port_delay = 0
+        self.probed: List[int] = []
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        if request.url.port in self.extra_ports:
+            self.probed.append(request.url.port)
+            await asyncio.sleep(self.extra_port_delay)
+            return httpx.Response(self.extra_ports[request.url.port])
+        self.requests.append((request.method, request.url.path))
+        if request.url.path == "/containers" and request.method == "GET":
+            if request.headers.get("If-None-Match") == f'"{len(self.containers)}"':
+                return httpx.Response(304)
+            return httpx.Response(200, json=self.containers, headers={"ETag": f'"{len(self.containers)}"'})
+        if request.url.path == "/v3/api-docs/actions":
+            return httpx.Response(200, json=OPENAPI_SPEC)
+        if request.url.path.startswith("/invoke/"):
+            result = {"n": len(self.requests), "params": json.loads(request.content)}
+            if self.invoke_cause is not None:
+                result = {"statusCode": self.invoke_status, "cause": {"statusCode": self.invoke_cause}}
+            await asyncio.sleep(self.invoke_delay)
+            return httpx.Response(self.invoke_status, json=result)
+        if request.url.path.startswith("/containers"):
+            return httpx.Response(200, json="ok")
+        return httpx.Response(404)
+
+    def count(self, method: str, path: str) -> int:
+        return self.requests.count((method, path))
+
+
+@pytest.fixture
+def anyio_backend():
+    # the backend relies on asyncio (e.g. asyncio.Lock), so do not run these tests with trio
+    return "asyncio"
+
+
+@pytest.fixture
+def platform():
+    platform = MockPlatform()
+    client = httpx.AsyncClient(transport=httpx.MockTransport(platform.handler))
+    with (patch("src.opaca_client.get_http_client", return_value=client),
+          patch.dict(tool_catalog._platform_catalogs, clear=True),
+          patch.dict(tool_catalog._compiled_catalogs, clear=True),
+          patch.dict(container_health._container_health, clear=True)):
+        yield platform
+
+
+def create_client() -> OpacaClient:
+    opaca_client = OpacaClient()
+    opaca_client.url = URL
+    return opaca_client
+
+
+@pytest.fixture
+def opaca_client():
+    return create_client()
+
+
+@pytest.mark.anyio
+async def test_http_clients_pooled():
+    with patch.dict(opaca_client_module._http_clients, clear=True):
+        # one client per platform, shared by all sessions
+        client = create_client()._client()
+        assert create_client()._client() is client
+        assert opaca_client_module.get_http_client("http://other:8000") is not client
+
+        # a separate client is used in another event loop, and closed together with the others
+        async def get_client():
+            return create_client()._client()
+
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever)
+        thread.start()
+        try:
+            other = asyncio.run_coroutine_threadsafe(get_client(), loop).result()
+            assert other is not client and not other.is_closed
+            await opaca_client_module.close_http_clients()
+            await asyncio.sleep(0.05)
+            assert client.is_closed and other.is_closed
+            assert not create_client()._client().is_closed
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+        await opaca_client_module.close_http_clients()
+
+
+@pytest.mark.anyio
+async def test_containers_cached(platform, opaca_client):
+    assert await opaca_client.get_containers() == CONTAINERS
+    assert await opaca_client.get_containers() == CONTAINERS
+    assert platform.count("GET", "/containers") == 1
+
+
+@pytest.mark.anyio
+async def test_containers_force_refresh(platform, opaca_client):
+    await opaca_client.get_containers()
+    version = opaca_client.catalog_version
+    await opaca_client.get_containers(force_refresh=True)
+    assert platform.count("GET", "/containers") == 2
+    # unchanged content does not produce a new catalog version
+    assert opaca_client.catalog_version == version
+
+
+@pytest.mark.anyio
+async def test_containers_revalidated_with_etag(platform, opaca_client):
+    with patch("src.opaca_client.CATALOG_TTL", 0):
+        await opaca_client.get_containers()
+        assert await opaca_client.get_containers() == CONTAINERS
+    assert platform.count("GET", "/containers") == 2
+
+
+@pytest.mark.anyio
+async def test_containers_invalidated_on_deploy_and_stop(platform, opaca_client):
+    await opaca_client.get_containers()
+    await opaca_client.deploy_container({"image": {"imageName": "other-image"}})
+    platform.containers = []
+    assert await opaca_client.get_containers() == []
+    await opaca_client.stop_container("container-1")
+    await opaca_client.get_containers()
+    assert platform.count("GET", "/containers") == 3
+
+
+@pytest.mark.anyio
+async def test_container_lookup_for_login(platform, opaca_client):
+    assert await opaca_client.get_most_likely_container_id("TestAgent", "TestAction") == ("container-1", "Test Container")
+    assert await opaca_client.get_most_likely_container_id(None, "TestAction") == ("container-1", "Test Container")
+    assert platform.count("GET", "/containers") == 1
+
+    # unknown actions trigger a single refresh of the containers
+    assert await opaca_client.get_most_likely_container_id("TestAgent", "Unknown") == ("", "")
+    assert platform.count("GET", "/containers") == 2
+
+
+@pytest.mark.anyio
+async def test_extra_ports_probed_concurrently(platform, opaca_client):
+    ports = {"8081": "Web UI", "8082": "API", "8083": "Broken"}
+    platform.containers = [{**CONTAINERS[0], "connectivity": {"publicUrl": "http://opaca-test", "extraPortMappings": {
+        port: {"protocol": "TCP", "description": description} for port, description in ports.items()}}}]
+    platform.extra_ports = {8081: 200, 8082: 200, 8083: 500}
+    platform.extra_port_delay = 0.2
+
+    with patch.dict(opaca_client_module._extra_port_health, clear=True):
+        start = time.time()
+        extra_ports = await opaca_client.get_extra_ports()
+        assert time.time() - start < 0.4
+        assert [p["fullUrl"] for p in extra_ports[0]["extraPorts"]] == ["http://opaca-test:8081", "http://opaca-test:8082"]
+        assert sorted(platform.probed) == [8081, 8082, 8083]
+
+        # recent results are reused, failures for a shorter time
+        assert await opaca_client.get_extra_ports() == extra_ports
+        assert len(platform.probed) == 3
+        with patch("src.opaca_client.time.time", return_value=time.time() + 16):
+            await opaca_client.get_extra_ports()
+        assert sorted(platform.probed[3:]) == [8083]
+        with patch("src.opaca_client.time.time", return_value=time.time() + 61):
+            await opaca_client.get_extra_ports()
+        assert sorted(platform.probed[4:]) == [8081, 8082, 8083]
+
+
+@pytest.mark.anyio
+async def test_tool_catalog_compiled_once(platform, opaca_client):
+    misses = catalog_stats["misses"]
+    catalog = await opaca_client.get_tool_catalog()
+    assert catalog.by_name["TestAgent--TestAction"]["parameters"]["required"] == ["value"]
+    assert catalog.get_functions(agent="TestAgent") == catalog.functions
+    assert catalog.get_functions(agent="OtherAgent") == []
+
+    # same spec fetched again is not converted again
+    assert await opaca_client.get_tool_catalog(force_refresh=True) is catalog
+    assert catalog_stats["misses"] == misses + 1
+    assert platform.count("GET", "/v3/api-docs/actions") == 2
+
+
+@pytest.mark.anyio
+async def test_catalog_shared_between_sessions(platform):
+    clients = [create_client() for _ in range(5)]
+    results = await asyncio.gather(*[c.get_containers() for c in clients], *[c.get_tool_catalog() for c in clients])
+    assert all(r == CONTAINERS for r in results[:5])
+    assert all(r is results[5] for r in results[5:])
+    assert platform.count("GET", "/containers") == 1
+    assert platform.count("GET", "/v3/api-docs/actions") == 1
+
+    # other platform user does not share the catalog
+    other = create_client()
+    other.token = "not-a-jwt"
+    await other.get_containers()
+    assert platform.count("GET", "/containers") == 2
+
+
+@pytest.mark.anyio
+async def test_identical_invocations_deduplicated(platform):
+    session = SessionData()
+    session.opaca_client.url = URL
+    method = SimpleToolsMethod(session, Chat(chat_id=""), QueryResponse())
+    path = "/invoke/TestAction/TestAgent"
+
+    # not deduplicated unless enabled for the action
+    await asyncio.gather(*[method.invoke_tool("TestAgent--TestAction", {"value": 1}, f"a/{i}") for i in range(3)])
+    assert platform.count("POST", path) == 3
+
+    set_restrictions([], [], ["testaction"])
+    try:
+        results = await asyncio.gather(
+            *[method.invoke_tool("TestAgent--TestAction", {"value": 1}, f"b/{i}") for i in range(3)],
+            method.invoke_tool("TestAgent--TestAction", {"value": 2}, "b/3"),
+        )
+    finally:
+        set_restrictions([], [], [])
+    assert platform.count("POST", path) == 5
+    assert [r.id for r in results] == ["b/0", "b/1", "b/2", "b/3"]
+    assert results[0].result == results[1].result == results[2].result != results[3].result
+    assert method.inflight_invocations == {}
+
+
+@pytest.mark.anyio
+async def test_action_results_cached(platform):
+    session = SessionData()
+    session.opaca_client.url = URL
+    method = SimpleToolsMethod(session, Chat(chat_id=""), QueryResponse())
+    path = "/invoke/TestAction/TestAgent"
+
+    set_result_ttls({"TESTACTION": 60})
+    try:
+        first = await method.invoke_tool("TestAgent--TestAction", {"value": 1, "other": 2}, "a/0")
+        second = await method.invoke_tool("TestAgent--TestAction", {"other": 2, "value": 1}, "a/1")
+        third = await method.invoke_tool("TestAgent--TestAction", {"value": 2}, "a/2")
+        assert platform.count("POST", path) == 2
+        assert (first.cached, second.cached, third.cached) == (False, True, False)
+        assert first.result == second.result
+        assert "cached" not in second.without_id()
+
+        # results expire after the TTL
+        with patch("src.result_cache.time.time", return_value=time.time() + 61):
+            assert not (await method.invoke_tool("TestAgent--TestAction", {"value": 1, "other": 2}, "a/3")).cached
+        assert platform.count("POST", path) == 3
+
+        # not cached for sessions logged in to the container, as the results may depend on the login
+        session.opaca_client.logged_in_containers["container-1"] = "token"
+        assert not (await method.invoke_tool("TestAgent--TestAction", {"value": 1, "other": 2}, "a/4")).cached
+        assert not (await method.invoke_tool("TestAgent--TestAction", {"value": 1, "other": 2}, "a/5")).cached
+        assert platform.count("POST", path) == 5
+    finally:
+        set_result_ttls({})
+
+
+def test_action_results_evicted():
+    try:
+        with patch("src.result_cache.RESULT_CACHE_MAX_BYTES", 10):
+            result_cache.put_result("a", "1234", 60)
+            result_cache.put_result("b", "1234", 60)
+            assert result_cache.get_result("a") == (True, "1234")
+            result_cache.put_result("c", "1234", 60)
+            # least recently used entry is evicted first, too large results are not cached at all
+            assert result_cache.get_result("b") == (False, None)
+            assert result_cache.get_result("a") == (True, "1234")
+            result_cache.put_result("d", "12345678901", 60)
+            assert result_cache.get_result("d") == (False, None)
+    finally:
+        result_cache.clear_results()
+
+
+@pytest.mark.anyio
+async def test_circuit_breaker(platform, opaca_client):
+    await opaca_client.get_containers()
+    path = "/invoke/TestAction/TestAgent"
+
+    # client errors do not count as failures of the container
+    platform.invoke_status = 400
+    for _ in range(5):
+        with pytest.raises(httpx.HTTPStatusError):
+            await opaca_client.invoke_opaca_action("TestAction", "TestAgent", {})
+    assert container_health.get_container_health(URL, "container-1").state == "closed"
+
+    # neither do client errors of the container wrapped in a server error of the platform
+    platform.invoke_status, platform.invoke_cause = 502, 404
+    for _ in range(5):
+        with pytest.raises(httpx.HTTPStatusError):
+            await opaca_client.invoke_opaca_action("TestAction", "TestAgent", {})
+    assert container_health.get_container_health(URL, "container-1").state == "closed"
+
+    platform.invoke_cause = 500
+    for _ in range(10):
+        with pytest.raises(httpx.HTTPStatusError):
+            await opaca_client.invoke_opaca_action("TestAction", "TestAgent", {})
+    health = container_health.get_container_health(URL, "container-1")
+    assert health.state == "open" and health.error_rate == 0.5
+    platform.invoke_cause = None
+
+    # open breaker fails fast, without calling the platform
+    with pytest.raises(Exception, match="currently unavailable"):
+        await opaca_client.invoke_opaca_action("TestAction", "TestAgent", {})
+    assert platform.count("POST", path) == 20
+
+    # after some time, a single successful call closes the breaker again
+    platform.invoke_status = 200
+    with patch("src.container_health.BREAKER_OPEN_SECONDS", 0):
+        await opaca_client.invoke_opaca_action("TestAction", "TestAgent", {})
+    assert health.state == "closed"
+    assert container_health.get_container_health_info()[0]["calls"] == 21
+
+
+@pytest.mark.anyio
+async def test_invoke_timeout_and_truncation(platform, opaca_client):
+    platform.invoke_delay = 1
+    with patch("src.opaca_client.INVOKE_TIMEOUT", 0.05), pytest.raises(TimeoutError):
+        await opaca_client.invoke_opaca_action("TestAction", "TestAgent", {})
+
+    # timeout for individual actions overrides the default
+    opaca_client_module.action_timeouts.update({"testaction": 5})
+    try:
+        with patch("src.opaca_client.INVOKE_TIMEOUT", 0.05):
+            assert await opaca_client.invoke_opaca_action("TestAction", "TestAgent", {}) == {"n": 2, "params": {}}
+    finally:
+        opaca_client_module.action_timeouts.update({})
+
+    platform.invoke_delay = 0
+    with patch("src.opaca_client.MAX_RESULT_BYTES", 10):
+        result = await opaca_client.invoke_opaca_action("TestAction", "TestAgent", {"value": 123})
+    assert result.startswith('{"n":3,"pa\n[... result truncated')
+
+
+@pytest.mark.anyio
+async def test_invoke_cancelled_on_abort(platform):
+    session = SessionData()
+    session.opaca_client.url = URL
+    method = SimpleToolsMethod(session, Chat(chat_id="chat"), QueryResponse())
+    platform.invoke_delay = 10
+
+    call = asyncio.ensure_future(method.invoke_tool("TestAgent--TestAction", {}, "a/0"))
+    await asyncio.sleep(0.05)
+    session.cancel_tasks("chat")
+    result = await asyncio.wait_for(call, 1)
+    assert "generation of the response has been stopped" in result.result
+
+    # shared invocations of deduplicated actions are cancelled, too
+    set_restrictions([], [], ["testaction"])
+    try:
+        call = asyncio.ensure_future(method.invoke_tool("TestAgent--TestAction", {}, "a/1"))
+        await asyncio.sleep(0.05)
+        shared = next(iter(method.inflight_invocations.values()))
+        session.cancel_tasks("chat")
+        result = await asyncio.wait_for(call, 1)
+        assert "generation of the response has been stopped" in result.result
+        await asyncio.sleep(0)
+        assert shared.cancelled() and method.inflight_invocations == {}
+    finally:
+        set_restrictions([], [], [])
+
+
+@pytest.mark.anyio
+async def test_catalog_watcher(platform):
+    changes = []
+
+    async def listener(catalog, diff):
+        changes.append(diff)
+
+    with (patch("src.opaca_client.CATALOG_WATCH_INTERVAL", 0.01),
+          patch("src.tool_catalog.catalog_listeners", [listener])):
+        opaca_client = OpacaClient()
+        assert await opaca_client.connect(URL, None, None) == 200
+        assert "TestAgent" in await opaca_client.get_agent_summaries()
+        await asyncio.sleep(0.05)
+        assert changes == []
+
+        platform.containers = [*CONTAINERS, {**CONTAINERS[0], "containerId": "container-2", "agents": []}]
+        await asyncio.sleep(0.05)
+        await stop_catalog_watchers()
+
+    # changes are noticed without any query, and derived data is invalidated
+    assert changes == [{"added": ["container-2"], "removed": [], "changed": []}]
+    assert platform.count("GET", "/containers") > 3
+    assert len(await opaca_client.get_containers()) == 2
+    assert opaca_client._catalog().derived == {}
@@ -0,0 +1,95 @@
+"""
+Tests for chaining the rounds of a query via previous_response_id, using a mocked LLM.
+"""
+
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+from litellm.types.llms.openai import ResponseAPIUsage, ResponsesAPIStreamEvents as event_type
+from openai.types.responses import ResponseFunctionToolCall
+
+from src.models import SessionData, Chat, QueryResponse, LLMConfig, ChatMessage
+from src.response_chain import ResponseChain
+from src.simple_tools import SimpleToolsMethod
+from util import patch_environment
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def llm():
+    """Mocked LLM, calling a tool in each response, recording the requests, and rejecting unknown response IDs."""
+    calls = []
+    stored = set()
+
+    async def stream(response_id):
+        yield SimpleNamespace(type=event_type.RESPONSE_COMPLETED, response=SimpleNamespace(
+            id=response_id,
+            output=[ResponseFunctionToolCall(type="function_call", name="Agent--Action", arguments='{}', call_id=f"call-{response_id}")],
+            usage=ResponseAPIUsage(input_tokens=10, output_tokens=5, total_tokens=15),
+        ))
+
+    async def aresponses_api_with_mcp(**kwargs):
+        calls.append(dict(kwargs))
+        if kwargs.get("previous_response_id") and kwargs["previous_response_id"] not in stored:
+            raise Exception("Previous response not found")
+        response_id = f"resp-{len(calls)}"
+        stored.add(response_id)
+        return stream(response_id)
+
+    with patch("litellm.aresponses_api_with_mcp", aresponses_api_with_mcp), patch_environment({"OPENAI_API_KEY": "test"}):
+        yield SimpleNamespace(calls=calls, stored=stored)
+
+
+async def call(method: SimpleToolsMethod, messages: list, chain: ResponseChain, chain_responses: bool = True):
+    result = await method.call_llm(
+        model_config=LLMConfig(model="openai/gpt-4o-mini", chain_responses=chain_responses),
+        agent="assistant",
+        system_prompt="Test",
+        messages=messages,
+        tools=[{"type": "function", "name": "Agent--Action", "parameters": {}}],
+        chain=chain,
+    )
+    result.tools[0].result = {"ok": True}
+    messages.append(chain.add_tool_results(ChatMessage(role="user", content="Tool results: ok")))
+    messages.append(ChatMessage(role="user", content="Continue"))
+    return result
+
+
+@pytest.mark.anyio
+async def test_rounds_chained(llm):
+    method = SimpleToolsMethod(SessionData(), Chat(chat_id=""), QueryResponse())
+    messages = [ChatMessage(role="user", content="Hi")]
+    chain = ResponseChain()
+
+    first = await call(method, messages, chain)
+    second = await call(method, messages, chain)
+    assert "previous_response_id" not in llm.calls[0] and llm.calls[0]["store"]
+    assert llm.calls[1]["previous_response_id"] == "resp-1"
+    assert llm.calls[1]["input"] == [
+        {"type": "function_call_output", "call_id": "call-resp-1", "output": '{"ok": true}'},
+        {"role": "user", "content": "Continue"},
+    ]
+    assert second.response_metadata["chained_response"] and "chained_response" not in first.response_metadata
+
+    # full input if the stored response is not available any more
+    llm.stored.clear()
+    third = await call(method, messages, chain)
+    assert llm.calls[-2]["previous_response_id"] == "resp-2"
+    assert "previous_response_id" not in llm.calls[-1] and len(llm.calls[-1]["input"]) == 5
+    assert "chained_response" not in third.response_metadata
+
+
+@pytest.mark.anyio
+async def test_rounds_not_chained_by_default(llm):
+    method = SimpleToolsMethod(SessionData(), Chat(chat_id=""), QueryResponse())
+    messages = [ChatMessage(role="user", content="Hi")]
+    chain = ResponseChain()
+    await call(method, messages, chain, chain_responses=False)
+    await call(method, messages, chain, chain_responses=False)
+    assert all("previous_response_id" not in c and "store" not in c for c in llm.calls)
+    assert len(llm.calls[1]["input"]) == 3
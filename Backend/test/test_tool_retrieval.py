@@ -0,0 +1,70 @@
+"""
+Tests for selecting the tools most relevant to the query.
+"""
+
+import pytest
+
+from src.models import SessionData, Chat, QueryResponse, AgentMessage, ToolCall, ToolSelectionConfig
+from src.simple_tools import SimpleToolsMethod
+from src.simple_tools.simple_tools_routes import SimpleToolConfig
+from src.tool_retrieval import rank_tools, tokenize, get_index
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+def function(name: str, description: str, *params: str) -> dict:
+    return {"type": "function", "name": name, "description": description,
+            "parameters": {"type": "object", "properties": {p: {"type": "string"} for p in params}}}
+
+
+TOOLS = [
+    function("RoomBooking--BookRoom", "Book a meeting room for a given time slot.", "roomId", "startTime"),
+    function("RoomBooking--GetFreeRooms", "List all rooms that are free right now."),
+    function("Kitchen--GetFridgeContents", "Get the items currently in the fridge."),
+    function("Weather--GetForecast", "Get the weather forecast for a city.", "city"),
+    *(function(f"Dummy{i}--DoThing{i}", f"Does thing number {i}.", f"param{i}") for i in range(200)),
+]
+
+
+def test_tokenize():
+    assert tokenize("RoomBooking--GetFreeRooms") == ["room", "booking", "free", "room"]
+    assert tokenize("start_time of the Meetings") == ["start", "time", "meeting"]
+
+
+@pytest.mark.anyio
+async def test_rank_tools():
+    selected = await rank_tools(TOOLS, "Is there a free room? Please book it from 10:00.", 3)
+    assert len(selected) == 3
+    assert [t["name"] for t in selected[:2]] == ["RoomBooking--BookRoom", "RoomBooking--GetFreeRooms"]
+
+    # tools already used are kept, and the original order is preserved
+    selected = await rank_tools(TOOLS, "What's the weather like in Berlin?", 2, always=["Kitchen--GetFridgeContents"])
+    assert [t["name"] for t in selected] == ["Kitchen--GetFridgeContents", "Weather--GetForecast"]
+
+    assert await rank_tools(TOOLS[:4], "weather", 10) == TOOLS[:4]
+
+
+def test_index_by_full_specs():
+    index = get_index(TOOLS)
+    assert get_index([dict(t) for t in TOOLS]) is index
+    # tools differing only in their parameters are indexed anew
+    changed = function("Weather--GetForecast", "Get the weather forecast for a city.", "zipCode")
+    assert get_index([*TOOLS[:3], changed, *TOOLS[4:]]) is not index
+
+
+@pytest.mark.anyio
+async def test_select_tools():
+    session = SessionData()
+    session.config[SimpleToolsMethod.NAME] = SimpleToolConfig(tool_selection=ToolSelectionConfig(max_tools=2))
+    previous = QueryResponse(query="What is in the fridge?", agent_messages=[AgentMessage(
+        agent="assistant", tools=[ToolCall(id="1", type="opaca", name="Kitchen--GetFridgeContents")])])
+    method = SimpleToolsMethod(session, Chat(chat_id="c1", responses=[previous]), QueryResponse(query="And the weather in Berlin?"))
+    assert [t["name"] for t in await method.select_tools(TOOLS)] == ["Kitchen--GetFridgeContents", "Weather--GetForecast"]
+
+    # at most 128 tools by default
+    method = SimpleToolsMethod(SessionData(), Chat(chat_id=""), QueryResponse(query="Book a room"))
+    selected = await method.select_tools(TOOLS)
+    assert len(selected) == 128 and TOOLS[0] in selected
@@ -0,0 +1,230 @@
+"""
+Tests for streaming messages to the session's websocket, using a mocked websocket.
+"""
+
+import asyncio
+import json
+import time
+from unittest.mock import patch
+
+import pytest
+
+from src import websocket_stream
+from src.models import SessionData, TextChunkMessage, StatusMessage, PushAdvert, PushMessage
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+class MockWebSocket:
+    def __init__(self, delay: float = 0):
+        self.sent = []
+        self.delay = delay
+        self.closed_with = None
+
+    async def send_json(self, message: dict):
+        await asyncio.sleep(self.delay)
+        self.sent.append(message)
+
+    async def send_bytes(self, data: bytes):
+        self.sent.append(websocket_stream.decode_msgpack(data))
+
+    async def close(self, code: int):
+        self.closed_with = code
+
+
+def chunk(text: str, message_id: str = "m1") -> TextChunkMessage:
+    return TextChunkMessage(id=message_id, agent="assistant", chunk=text, is_output=True, chat_id="c1")
+
+
+@pytest.fixture
+async def session():
+    session = SessionData()
+    await session.attach_websocket(MockWebSocket())
+    yield session
+    await session.detach_websocket()
+
+
+@pytest.mark.anyio
+async def test_chunks_coalesced_within_window(session):
+    with patch("src.websocket_stream.WS_COALESCE_MS", 10):
+        for text in ("Hel", "lo", " World"):
+            await session.websocket_send(chunk(text))
+        assert session._websocket.sent == []
+        await asyncio.sleep(0.05)
+        await session._ws_writer.join()
+    assert [m["chunk"] for m in session._websocket.sent] == ["Hello World"]
+
+
+@pytest.mark.anyio
+async def test_chunks_flushed_on_boundaries(session):
+    with patch("src.websocket_stream.WS_COALESCE_MS", 1000), patch("src.websocket_stream.WS_COALESCE_MAX_CHARS", 10):
+        await session.websocket_send(chunk("a"))
+        await session.websocket_send(chunk("b", "m2"))
+        await session.websocket_send(chunk("c", "m2"))
+        await session.websocket_send(StatusMessage(agent="assistant", status="Working", chat_id="c1"))
+        await session.websocket_send(chunk("0123456789"))
+        await session._ws_writer.join()
+    sent = session._websocket.sent
+    assert [(m["type"], m.get("chunk")) for m in sent] == [
+        ("TextChunkMessage", "a"),
+        ("TextChunkMessage", "bc"),
+        ("StatusMessage", None),
+        ("TextChunkMessage", "0123456789"),
+    ]
+
+
+@pytest.mark.anyio
+async def test_chunks_not_coalesced_if_disabled(session):
+    with patch("src.websocket_stream.WS_COALESCE_MS", 0):
+        await session.websocket_send(chunk("a"))
+        await session.websocket_send(chunk("b", "m2"))
+        await session._ws_writer.join()
+    assert [m["chunk"] for m in session._websocket.sent] == ["a", "b"]
+
+
+@pytest.mark.anyio
+async def test_slow_client_does_not_block_producer():
+    session = SessionData()
+    websocket = MockWebSocket(delay=0.05)
+    with patch("src.websocket_stream.WS_COALESCE_MS", 0), patch("src.websocket_stream.WS_QUEUE_SIZE", 4):
+        await session.attach_websocket(websocket)
+        # pending chunks of the same message are merged while waiting for the client
+        for text in "abc":
+            await session.websocket_send(chunk(text))
+        assert session._ws_buffer.stats["merged"] == 2
+
+        # low-priority messages are dropped once the queue is half full
+        await session.websocket_send(chunk("x", "m2"))
+        await session.websocket_send(StatusMessage(agent="assistant", status="Working", chat_id="c1"))
+        assert session._ws_buffer.stats["dropped"] == 1
+
+        # if too many messages are pending, the stalled websocket is closed, keeping the messages for resending
+        for i in range(2):
+            await session.websocket_send(chunk(str(i), f"n{i}"))
+        assert session._ws_writer.stalled
+        await session._ws_writer.close_task
+        assert websocket.closed_with == 1013
+        await session.detach_websocket()
+
+        websocket = MockWebSocket()
+        await session.attach_websocket(websocket, last_seq=0)
+        await session._ws_writer.join()
+        assert [m["chunk"] for m in websocket.sent] == ["abc", "x", "0", "1"]
+        await session.detach_websocket()
+
+
+@pytest.mark.anyio
+@patch("src.websocket_stream.WS_COALESCE_MS", 0)
+async def test_resume_after_reconnect(session):
+    for i in range(3):
+        await session.websocket_send(chunk(str(i), f"m{i}"))
+    await session._ws_writer.join()
+    assert [m["seq"] for m in session._websocket.sent] == [1, 2, 3]
+    await session.detach_websocket()
+
+    # sent while disconnected; only the latest messages of each scheduled task are kept
+    for i in range(2):
+        await session.websocket_send(PushAdvert(task_id=1, query="q"))
+        await session.websocket_send(PushMessage(task_id=1, query="q", content=f"result {i}"))
+    assert session._ws_buffer.stats["superseded"] == 2
+
+    # the client missed the last message before the connection was lost
+    websocket = MockWebSocket()
+    await session.attach_websocket(websocket, last_seq=2)
+    await session._ws_writer.join()
+    assert [(m["seq"], m["type"]) for m in websocket.sent] == [(3, "TextChunkMessage"), (6, "PushAdvert"), (7, "PushMessage")]
+    assert websocket.sent[-1]["content"] == "result 1"
+
+
+@pytest.mark.anyio
+@patch("src.websocket_stream.WS_COALESCE_MS", 0)
+async def test_reload_chats_if_messages_dropped(session):
+    await session.detach_websocket()
+    with patch("src.websocket_stream.WS_BUFFER_MAX_BYTES", 500):
+        for i in range(10):
+            await session.websocket_send(chunk("x" * 100, f"m{i}"))
+        assert session._ws_buffer.size <= 500
+
+        websocket = MockWebSocket()
+        await session.attach_websocket(websocket)
+        await session._ws_writer.join()
+    assert [m["id"] for m in websocket.sent[:-1]] == [f"m{i}" for i in range(10 - len(websocket.sent) + 1, 10)]
+    assert websocket.sent[-1]["type"] == "ReloadChatsMessage"
+
+
+@pytest.mark.anyio
+@patch("src.websocket_stream.WS_COALESCE_MS", 0)
+async def test_undelivered_messages_kept_while_connected():
+    session = SessionData()
+    websocket = MockWebSocket(delay=0.01)
+    await session.attach_websocket(websocket)
+    with patch("src.websocket_stream.WS_BUFFER_MAX_BYTES", 500):
+        for i in range(10):
+            await session.websocket_send(chunk("x" * 100, f"m{i}"))
+        await session._ws_writer.join()
+        # only messages already sent are dropped to stay within the size limit
+        assert session._ws_buffer.size <= 500
+    assert [m["id"] for m in websocket.sent] == [f"m{i}" for i in range(10)]
+    await session.detach_websocket()
+
+
+@pytest.mark.anyio
+@patch("src.websocket_stream.WS_COALESCE_MS", 0)
+async def test_sent_messages_trimmed_after_resume_window(session):
+    for i in range(3):
+        await session.websocket_send(chunk(str(i), f"m{i}"))
+    await session._ws_writer.join()
+    assert session._ws_buffer.info()["entries"] == 3
+
+    with patch("src.websocket_stream.time.time", return_value=time.time() + 61):
+        await session.websocket_send(chunk("3", "m3"))
+    await session._ws_writer.join()
+    assert session._ws_buffer.info()["entries"] == 1 and session._ws_buffer.stats["trimmed"] == 3
+
+    # a client resuming from before the trimmed messages has to reload the chats
+    websocket = MockWebSocket()
+    await session.attach_websocket(websocket, last_seq=1)
+    await session._ws_writer.join()
+    assert [m["type"] for m in websocket.sent] == ["TextChunkMessage", "ReloadChatsMessage"]
+
+
+@pytest.mark.anyio
+@patch("src.websocket_stream.WS_COALESCE_MS", 0)
+async def test_msgpack_encoding():
+    pytest.importorskip("msgpack")
+    assert websocket_stream.select_subprotocol(["sage.msgpack", "sage.json"]) == "sage.msgpack"
+    assert websocket_stream.select_subprotocol(["sage.json"]) == "sage.json"
+    assert websocket_stream.select_subprotocol([]) is None
+
+    message = {"type": "ToolResultMessage", "id": "t1", "result": {"rooms": [{"id": 1, "free": True}]}, "chat_id": "c1"}
+    encoded = websocket_stream.encode_msgpack(message)
+    assert len(encoded) < len(json.dumps(message))
+    assert websocket_stream.decode_msgpack(encoded) == message
+    # unknown types are kept as they are
+    assert websocket_stream.decode_msgpack(websocket_stream.encode_msgpack({"type": "Other"})) == {"type": "Other"}
+
+    session = SessionData()
+    websocket = MockWebSocket()
+    await session.attach_websocket(websocket, subprotocol="sage.msgpack")
+    await session.websocket_send(chunk("a"))
+    await session._ws_writer.join()
+    assert websocket.sent == [{**chunk("a").model_dump(), "type": "TextChunkMessage", "seq": 1}]
+    await session.detach_websocket()
+
+
+@pytest.mark.anyio
+@patch("src.websocket_stream.WS_COALESCE_MS", 0)
+async def test_websocket_replaced(session):
+    old_websocket, old_writer = session._websocket, session._ws_writer
+    websocket = MockWebSocket()
+    await session.attach_websocket(websocket)
+    assert old_writer.closed and old_writer.task.done()
+
+    # the old connection closing afterwards does not detach the new one
+    assert not await session.detach_websocket(old_websocket)
+    await session.websocket_send(chunk("a"))
+    await session._ws_writer.join()
+    assert [m["chunk"] for m in websocket.sent] == ["a"] and old_websocket.sent == []
@@ -1,9 +1,14 @@
+import os
+from contextlib import contextmanager
 from typing import Union, Optional
+from unittest.mock import patch
+
 from fastapi import Request, Response
 
 from starlette.datastructures import Headers
 from starlette.websockets import WebSocket
 
+from src.model_capabilities import invalidate_model_capabilities
 from src.models import SessionData, OpacaException
 from src.session_manager import create_or_refresh_session
 
@@ -26,6 +31,14 @@ def example_prompt():
         ]
     }
 
+@contextmanager
+def patch_environment(values: dict):
+    """Patch the environment (e.g. API keys), invalidating the model capabilities derived from it."""
+    with patch.dict(os.environ, values):
+        invalidate_model_capabilities()
+        yield
+    invalidate_model_capabilities()
+
 async def handle_admin_session_id(source: Request, response: Response) -> SessionData:
     return await handle_test_session_id("admin", source, response)
 
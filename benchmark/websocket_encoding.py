@@ -0,0 +1,98 @@
+"""
+Compare the JSON and MessagePack encodings of the websocket messages sent by the backend, regarding the size of
+the encoded messages (with and without the per-message compression that may be negotiated with the browser)
+and the time needed for encoding them.
+
+The messages are read from a recorded stream, i.e. a file with one message (as sent via websocket) per line,
+e.g. copied from the browser's developer tools. Without such a file, a synthetic stream with text chunks and
+larger, nested tool results is used.
+"""
+import argparse
+import json
+import random
+import sys
+import time
+import zlib
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "Backend"))
+from src.websocket_stream import encode_msgpack
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--file", type=str, default=None, help="Recorded stream, with one JSON message per line. If not given, a synthetic stream is used.")
+    parser.add_argument("-n", "--repetitions", type=int, default=20, help="How often to encode the entire stream for measuring the time.")
+    return parser.parse_args()
+
+
+def load_stream(file: str) -> list[dict]:
+    with open(file, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def synthetic_stream(seed: int = 42) -> list[dict]:
+    rnd = random.Random(seed)
+    messages = []
+    for query in range(20):
+        chat_id = f"chat-{query}"
+        for tool in range(3):
+            tool_id = f"msg-{query}/{tool}"
+            messages.append({"type": "ToolCallMessage", "id": tool_id, "name": "RoomBooking--GetRooms", "args": {"building": rnd.randint(1, 9)}, "agent": "assistant", "chat_id": chat_id})
+            result = [{"id": i, "name": f"Room {i}", "free": rnd.random() < 0.5, "capacity": rnd.randint(2, 40),
+                       "equipment": rnd.sample(["projector", "whiteboard", "camera", "screen", "phone"], 3),
+                       "position": {"x": rnd.uniform(0, 100), "y": rnd.uniform(0, 100), "floor": rnd.randint(0, 5)}}
+                      for i in range(rnd.randint(10, 100))]
+            messages.append({"type": "ToolResultMessage", "id": tool_id, "result": result, "chat_id": chat_id, "cached": False})
+        for _ in range(rnd.randint(50, 200)):
+            chunk = " ".join(rnd.choice(["the", "room", "is", "free", "at", "10:00", "booked", "for", "you"]) for _ in range(rnd.randint(1, 4)))
+            messages.append({"type": "TextChunkMessage", "id": f"msg-{query}", "agent": "assistant", "chunk": chunk, "is_output": True, "chat_id": chat_id})
+        messages.append({"type": "MetricsMessage", "agent": "assistant", "metrics": {"input_tokens": rnd.randint(500, 5000), "output_tokens": rnd.randint(50, 500), "cached_tokens": 0}, "execution_time": rnd.uniform(0.5, 5), "chat_id": chat_id, "cached_tokens": 0})
+    for seq, message in enumerate(messages, start=1):
+        message["seq"] = seq
+    return messages
+
+
+def encode_json(message: dict) -> bytes:
+    # same as starlette's send_json
+    return json.dumps(message, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def deflate(data: bytes) -> bytes:
+    # like permessage-deflate (raw deflate, without context takeover)
+    compressor = zlib.compressobj(wbits=-15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def measure(name: str, encode, messages: list[dict], repetitions: int) -> dict:
+    encoded = [encode(m) for m in messages]
+    start = time.perf_counter()
+    for _ in range(repetitions):
+        for message in messages:
+            encode(message)
+    encode_time = (time.perf_counter() - start) / repetitions
+    return {
+        "encoding": name,
+        "bytes": sum(map(len, encoded)),
+        "deflated_bytes": sum(len(deflate(e)) for e in encoded),
+        "encode_ms": encode_time * 1000,
+    }
+
+
+def main():
+    args = parse_arguments()
+    messages = load_stream(args.file) if args.file else synthetic_stream()
+    results = [measure(name, encode, messages, args.repetitions) for name, encode in (("json", encode_json), ("msgpack", encode_msgpack))]
+
+    print(f"{len(messages)} messages")
+    print(f"{'encoding':<10}{'bytes':>12}{'deflated':>12}{'encode (ms)':>14}")
+    for r in results:
+        print(f"{r['encoding']:<10}{r['bytes']:>12}{r['deflated_bytes']:>12}{r['encode_ms']:>14.2f}")
+    json_result, msgpack_result = results
+    print(f"msgpack vs. json: {msgpack_result['bytes'] / json_result['bytes']:.0%} size, "
+          f"{msgpack_result['deflated_bytes'] / json_result['deflated_bytes']:.0%} deflated size, "
+          f"{msgpack_result['encode_ms'] / json_result['encode_ms']:.0%} encoding time")
+
+
+if __name__ == "__main__":
+    main()